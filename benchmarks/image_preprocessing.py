@@ -0,0 +1,164 @@
+"""
+Payload size, vision tokens and latency of ImagePreprocessor on a fixed
+image corpus, before (raw photo) and after preprocessing.
+
+    python -m benchmarks.image_preprocessing path/to/corpus
+    python -m benchmarks.image_preprocessing path/to/corpus --solve
+
+With --solve every photo is also solved by TaskSolverGPT twice, raw and
+preprocessed (needs OPENAI_API_KEY), and the report adds end-to-end solve
+latency, the tokens OpenAI billed and accuracy. If the corpus contains an
+answers.json ({"<file name>": "<expected final answer>"}) accuracy is
+measured against it, otherwise as agreement of the preprocessed answer
+with the raw one.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List, Optional
+
+from PIL import Image
+
+from bot.image_preprocessing import ImagePreprocessor, estimate_vision_tokens
+from bot.solution_cache import normalize_query_text
+
+_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _load_corpus(directory: str) -> Dict[str, bytes]:
+    corpus = {}
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(_EXTENSIONS):
+            with open(os.path.join(directory, name), "rb") as f:
+                corpus[name] = f.read()
+    return corpus
+
+
+def _size(content: bytes):
+    with Image.open(io.BytesIO(content)) as image:
+        return image.size
+
+
+def _final_answer(answer: Dict[str, Any]) -> str:
+    parts = [
+        item.get("content", "")
+        for solution in answer.get("solutions", [])
+        for item in solution.get("solution", [])
+    ]
+    return normalize_query_text(" ".join(parts))
+
+
+def _percentiles(values: List[float]) -> str:
+    if not values:
+        return "-"
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(0.95 * len(values)))]
+    return f"p50 {1000 * statistics.median(values):.1f} ms, p95 {1000 * p95:.1f} ms"
+
+
+def measure_preprocessing(corpus: Dict[str, bytes]) -> Dict[str, Dict[str, Any]]:
+    preprocessor = ImagePreprocessor()
+    results = {}
+    for name, content in corpus.items():
+        start_time = time.perf_counter()
+        image = preprocessor.process(content)
+        latency = time.perf_counter() - start_time
+        width, height = _size(content)
+        results[name] = {
+            "image": image,
+            "latency": latency,
+            "bytes_before": len(content),
+            "bytes_after": len(image.data),
+            # The model sees the base64 string
+            "payload_before": len(base64.b64encode(content)),
+            "payload_after": len(base64.b64encode(image.data)),
+            "tokens_before": estimate_vision_tokens(width, height),
+            "tokens_after": estimate_vision_tokens(*_size(image.data)),
+        }
+    return results
+
+
+async def _solve(solver, content: bytes, mime_type: str) -> Dict[str, Any]:
+    # Usage reported by OpenAI, see LLMRateLimiter.reconcile
+    used_before = solver.rate_limiter.actual_tokens
+    start_time = time.perf_counter()
+    answer = await solver.solve(content, mime_type)
+    return {
+        "answer": answer,
+        "latency": time.perf_counter() - start_time,
+        "billed_tokens": solver.rate_limiter.actual_tokens - used_before,
+    }
+
+
+async def measure_solving(
+    corpus: Dict[str, bytes],
+    results: Dict[str, Dict[str, Any]],
+    expected: Optional[Dict[str, str]],
+) -> Dict[str, Any]:
+    from bot.gpt_service import TaskSolverGPT
+
+    solver = TaskSolverGPT(openai_api_key=os.environ["OPENAI_API_KEY"])
+    latencies = {"before": [], "after": []}
+    billed = {"before": 0, "after": 0}
+    correct = {"before": 0, "after": 0}
+    for name, content in corpus.items():
+        image = results[name]["image"]
+        raw = await _solve(solver, content, "image/jpeg")
+        processed = await _solve(solver, image.data, image.mime_type)
+        for key, run in (("before", raw), ("after", processed)):
+            latencies[key].append(run["latency"] + (results[name]["latency"] if key == "after" else 0))
+            billed[key] += run["billed_tokens"]
+        if expected is not None and name in expected:
+            reference = normalize_query_text(expected[name])
+            correct["before"] += reference in _final_answer(raw["answer"])
+            correct["after"] += reference in _final_answer(processed["answer"])
+        else:
+            correct["before"] += 1
+            correct["after"] += _final_answer(processed["answer"]) == _final_answer(raw["answer"])
+    return {"latencies": latencies, "billed": billed, "correct": correct}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("corpus", help="directory of photos")
+    parser.add_argument("--solve", action="store_true", help="also solve every photo with OpenAI")
+    args = parser.parse_args()
+
+    corpus = _load_corpus(args.corpus)
+    if not corpus:
+        raise SystemExit(f"No images in {args.corpus}")
+    results = measure_preprocessing(corpus)
+    rows = list(results.values())
+
+    def total(key):
+        return sum(row[key] for row in rows)
+
+    print(f"{len(rows)} images")
+    for label, key in (("file bytes", "bytes"), ("base64 payload", "payload"), ("vision tokens", "tokens")):
+        before, after = total(key + "_before"), total(key + "_after")
+        print(f"{label:>15}: {before:>12,} -> {after:>12,} ({after / before:.0%})")
+    print(f"{'preprocessing':>15}: {_percentiles([row['latency'] for row in rows])}")
+
+    if args.solve:
+        expected = None
+        answers_path = os.path.join(args.corpus, "answers.json")
+        if os.path.exists(answers_path):
+            with open(answers_path, encoding="utf-8") as f:
+                expected = json.load(f)
+        solved = asyncio.run(measure_solving(corpus, results, expected))
+        accuracy = "accuracy" if expected is not None else "agreement with raw"
+        for key in ("before", "after"):
+            print(
+                f"{'solve ' + key:>15}: {_percentiles(solved['latencies'][key])}, "
+                f"billed tokens {solved['billed'][key]:,}, "
+                f"{accuracy} {solved['correct'][key] / len(rows):.0%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
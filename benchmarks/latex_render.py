@@ -0,0 +1,244 @@
+"""
+Render benchmarks for LatexRenderer on a corpus of solutions.
+
+    python -m benchmarks.latex_render format [--corpus solutions.json] [--count 40]
+    python -m benchmarks.latex_render fragments [--corpus solutions.json]
+    python -m benchmarks.latex_render backends [--corpus solutions.json]
+
+format: per-render latency of the same documents compiled one-shot with
+the full preamble (before the dumped format), one-shot against the dumped
+format, and through the warm TeX worker pool.
+
+fragments: renders the corpus in order, starting from an empty cache,
+once as whole documents and once in fragment mode, and reports the math
+fragment hit rate next to the whole-solution cache hit rate and the
+render latency of both.
+
+backends: how many solutions the automatic routing sends to mathtext and
+how many to xelatex, and the render latency of each backend, next to the
+latency of the mathtext-eligible solutions when rendered by xelatex.
+
+The corpus is a JSON list (or JSON lines) of solution dicts as produced by
+TaskSolverGPT, or of {"solutions": [...]} answers such as the `solution`
+column of the tasks table. Without --corpus a synthetic one is generated:
+quadratic and linear equations, which share standard steps, and systems
+and word problems, which need full LaTeX.
+Needs xelatex and pdftoppm on PATH.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+from bot.latex_renderer import RENDER_CACHE_MEMORY_MAX_BYTES, LatexRenderer, build_latex
+from bot.render_cache import RenderCache
+
+
+def _quadratic(rnd: random.Random) -> Dict[str, Any]:
+    x1, x2 = rnd.randint(-9, 9), rnd.randint(-9, 9)
+    b, c = -(x1 + x2), x1 * x2
+    d = b * b - 4 * c
+    return {
+        "problem": f"Решите уравнение $x^2 {b:+d}x {c:+d} = 0$.",
+        "steps": [
+            {"type": "text", "content": "Найдём дискриминант:"},
+            {"type": "math", "content": "D = b^2 - 4ac"},
+            {"type": "math", "content": f"D = {b}^2 - 4 \\cdot 1 \\cdot {c} = {d}"},
+            {"type": "text", "content": "Корни уравнения:"},
+            {"type": "math", "content": "x_{1,2} = \\frac{-b \\pm \\sqrt{D}}{2a}"},
+        ],
+        "solution": [{"type": "math", "content": f"x_1 = {max(x1, x2)}, x_2 = {min(x1, x2)}"}],
+    }
+
+
+def _linear(rnd: random.Random) -> Dict[str, Any]:
+    a, x = rnd.randint(2, 9), rnd.randint(-9, 9)
+    b = rnd.randint(-20, 20)
+    return {
+        "problem": f"Решите уравнение ${a}x {b:+d} = {a * x + b}$.",
+        "steps": [
+            {"type": "text", "content": "Перенесём свободный член вправо:"},
+            {"type": "math", "content": f"{a}x = {a * x + b} {-b:+d}"},
+            {"type": "math", "content": f"x = \\frac{{{a * x}}}{{{a}}}"},
+        ],
+        "solution": [{"type": "math", "content": f"x = {x}"}],
+    }
+
+
+def _system(rnd: random.Random) -> Dict[str, Any]:
+    x, y = rnd.randint(-5, 5), rnd.randint(-5, 5)
+    return {
+        "problem": f"Решите систему уравнений $x + y = {x + y}$, $x - y = {x - y}$.",
+        "steps": [
+            {"type": "math", "content": f"\\begin{{cases}} x + y = {x + y} \\\\ x - y = {x - y} \\end{{cases}}"},
+            {"type": "text", "content": "Сложим уравнения:"},
+            {"type": "math", "content": f"2x = {2 * x} \\Rightarrow x = {x}"},
+        ],
+        "solution": [{"type": "math", "content": f"(x; y) = ({x}; {y})"}],
+    }
+
+
+def _word_problem(rnd: random.Random) -> Dict[str, Any]:
+    speed, hours = rnd.randint(40, 90), rnd.randint(2, 6)
+    return {
+        "problem": f"Поезд идёт со скоростью {speed} км/ч. Какой путь он пройдёт за {hours} ч?",
+        "steps": [
+            {"type": "math", "content": "s = v \\cdot t"},
+            {"type": "math", "content": f"s = {speed} \\cdot {hours} = {speed * hours}\\,\\text{{км}}"},
+        ],
+        "solution": [{"type": "text", "content": f"Ответ: {speed * hours} км."}],
+    }
+
+
+_TEMPLATES = (_quadratic, _quadratic, _linear, _system, _word_problem)
+
+
+def sample_corpus(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rnd = random.Random(seed)
+    return [rnd.choice(_TEMPLATES)(rnd) for _ in range(count)]
+
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    solutions = []
+    for item in items:
+        if isinstance(item, str):
+            item = json.loads(item)
+        solutions.extend(item["solutions"] if "solutions" in item else [item])
+    return solutions
+
+
+def _summary(latencies: List[float]) -> str:
+    if not latencies:
+        return "no renders"
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    return (
+        f"n {len(latencies):>4}  p50 {1000 * statistics.median(latencies):>8.1f} ms  "
+        f"p95 {1000 * p95:>8.1f} ms  mean {1000 * statistics.fmean(latencies):>8.1f} ms"
+    )
+
+
+def _time_each(render: Callable[[Any], Any], items: List[Any]) -> List[float]:
+    latencies = []
+    for item in items:
+        start_time = time.perf_counter()
+        render(item)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def bench_format(solutions: List[Dict[str, Any]]) -> None:
+    renderer = LatexRenderer(fragment_mode=False, mathtext_enabled=False)
+    fmt = renderer.build_format()
+    if fmt is None:
+        raise SystemExit("Building the LaTeX format failed; is xelatex on PATH?")
+    documents = [build_latex(solution) for solution in solutions]
+    results = {
+        "plain": _time_each(lambda latex: renderer._compile_document(latex, None), documents),
+        "format": _time_each(lambda latex: renderer._compile_document(latex, fmt), documents),
+    }
+    renderer.warm()
+    results["pool"] = _time_each(lambda latex: renderer._compile(latex, fmt), documents)
+    renderer.close()
+    for mode, latencies in results.items():
+        print(f"{mode:>8}: {_summary(latencies)}")
+    plain = statistics.median(results["plain"])
+    for mode in ("format", "pool"):
+        print(f"{mode:>8}: {plain / statistics.median(results[mode]):.1f}x faster than plain at p50")
+    pool = renderer.stats()["pool"]
+    if pool is not None:
+        print(f"    pool: {pool['cold_starts']} cold starts in {pool['jobs']} jobs")
+
+
+def _fresh_renderer(**kwargs) -> LatexRenderer:
+    """A renderer with an empty, memory-only cache."""
+    renderer = LatexRenderer(**kwargs)
+    renderer._cache = RenderCache(
+        directory=None, memory_max_bytes=RENDER_CACHE_MEMORY_MAX_BYTES, disk_max_bytes=0
+    )
+    return renderer
+
+
+async def _render_all(renderer: LatexRenderer, solutions: List[Dict[str, Any]]) -> List[float]:
+    latencies = []
+    for solution in solutions:
+        start_time = time.perf_counter()
+        await renderer.render_solution(solution)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def bench_fragments(solutions: List[Dict[str, Any]]) -> None:
+    whole = _fresh_renderer(fragment_mode=False, mathtext_enabled=False)
+    whole.warm()
+    fragments = _fresh_renderer(fragment_mode=True, mathtext_enabled=False)
+    results = {
+        "whole": asyncio.run(_render_all(whole, solutions)),
+        "fragments": asyncio.run(_render_all(fragments, solutions)),
+    }
+    whole.close()
+    fragments.close()
+    for mode, latencies in results.items():
+        print(f"{mode:>9}: {_summary(latencies)}")
+    stats = fragments.stats()["fragments"]
+    print(f"whole-solution cache hit rate: {whole.stats()['cache']['hit_rate']:.1%}")
+    print(
+        f"math fragment hit rate: {stats['math_hit_rate']:.1%} "
+        f"({stats['math_hits']} hits, {stats['math_misses']} misses)"
+    )
+
+
+def bench_backends(solutions: List[Dict[str, Any]]) -> None:
+    routed = _fresh_renderer(fragment_mode=False, mathtext_enabled=True)
+    if not routed._mathtext.available:
+        raise SystemExit("matplotlib isn't installed; every solution would go to xelatex")
+    eligible = [solution for solution in solutions if routed._mathtext.qualifies(solution)]
+    print(f"routed to mathtext: {len(eligible) / len(solutions):.1%} ({len(eligible)} of {len(solutions)})")
+    routed.warm()
+    asyncio.run(_render_all(routed, solutions))
+    routed.close()
+    backends = routed.stats()["backends"]
+    for backend in ("mathtext", "xelatex"):
+        stats = backends[backend]
+        if stats["count"]:
+            print(
+                f"{backend:>9}: n {stats['count']:>4}  p50 {1000 * stats['p50_latency_sec']:>8.1f} ms  "
+                f"p90 {1000 * stats['p90_latency_sec']:>8.1f} ms"
+            )
+    print(f"mathtext failures that fell back to xelatex: {backends['mathtext_fallbacks']}")
+    if eligible:
+        tex_only = _fresh_renderer(fragment_mode=False, mathtext_enabled=False)
+        tex_only.warm()
+        latencies = asyncio.run(_render_all(tex_only, eligible))
+        tex_only.close()
+        print(f"eligible via xelatex: {_summary(latencies)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("benchmark", choices=["format", "fragments", "backends"])
+    parser.add_argument("--corpus", help="JSON or JSON lines file of solutions")
+    parser.add_argument("--count", type=int, default=40, help="size of the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    solutions = load_corpus(args.corpus) if args.corpus else sample_corpus(args.count, args.seed)
+    print(f"{len(solutions)} solutions")
+    if args.benchmark == "format":
+        bench_format(solutions)
+    elif args.benchmark == "fragments":
+        bench_fragments(solutions)
+    elif args.benchmark == "backends":
+        bench_backends(solutions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Load test of SupabaseService: throughput of uncached reads as the number
+of concurrent users grows, with every call on the I/O pool (the current
+code) and with calls run inline on the event loop (how the service used
+to call supabase-py).
+
+    python -m benchmarks.supabase_load
+    python -m benchmarks.supabase_load --concurrency 1 4 16 64 --duration 10
+
+Uses SUPABASE_URL, SUPABASE_KEY, USER_EMAIL and USER_PASSWORD like the app;
+the reads are get_solution_by_query_hash lookups of random hashes, which
+miss every cache and touch no rows.
+"""
+import argparse
+import asyncio
+import os
+import secrets
+import statistics
+import time
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+from bot.supabase_service import SupabaseService
+
+
+def _inline(db: SupabaseService) -> None:
+    """Make `db` call supabase-py directly on the event loop."""
+
+    async def run(func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    db._run = run
+
+
+async def _user(db: SupabaseService, deadline: float, latencies: List[float], errors: List[str]) -> None:
+    while time.monotonic() < deadline:
+        start_time = time.monotonic()
+        response = await db.get_solution_by_query_hash(secrets.token_hex(32))
+        latencies.append(time.monotonic() - start_time)
+        if response.get("status_code") != 200:
+            errors.append(response.get("error", ""))
+
+
+async def measure(db: SupabaseService, concurrency: int, duration: float) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors: List[str] = []
+    start_time = time.monotonic()
+    deadline = start_time + duration
+    await asyncio.gather(*(_user(db, deadline, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.monotonic() - start_time
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies) if latencies else 0.0,
+        "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+    }
+
+
+async def run(concurrency: List[int], duration: float, modes: List[str]) -> None:
+    db = SupabaseService(
+        supabase_url=os.environ.get("SUPABASE_URL"),
+        supabase_key=os.environ.get("SUPABASE_KEY"),
+        user_email=os.environ.get("USER_EMAIL"),
+        user_password=os.environ.get("USER_PASSWORD"),
+    )
+    pooled_run = db._run
+    print(f"{'mode':>6} {'users':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'errors':>6}")
+    for mode in modes:
+        if mode == "inline":
+            _inline(db)
+        else:
+            db._run = pooled_run
+        # One warm-up call so connection setup isn't measured
+        await db.get_solution_by_query_hash(secrets.token_hex(32))
+        for users in concurrency:
+            result = await measure(db, users, duration)
+            print(
+                f"{mode:>6} {users:>5} {result['throughput']:>8.1f} "
+                f"{result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['errors']:>6}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per level")
+    parser.add_argument("--modes", nargs="+", choices=["pool", "inline"], default=["pool", "inline"])
+    args = parser.parse_args()
+    load_dotenv()
+    asyncio.run(run(args.concurrency, args.duration, args.modes))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
+import asyncio
+import hashlib
+import json
 import os
+import time
+from contextlib import aclosing
 from typing import Annotated
 
 from dotenv import load_dotenv
 from fastapi import FastAPI, Form, UploadFile, File
+from fastapi.responses import StreamingResponse
 
 from bot.constants import (
     DOWNLOAD_ENDPOINT,
     SOLVE_ENDPOINT,
+    SOLVE_STREAM_ENDPOINT,
     ADD_NEW_USER_ENDPOINT,
     GET_EXIST_SOLUTION_ENDPOINT,
     DONATE_ENDPOINT,
@@ -15,45 +22,289 @@ from bot.constants import (
     GET_CURRENT_BALANCE_ENDPOINT,
     DAILY_LIMIT_EXCEEDED_MESSAGE,
     GET_ALL_USER_IDS,
+    STREAM_ALL_USER_IDS,
     ADD_SUBSCRIPTION_LIMITS_FOR_ALL_USERS,
+    STATS_ENDPOINT,
+    PROVIDERS_STATUS_ENDPOINT,
+    LLM_MAX_CONCURRENCY,
 )
 from bot.gemini_service import GeminiSolver
 from bot.gpt_service import TaskSolverGPT
+from bot.hedging import Hedger
+from bot.image_preprocessing import ImagePreprocessor
+from bot.provider_router import ProviderRouter
+from bot.scheduler import PriorityScheduler, classify_priority
+from bot.single_flight import SingleFlight
+from bot.solution_cache import (
+    ImageSolutionCache,
+    TextSolutionCache,
+    compute_image_hash,
+    normalize_query_text,
+    hash_query_text,
+)
+from bot.sqlite_service import SQLiteService
 from bot.supabase_service import SupabaseService
+from bot.upload_pipeline import UploadPipeline
+from bot.write_behind import WriteBehindQueue
 
 load_dotenv()
 
 app = FastAPI()
 solver = TaskSolverGPT(openai_api_key=os.environ.get("OPENAI_API_KEY"))
-db = SupabaseService(
-    supabase_url=os.environ.get("SUPABASE_URL"),
-    supabase_key=os.environ.get("SUPABASE_KEY"),
-    user_email=os.environ.get("USER_EMAIL"),
-    user_password=os.environ.get("USER_PASSWORD"),
-)
+if os.environ.get("DB_BACKEND", "supabase").lower() == "sqlite":
+    # Local stand-in for offline runs and load tests
+    db = SQLiteService(
+        db_path=os.environ.get("SQLITE_PATH", "tasker.sqlite3"),
+        storage_dir=os.environ.get("SQLITE_STORAGE_DIR", "storage"),
+    )
+else:
+    db = SupabaseService(
+        supabase_url=os.environ.get("SUPABASE_URL"),
+        supabase_key=os.environ.get("SUPABASE_KEY"),
+        user_email=os.environ.get("USER_EMAIL"),
+        user_password=os.environ.get("USER_PASSWORD"),
+    )
 gemini_solver = GeminiSolver(google_api_key=os.environ.get("GOOGLE_API_KEY"))
+image_cache = ImageSolutionCache()
+text_cache = TextSolutionCache()
+image_preprocessor = ImagePreprocessor()
+hedger = Hedger()
+router = ProviderRouter(
+    providers={
+        "openai": {
+            "solve": solver.solve,
+            "solve_stream": solver.solve_stream,
+            "text": solver.generate_text_solution,
+        },
+        "gemini": {"solve": gemini_solver.solve, "text": gemini_solver.generate_text},
+    },
+    hedger=hedger,
+)
+single_flight = SingleFlight()
+llm_scheduler = PriorityScheduler(capacity=LLM_MAX_CONCURRENCY)
+write_behind = WriteBehindQueue(db)
+uploads = UploadPipeline(db)
+
+
+def _is_valid_answer(answer) -> bool:
+    return isinstance(answer, dict) and "solutions" in answer
+
+
+@app.on_event("startup")
+async def on_startup():
+    db.start_background_tasks()
+    write_behind.start()
+    loaded = await image_cache.warm(db)
+    print(f"Image cache warmed with {loaded} solutions")
+    loaded = await text_cache.warm(db)
+    print(f"Text cache warmed with {loaded} solutions")
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await uploads.stop()
+    await write_behind.stop()
+    await db.stop_background_tasks()
+
+
+async def _lookup_image_solution(image_hash: str | None):
+    if not image_hash:
+        return None
+    answer = image_cache.get(image_hash)
+    if answer is not None:
+        return answer
+    # Exact match on hash and thumbnail, i.e. the same picture
+    response = await db.get_solution_by_image_hash(image_hash)
+    if response.get("status_code") == 200 and response["message"]:
+        image_cache.record_db_hit(image_hash, response["message"])
+        return response["message"]
+    return None
+
+
+async def _lookup_text_solution(canonical: str, query_hash: str):
+    answer = text_cache.get(canonical)
+    if answer is not None:
+        return answer
+    response = await db.get_solution_by_query_hash(query_hash)
+    if response.get("status_code") == 200 and response["message"]:
+        text_cache.record_db_hit(canonical, response["message"])
+        return response["message"]
+    return None
+
+
+async def _store_image_solution(
+    user_id: str, image_path: str, content: bytes, image_hash: str | None, answer: dict
+):
+    await write_behind.put_last_processing_image_path(user_id=user_id, image_path=image_path)
+    await write_behind.put_solution(
+        user_id=user_id,
+        file_path=image_path,
+        solution=answer,
+        image_hash=image_hash,
+        # The photo itself is stored under its content hash, see upload_image
+        object_path=UploadPipeline.object_path(content),
+    )
+
+
+async def _user_priority(user_id: str) -> str:
+    return classify_priority(await db.get_current_balance(user_id))
+
+
+def _image_flight_key(content: bytes) -> str:
+    return "solve:" + hashlib.sha256(content).hexdigest()
+
+
+async def _solve_image(content: bytes, image_hash: str | None, user_id: str) -> dict:
+    image = await asyncio.to_thread(image_preprocessor.process, content)
+    priority = await _user_priority(user_id)
+    async with llm_scheduler.slot(priority):
+        # OpenAI first unless its breaker is open; Gemini races it once the
+        # hedge delay passes or takes over if OpenAI fails
+        answer = await router.call(
+            "solve", image.data, image.mime_type, validate=_is_valid_answer
+        )
+    if image_hash:
+        image_cache.put(image_hash, answer)
+    return answer
 
 
 @app.post(SOLVE_ENDPOINT)
 async def solve_task(
     image_path: str = Form(...), file: UploadFile = File(...), user_id: str = Form(...)
 ):
-    try:
-        # Try using the GeminiSolver first
-        #answer = await gemini_solver.solve(file)
-        answer = await solver.solve(file)
-    except Exception as e:
-        # Log the error and fall back to TaskSolverGPT
-        print(f"Error with GeminiSolver: {e}. Falling back to TaskSolverGPT.")
-        print(type(file))
-        await file.seek(0)
-        answer = await gemini_solver.solve(file)
-    await db.update_last_processing_image_path(user_id=user_id, image_path=image_path)
-    await db.insert_solution(user_id=user_id, file_path=image_path, solution=answer)
+    content = await file.read()
+    image_hash = await asyncio.to_thread(compute_image_hash, content)
+    answer = await _lookup_image_solution(image_hash)
+    if answer is not None:
+        print("Image cache hit", image_hash[:16])
+    else:
+        answer = await single_flight.do(
+            _image_flight_key(content),
+            lambda: _solve_image(content, image_hash, user_id),
+        )
+    await _store_image_solution(user_id, image_path, content, image_hash, answer)
     print("GETTING SOLUTION", answer)
     return {"message": "Task solved", "answer": answer}
 
 
+def _ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+_STREAM_END = object()
+
+
+async def _stream_solutions(image, priority: str):
+    """
+    Yield solutions as the provider streams them. The provider stream is
+    read by its own task, which holds the LLM slot only until the provider
+    is done, so a slow client can't keep scheduler capacity.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async with llm_scheduler.slot(priority):
+                async for solution in router.stream(
+                    "solve_stream", image.data, image.mime_type
+                ):
+                    queue.put_nowait(solution)
+        finally:
+            queue.put_nowait(_STREAM_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            solution = await queue.get()
+            if solution is _STREAM_END:
+                break
+            yield solution
+        # Raises if the provider stream failed
+        await producer
+    finally:
+        producer.cancel()
+
+
+@app.post(SOLVE_STREAM_ENDPOINT)
+async def solve_task_stream(
+    image_path: str = Form(...), file: UploadFile = File(...), user_id: str = Form(...)
+):
+    """
+    NDJSON variant of SOLVE_ENDPOINT: one {"type": "solution"} line per
+    solution as soon as it is generated, then a {"type": "done"} line.
+    A photo that has to be solved first gets a {"type": "meta"} line with
+    the user's priority; cache hits skip the balance lookup.
+    """
+    content = await file.read()
+
+    async def events():
+        image_hash = await asyncio.to_thread(compute_image_hash, content)
+        answer = await _lookup_image_solution(image_hash)
+        if answer is not None:
+            print("Image cache hit", image_hash[:16])
+            for index, solution in enumerate(answer.get("solutions", [])):
+                yield _ndjson({"type": "solution", "index": index, "solution": solution})
+        elif single_flight.in_flight(_image_flight_key(content)):
+            # Same photo is already being solved; wait for it instead of
+            # starting a second stream
+            answer = await single_flight.do(
+                _image_flight_key(content),
+                lambda: _solve_image(content, image_hash, user_id),
+            )
+            for index, solution in enumerate(answer.get("solutions", [])):
+                yield _ndjson({"type": "solution", "index": index, "solution": solution})
+        else:
+            flight = single_flight.lead(_image_flight_key(content))
+            try:
+                image = await asyncio.to_thread(image_preprocessor.process, content)
+                priority = await _user_priority(user_id)
+                # Lets the bot schedule rendering with the same priority
+                yield _ndjson({"type": "meta", "priority": priority})
+                solutions = []
+                try:
+                    async with aclosing(_stream_solutions(image, priority)) as stream:
+                        async for solution in stream:
+                            yield _ndjson(
+                                {"type": "solution", "index": len(solutions), "solution": solution}
+                            )
+                            solutions.append(solution)
+                except Exception as e:
+                    print(f"Streaming solve failed: {e}")
+                    if solutions:
+                        # Part of the answer is already on screen; don't mix
+                        # in a different model's numbering
+                        raise
+                    async with llm_scheduler.slot(priority):
+                        answer = await router.call(
+                            "solve", image.data, image.mime_type, validate=_is_valid_answer
+                        )
+                    solutions = answer["solutions"]
+                    for index, solution in enumerate(solutions):
+                        yield _ndjson({"type": "solution", "index": index, "solution": solution})
+                answer = {"solutions": solutions}
+                if image_hash:
+                    image_cache.put(image_hash, answer)
+                flight.set_result(answer)
+            except Exception as e:
+                flight.set_exception(e)
+                # Followers report it; don't warn about an unretrieved one
+                flight.exception()
+                yield _ndjson({"type": "error", "error": str(e)})
+                return
+            except BaseException:
+                # Client went away mid-stream; anyone waiting on the same
+                # photo still gets an answer
+                single_flight.hand_off(
+                    _image_flight_key(content),
+                    lambda: _solve_image(content, image_hash, user_id),
+                )
+                raise
+        yield _ndjson({"type": "done", "count": len(answer.get("solutions", []))})
+        await _store_image_solution(user_id, image_path, content, image_hash, answer)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
 @app.post(DOWNLOAD_ENDPOINT)
 async def upload_image(
     file: Annotated[bytes, File(description="A file read as bytes")],
@@ -62,8 +313,14 @@ async def upload_image(
 ):
     proceed_processing = await db.proceed_processing(user_id)
     if proceed_processing:
-        response = await db.upload_file(file_path=image_path, file_bytes=file)
-        return response
+        # Storage is only an archive; solving doesn't wait for it
+        object_path = await uploads.submit(file)
+        print(f"Upload of {image_path} scheduled as {object_path}")
+        return {
+            "message": "File upload scheduled",
+            "status_code": 200,
+            "object_path": object_path,
+        }
     else:
         return {
             "message": "Daily limit exceeded",
@@ -96,21 +353,37 @@ async def donate(user_data: dict):
     return response
 
 
+async def _solve_text(text: str, canonical: str, user_id: str) -> dict:
+    priority = await _user_priority(user_id)
+    start_time = time.monotonic()
+    async with llm_scheduler.slot(priority):
+        answer = await router.call("text", text, validate=_is_valid_answer)
+    text_cache.put(canonical, answer, latency=time.monotonic() - start_time)
+    return answer
+
+
 @app.post(TEXT_SOLVE_ENDPOINT)
 async def text_solve_task(text: str = Form(...), user_id: str = Form(...)):
     print("TEXT SOLVE TASK", text)
     processing = await db.proceed_processing(user_id)
     if processing:
-        try:
-            answer = await solver.generate_text_solution(text)
-            await db.insert_solution(user_id=user_id, file_path="", solution=answer)
-            return {"message": "Task solved", "answer": answer}
-        except Exception as e:
-            # use Gemini as fallback
-            print(f"Error with TaskSolverGPT: {e}. Falling back to GeminiSolver.")
-            answer = await gemini_solver.generate_text(text)
-            await db.insert_solution(user_id=user_id, file_path="", solution=answer)
-            return {"message": "Task solved", "answer": answer}
+        canonical = normalize_query_text(text)
+        query_hash = hash_query_text(canonical)
+        answer = await _lookup_text_solution(canonical, query_hash)
+        if answer is not None:
+            print("Text cache hit", query_hash)
+        else:
+            answer = await single_flight.do(
+                "text:" + query_hash, lambda: _solve_text(text, canonical, user_id)
+            )
+        await write_behind.put_solution(
+            user_id=user_id,
+            file_path="",
+            solution=answer,
+            query_text=canonical,
+            query_hash=query_hash,
+        )
+        return {"message": "Task solved", "answer": answer}
     else:
         return {
             "message": "Daily limit exceeded",
@@ -129,7 +402,7 @@ async def text_solve_task(text: str = Form(...), user_id: str = Form(...)):
 @app.post(LATEX_TO_TEXT_SOLVE_ENDPOINT)
 async def latex_to_text_solve_task(text: str = Form(...), user_id: str = Form(...)):
     answer = await gemini_solver.generate_unicode_solution(text)
-    await db.insert_solution(user_id=user_id, file_path="", solution=answer)
+    await write_behind.put_solution(user_id=user_id, file_path="", solution=answer)
     return {"message": "Task solved", "answer": answer}
 
 
@@ -145,9 +418,46 @@ async def get_all_users():
     return await db.get_all_user_ids()
 
 
+@app.post(STREAM_ALL_USER_IDS)
+async def stream_all_users():
+    async def rows():
+        try:
+            async for row in db.iter_user_ids():
+                yield _ndjson({"user_id": row["user_id"]})
+        except Exception as e:
+            print("User id stream failed", str(e))
+            yield _ndjson({"error": str(e)})
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+
 @app.post(ADD_SUBSCRIPTION_LIMITS_FOR_ALL_USERS)
 async def add_subscription_limits_for_all_users(data: dict):
-    return await db.add_subscription_limits_for_all_users(data["limit"])
+    return await db.add_subscription_limits_for_all_users(
+        data["limit"], resume_after=data.get("resume_after")
+    )
+
+
+@app.get(STATS_ENDPOINT)
+async def stats():
+    return {
+        "image_cache": image_cache.stats(),
+        "text_cache": text_cache.stats(),
+        "hedging": hedger.stats(),
+        "image_preprocessing": image_preprocessor.stats(),
+        "single_flight": single_flight.stats(),
+        "openai_rate_limiter": solver.rate_limiter.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "balance_cache": db.balance_cache.stats(),
+        "user_solution_cache": db.solution_cache.stats(),
+        "write_behind": write_behind.stats(),
+        "uploads": uploads.stats(),
+    }
+
+
+@app.get(PROVIDERS_STATUS_ENDPOINT)
+async def providers_status():
+    return router.status()
 
 
 @app.get("/")
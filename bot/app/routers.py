@@ -18,6 +18,7 @@ from tg_app import (
     notify_all_users,
     notify_user,
     add_subscription_limits_for_all_users,
+    send_render_stats,
 )
 from bot.constants import (
     ADD_NEW_USER_ENDPOINT,
@@ -305,8 +306,20 @@ async def cmd_add_subscription_limits_for_all_users(
     if user_id != ADMIN_TG_ID:
         await message.answer(l10n.format_value("notify-not-allowed"))
         return
-    limit = message.text.split(" ")[1]
-    await add_subscription_limits_for_all_users(limit)
+    # /add_subscription_limits_for_all_users <limit> [<resume after user id>]
+    args = message.text.split()
+    limit = args[1]
+    resume_after = args[2] if len(args) > 2 else None
+    await add_subscription_limits_for_all_users(limit, resume_after)
+
+
+@router.message(Command("render_stats"))
+async def cmd_render_stats(message: Message, l10n: FluentLocalization):
+    user_id = str(message.from_user.id)
+    if user_id != ADMIN_TG_ID:
+        await message.answer(l10n.format_value("notify-not-allowed"))
+        return
+    await send_render_stats()
 
 
 @router.message()
@@ -1,4 +1,5 @@
 import asyncio
+import html
 import json
 import logging
 import os
@@ -20,18 +21,22 @@ from aiohttp import ClientTimeout
 from bot.constants import (
     DOWNLOAD_ENDPOINT,
     SOLVE_ENDPOINT,
+    SOLVE_STREAM_ENDPOINT,
     GET_EXIST_SOLUTION_ENDPOINT,
     LOADING_MESSAGE,
     NETWORK,
     DAILY_LIMIT_EXCEEDED_MESSAGE,
     TEXT_SOLVE_ENDPOINT,
     LATEX_TO_TEXT_SOLVE_ENDPOINT,
-    GET_ALL_USER_IDS,
+    STREAM_ALL_USER_IDS,
     ADD_SUBSCRIPTION_LIMITS_FOR_ALL_USERS,
+    PRIORITY_FREE,
+    RENDER_STATS_LOG_INTERVAL_SEC,
 )
 from bot.fluent_loader import get_fluent_localization
 from bot.latex_renderer import latex_renderer
 from bot.localization import L10nMiddleware
+from bot.solution_cache import SentSolutionCache, solution_key
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -269,6 +274,38 @@ async def get_solution(path, photo_io, user_id):
     return answer["answer"]
 
 
+async def get_solution_stream(path, photo_io, user_id):
+    """Yield (priority, solution) pairs one by one as the app streams them."""
+    priority = PRIORITY_FREE
+    async with aiohttp.ClientSession(timeout=ClientTimeout(5 * 60)) as session:
+        data = aiohttp.FormData()
+        data.add_field("image_path", path)
+        data.add_field(
+            "file", photo_io, filename="image.jpg", content_type="image/jpeg"
+        )
+        data.add_field("user_id", user_id)
+
+        async with session.post(
+                f"http://{NETWORK}:8000{SOLVE_STREAM_ENDPOINT}", data=data
+        ) as response:
+            if response.status != 200:
+                raise Exception(
+                    f"Failed to get solution. Status code: {response.status}"
+                )
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event["type"] == "meta":
+                    priority = event["priority"]
+                elif event["type"] == "solution":
+                    yield priority, event["solution"]
+                elif event["type"] == "error":
+                    raise Exception(f"Solution stream failed: {event['error']}")
+                elif event["type"] == "done":
+                    break
+
+
 async def get_exist_solution(path, user_id):
     async with aiohttp.ClientSession(timeout=ClientTimeout(5 * 60)) as session:
         data = aiohttp.FormData()
@@ -524,6 +561,24 @@ def regenerate_latex(solution):
 
 from bot.latex_renderer import latex_renderer, LatexCompilationError
 
+sent_solutions = SentSolutionCache()
+
+
+def render_stats() -> dict:
+    """Rendering metrics of this process; the app's /stats can't see them."""
+    return {"renderer": latex_renderer.stats(), "sent_solutions": sent_solutions.stats()}
+
+
+async def send_render_stats():
+    text = json.dumps(render_stats(), ensure_ascii=False, indent=1)
+    await bot.send_message(ADMIN_TG_ID, f"<pre>{html.escape(text)}</pre>")
+
+
+async def log_render_stats(interval_sec: float = RENDER_STATS_LOG_INTERVAL_SEC):
+    while True:
+        await asyncio.sleep(interval_sec)
+        logging.info("Render stats: %s", json.dumps(render_stats(), ensure_ascii=False))
+
 
 async def send_solution_to_user(message, answer):
     if not answer:
@@ -534,23 +589,32 @@ async def send_solution_to_user(message, answer):
         answer = json.loads(answer)
 
     for idx, solution in enumerate(answer.get("solutions", []), start=1):
-        try:
+        await send_single_solution_to_user(message, idx, solution)
+
+
+async def send_single_solution_to_user(message, idx, solution, priority=PRIORITY_FREE):
+    try:
+        key = solution_key(solution)
+        photo = sent_solutions.get(key)
+        if photo is None:
             # Use latex_renderer instead of local functions
-            img = await latex_renderer.render_solution(solution)
-            file = BufferedInputFile(img, filename=f"solution_{idx}.png")
-            await message.answer_photo(file, caption=f"Решение {idx}")
-            await bot.send_photo(
-                chat_id=ADMIN_TG_ID,
-                photo=file,
-                caption=f"Solution for user: {message.from_user.id}, @{message.from_user.username}",
-            )
-        except LatexCompilationError as e:
-            print(f"LaTeX error: {str(e)}\nSTDOUT: {e.stdout[:500]}\nSTDERR: {e.stderr[:500]}")
-            await message.answer(f"Проблема с LaTeX. Отправляю текст:")
-            await send_text_solution_to_user(message, json.dumps({"solutions": [solution]}))
-        except Exception as e:
-            logging.exception(f"Unexpected rendering error: {e}")
-            await send_text_solution_to_user(message, json.dumps({"solutions": [solution]}))
+            img = await latex_renderer.render_solution(solution, priority)
+            photo = BufferedInputFile(img, filename=f"solution_{idx}.png")
+        sent = await message.answer_photo(photo, caption=f"Решение {idx}")
+        # Later sends of this solution, including the admin copy, reuse the upload
+        sent_solutions.put(key, sent.photo[-1].file_id)
+        await bot.send_photo(
+            chat_id=ADMIN_TG_ID,
+            photo=sent.photo[-1].file_id,
+            caption=f"Solution for user: {message.from_user.id}, @{message.from_user.username}",
+        )
+    except LatexCompilationError as e:
+        print(f"LaTeX error: {str(e)}\nSTDOUT: {e.stdout[:500]}\nSTDERR: {e.stderr[:500]}")
+        await message.answer(f"Проблема с LaTeX. Отправляю текст:")
+        await send_text_solution_to_user(message, json.dumps({"solutions": [solution]}))
+    except Exception as e:
+        logging.exception(f"Unexpected rendering error: {e}")
+        await send_text_solution_to_user(message, json.dumps({"solutions": [solution]}))
 
 
 def prepare_plain_text_document(solution):
@@ -593,10 +657,24 @@ async def process_photo_message(message: Message):
 
         photo_to_answer = await bot.download(message.photo[-1])
         await message.answer(LOADING_MESSAGE)
-        answer = await get_solution(
-            path=path, photo_io=photo_to_answer, user_id=str(user_id)
-        )
-        await send_solution_to_user(message, answer)
+        # Render and send each solution while the next ones are generated
+        idx = 0
+        try:
+            async for priority, solution in get_solution_stream(
+                path=path, photo_io=photo_to_answer, user_id=str(user_id)
+            ):
+                idx += 1
+                await send_single_solution_to_user(message, idx, solution, priority)
+        except Exception as e:
+            if idx:
+                raise
+            # Nothing shown yet: retry once on the non-streaming endpoint
+            logging.warning(f"Solution stream failed, falling back: {e}")
+            photo_to_answer.seek(0)
+            answer = await get_solution(
+                path=path, photo_io=photo_to_answer, user_id=str(user_id)
+            )
+            await send_solution_to_user(message, answer)
     except Exception as e:
         logging.exception(f"Error processing photo message: {e}")
         await message.answer("Произошла ошибка при обработке фото. Попробуйте позже.")
@@ -736,34 +814,50 @@ async def process_text_message(message: Message):
         await message.answer("Произошла ошибка при обработке текста. Попробуйте позже.")
 
 
-async def notify_all_users(message: Message):
+async def iter_all_user_ids(session):
+    """Yield user ids one by one as the app streams them."""
+    async with session.post(
+            f"http://{NETWORK}:8000{STREAM_ALL_USER_IDS}",
+            json={"user_id": ADMIN_TG_ID},
+            timeout=ClientTimeout(total=None),
+    ) as response:
+        if response.status != 200:
+            raise Exception(
+                f"Failed to get users. Status code: {response.status}"
+            )
+        async for line in response.content:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if "error" in row:
+                raise Exception(f"User stream failed: {row['error']}")
+            yield row["user_id"]
+
+
+async def broadcast(text_message: str) -> int:
+    """Send `text_message` to every user, returns how many got it."""
+    sent = 0
     async with aiohttp.ClientSession() as session:
-        async with session.post(
-                f"http://{NETWORK}:8000{GET_ALL_USER_IDS}",
-                json={"user_id": str(message.from_user.id)},
-        ) as response:
-            answer = await response.json()
-            print(answer)
-            text_message = message.text.split(" = ")[1]
-            print(text_message)
-            if response.status != 200:
-                raise Exception(
-                    f"Failed to get balance. Status code: {response.status}"
+        async for user_id in iter_all_user_ids(session):
+            try:
+                await bot.send_message(user_id, text_message)
+                sent += 1
+            except exceptions.TelegramForbiddenError:
+                print(f"User {user_id} has blocked the bot. Skipping.")
+            except exceptions.TelegramAPIError as e:
+                print(
+                    f"Failed to send message to {user_id} due to Telegram API error: {e}"
                 )
-            await bot.send_message(ADMIN_TG_ID, text_message)
-            for user in answer["message"]:
-                try:
-                    await bot.send_message(user["user_id"], text_message)
-                    await bot.send_message(
-                        ADMIN_TG_ID, f"Message sent to user {user['user_id']}"
-                    )
-                except exceptions.TelegramForbiddenError:
-                    print(f"User {user['user_id']} has blocked the bot. Skipping.")
-                except exceptions.TelegramAPIError as e:
-                    print(
-                        f"Failed to send message to {user['user_id']} due to Telegram API error: {e}"
-                    )
-                await asyncio.sleep(0.2)
+            await asyncio.sleep(0.2)
+    return sent
+
+
+async def notify_all_users(message: Message):
+    text_message = message.text.split(" = ")[1]
+    print(text_message)
+    await bot.send_message(ADMIN_TG_ID, text_message)
+    sent = await broadcast(text_message)
+    await bot.send_message(ADMIN_TG_ID, f"Message sent to {sent} users")
 
 
 async def notify_user(message: Message):
@@ -781,11 +875,11 @@ async def notify_user(message: Message):
         await bot.send_message(user_id, text_message)
 
 
-async def add_subscription_limits_for_all_users(limit):
+async def add_subscription_limits_for_all_users(limit, resume_after=None):
     async with aiohttp.ClientSession() as session:
         async with session.post(
                 f"http://{NETWORK}:8000{ADD_SUBSCRIPTION_LIMITS_FOR_ALL_USERS}",
-                json={"user_id": ADMIN_TG_ID, "limit": limit},
+                json={"user_id": ADMIN_TG_ID, "limit": limit, "resume_after": resume_after},
         ) as response:
             answer = await response.json()
             print(answer)
@@ -793,27 +887,32 @@ async def add_subscription_limits_for_all_users(limit):
                 raise Exception(
                     f"Failed to get balance. Status code: {response.status}"
                 )
-            for user in answer["message"]:
-                try:
-                    await bot.send_message(
-                        user["user_id"],
-                        "Бесплатно добавлены донатные решения! Проверь свой баланс /balance",
-                    )
-                    await bot.send_message(
-                        ADMIN_TG_ID,
-                        f"Лимит решений для пользователя {user['user_id']} увеличен!",
-                    )
-                except exceptions.TelegramForbiddenError:
-                    print(f"User {user['user_id']} has blocked the bot. Skipping.")
-                except exceptions.TelegramAPIError as e:
-                    print(
-                        f"Failed to send message to {user['user_id']} due to Telegram API error: {e}"
-                    )
-                await asyncio.sleep(0.2)
+        summary = answer["message"]
+        if answer.get("status_code") != 200:
+            resume = f"/add_subscription_limits_for_all_users {limit}"
+            if summary["last_user_id"] is not None:
+                resume += f" {summary['last_user_id']}"
+            await bot.send_message(
+                ADMIN_TG_ID,
+                f"Начисление прервано: обновлено {summary['updated']} пользователей. "
+                f"Продолжить: {resume}",
+            )
+            return
+        await bot.send_message(
+            ADMIN_TG_ID,
+            f"Лимит решений увеличен для {summary['updated']} пользователей "
+            f"({summary['batches']} батчей)",
+        )
+    await broadcast(
+        "Бесплатно добавлены донатные решения! Проверь свой баланс /balance"
+    )
 
 
 async def main() -> None:
     locale = get_fluent_localization()
+    # Format build is a no-op when the image already has it
+    await asyncio.to_thread(latex_renderer.warm)
+    stats_task = asyncio.create_task(log_render_stats())
 
     # Use MemoryStorage for state management
     dp = Dispatcher(storage=MemoryStorage())
@@ -823,12 +922,15 @@ async def main() -> None:
     dp.include_router(routers.router)
 
     # Start polling with parallel processing enabled
-    await dp.start_polling(
-        bot,
-        polling_timeout=30,
-        handle_signals=True,
-        allowed_updates=dp.resolve_used_update_types()
-    )
+    try:
+        await dp.start_polling(
+            bot,
+            polling_timeout=30,
+            handle_signals=True,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+    finally:
+        stats_task.cancel()
 
 
 if __name__ == "__main__":
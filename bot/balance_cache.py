@@ -0,0 +1,156 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from bot.constants import (
+    DEFAULT_DAILY_LIMIT,
+    BALANCE_CACHE_TTL_SEC,
+    BALANCE_CACHE_MAX_ENTRIES,
+)
+
+
+@dataclass
+class _Balance:
+    daily_limit: int
+    subscription_limit: int
+    last_processing_date: Optional[str]
+    stored_at: float
+    # Read since it was stored; idle entries aren't reconciled and expire
+    served: bool = False
+
+
+class BalanceCache:
+    """
+    Short-TTL view of users_status rows, updated on every write SupabaseService
+    makes and periodically reconciled against the database.
+    Raw rows are stored and the lazy daily reset is applied on read, so an
+    entry cached yesterday still reports the fresh daily limit today.
+    Only entries that are being read get reconciled; the rest expire.
+    """
+
+    def __init__(
+        self,
+        ttl_sec: float = BALANCE_CACHE_TTL_SEC,
+        max_entries: int = BALANCE_CACHE_MAX_ENTRIES,
+    ):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, _Balance]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.reconciled = 0
+        self.drift_corrections = 0
+        self.expired = 0
+        self._served_age_total = 0.0
+        self._served_age_max = 0.0
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Return the effective balance as get_current_balance reports it."""
+        user_id = str(user_id)
+        entry = self._entries.get(user_id)
+        if entry is None or time.monotonic() - entry.stored_at > self.ttl_sec:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        entry.served = True
+        age = time.monotonic() - entry.stored_at
+        self.hits += 1
+        self._served_age_total += age
+        self._served_age_max = max(self._served_age_max, age)
+        daily_limit = entry.daily_limit
+        if entry.last_processing_date != date.today().isoformat():
+            daily_limit = DEFAULT_DAILY_LIMIT
+        return {
+            "daily_limit": daily_limit,
+            "subscription_limit": entry.subscription_limit,
+        }
+
+    def put(self, user_id: str, row: Dict[str, Any]) -> None:
+        """
+        Args:
+            user_id (str): user id
+            row (Dict): raw users_status row with daily_limit,
+                subscription_limit and last_processing_date
+        """
+        self.writes += 1
+        self._store(str(user_id), row)
+
+    def _store(self, user_id: str, row: Dict[str, Any]) -> None:
+        self._entries[user_id] = _Balance(
+            daily_limit=row["daily_limit"],
+            subscription_limit=row["subscription_limit"],
+            last_processing_date=row.get("last_processing_date"),
+            stored_at=time.monotonic(),
+        )
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(user_id), None)
+
+    def stale_user_ids(self, older_than_sec: float, limit: int) -> List[str]:
+        """Live entries read since they were stored and older than
+        `older_than_sec`; drops expired entries on the way."""
+        now = time.monotonic()
+        expired = []
+        stale = []
+        for user_id, entry in self._entries.items():
+            age = now - entry.stored_at
+            if age > self.ttl_sec:
+                expired.append(user_id)
+            elif age >= older_than_sec and entry.served and len(stale) < limit:
+                stale.append(user_id)
+        for user_id in expired:
+            del self._entries[user_id]
+            self.expired += 1
+        return stale
+
+    def reconcile(self, rows: List[Dict[str, Any]], fetched_at: float) -> None:
+        """
+        Refresh entries from database rows, counting those that drifted.
+        Args:
+            rows (List[Dict]): users_status rows
+            fetched_at (float): time.monotonic() when the read started;
+                entries written after it are newer than the rows
+        """
+        for row in rows:
+            user_id = str(row["user_id"])
+            entry = self._entries.get(user_id)
+            if entry is None or entry.stored_at > fetched_at:
+                continue
+            if (
+                entry.daily_limit,
+                entry.subscription_limit,
+                entry.last_processing_date,
+            ) != (
+                row["daily_limit"],
+                row["subscription_limit"],
+                row.get("last_processing_date"),
+            ):
+                self.drift_corrections += 1
+            self._store(user_id, row)
+            self.reconciled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "reconciled": self.reconciled,
+            "drift_corrections": self.drift_corrections,
+            "expired": self.expired,
+            "avg_served_age_sec": (
+                round(self._served_age_total / self.hits, 3) if self.hits else 0.0
+            ),
+            "max_served_age_sec": round(self._served_age_max, 3),
+        }
@@ -1,8 +1,15 @@
 GPT_MODEL = "gpt-5-mini-2025-08-07"
 GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_MAX_CONCURRENCY = 16
+
+# OpenAI account limits for GPT_MODEL, enforced client-side
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 500_000
+OPENAI_EXPECTED_OUTPUT_TOKENS = 2000
 
 DOWNLOAD_ENDPOINT = "/tasker/api/download_image"
 SOLVE_ENDPOINT = "/tasker/api/solve_task"
+SOLVE_STREAM_ENDPOINT = "/tasker/api/solve_task_stream"
 ADD_NEW_USER_ENDPOINT = "/tasker/api/add_new_user"
 GET_EXIST_SOLUTION_ENDPOINT = "/tasker/api/get_exist_solution"
 DONATE_ENDPOINT = "/tasker/api/donate"
@@ -10,9 +17,12 @@ TEXT_SOLVE_ENDPOINT = "/tasker/api/text_solve_task"
 LATEX_TO_TEXT_SOLVE_ENDPOINT = "/tasker/api/latex_to_text_solve_task"
 GET_CURRENT_BALANCE_ENDPOINT = "/tasker/api/get_current_balance"
 GET_ALL_USER_IDS = "/tasker/api/get_all_user_ids"
+STREAM_ALL_USER_IDS = "/tasker/api/stream_all_user_ids"
 ADD_SUBSCRIPTION_LIMITS_FOR_ALL_USERS = (
     "/tasker/api/add_subscription_limits_for_all_users"
 )
+STATS_ENDPOINT = "/tasker/api/stats"
+PROVIDERS_STATUS_ENDPOINT = "/tasker/api/providers_status"
 
 NETWORK = "app"
 
@@ -20,6 +30,98 @@ SUB_FOLDER = "/task_images/"
 
 DEFAULT_DAILY_LIMIT = 3
 
+# Worker threads for the synchronous supabase-py client
+SUPABASE_IO_WORKERS = 16
+
+# Background Supabase auth refresh, this long before the token expires
+SESSION_REFRESH_MARGIN_SEC = 300
+SESSION_REFRESH_RETRY_SEC = 10
+
+# Bot process: how often LatexRenderer.stats() is written to the log
+RENDER_STATS_LOG_INTERVAL_SEC = 600
+
+# Local SQLite backend (DB_BACKEND=sqlite)
+SQLITE_IO_WORKERS = 8
+SQLITE_BUSY_TIMEOUT_SEC = 30.0
+
+# In-process users_status cache
+BALANCE_CACHE_TTL_SEC = 30.0
+BALANCE_CACHE_MAX_ENTRIES = 50000
+BALANCE_RECONCILE_INTERVAL_SEC = 10.0
+BALANCE_RECONCILE_BATCH_SIZE = 200
+
+# Rows per keyset page when walking the users table
+USER_IDS_PAGE_SIZE = 1000
+
+# Rows per grant_subscription_limit_batch call
+BULK_GRANT_BATCH_SIZE = 5000
+
+# Batched solution inserts and last_processing_image_path updates
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_FLUSH_INTERVAL_SEC = 0.5
+WRITE_BEHIND_MAX_PENDING = 5000
+WRITE_BEHIND_MAX_RETRIES = 5
+WRITE_BEHIND_RETRY_BACKOFF_SEC = 0.5
+WRITE_BEHIND_SHUTDOWN_TIMEOUT_SEC = 30.0
+
+# Background photo uploads to the tasks bucket
+UPLOAD_MAX_CONCURRENCY = 8
+UPLOAD_MAX_PENDING = 200
+UPLOAD_MAX_RETRIES = 3
+UPLOAD_RETRY_BACKOFF_SEC = 1.0
+UPLOAD_DEDUP_MAX_ENTRIES = 10000
+UPLOAD_SHUTDOWN_TIMEOUT_SEC = 30.0
+
+# Photo preprocessing before the vision models.
+# OpenAI high-detail vision fits images into 2048x2048 and then scales the
+# short side to 768, so larger photos only cost upload time.
+IMAGE_MAX_LONG_SIDE = 2048
+IMAGE_MAX_SHORT_SIDE = 768
+IMAGE_TARGET_BYTES = 300 * 1024
+IMAGE_JPEG_QUALITIES = (85, 75, 65, 55, 45)
+IMAGE_GRAYSCALE_MAX_SATURATION = 24  # mean HSV saturation, 0-255
+
+# Priority scheduling of LLM calls: donors (subscription_limit > 0) get
+# PRIORITY_WEIGHTS["paid"] slots for every PRIORITY_WEIGHTS["free"] one
+PRIORITY_PAID = "paid"
+PRIORITY_FREE = "free"
+PRIORITY_WEIGHTS = {PRIORITY_PAID: 3, PRIORITY_FREE: 1}
+LLM_MAX_CONCURRENCY = 32
+
+# Perceptual-hash cache of image solutions
+IMAGE_CACHE_MAX_HAMMING_DISTANCE = 64  # out of 256 bits, shortlists candidates
+IMAGE_CACHE_MIN_CORRELATION = 0.85  # of the 32x32 thumbnails, verifies them
+IMAGE_CACHE_TTL_SEC = 7 * 24 * 60 * 60
+IMAGE_CACHE_MAX_ENTRIES = 5000
+
+# Per-user LRU of get_exist_solution results
+USER_SOLUTION_CACHE_MAX_USERS = 10000
+USER_SOLUTION_CACHE_PER_USER = 20
+
+# Rendered solution PNGs and their Telegram file_ids, in the bot process
+SENT_SOLUTION_CACHE_MAX_ENTRIES = 2000
+
+# Normalized text + MinHash/LSH cache of text solutions
+TEXT_CACHE_MIN_SIMILARITY = 0.9  # estimated Jaccard of character shingles
+TEXT_CACHE_TTL_SEC = 7 * 24 * 60 * 60
+TEXT_CACHE_MAX_ENTRIES = 20000
+
+# Hedged requests across LLM providers
+LLM_HEDGING_ENABLED = True
+HEDGE_DELAY_SEC = None  # None = adaptive, use HEDGE_PERCENTILE of primary latency
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY_SEC = 30.0
+HEDGE_LATENCY_WINDOW = 200
+
+# Per-provider circuit breakers
+BREAKER_EWMA_ALPHA = 0.2
+BREAKER_ERROR_RATE_THRESHOLD = 0.5
+BREAKER_LATENCY_THRESHOLD_SEC = 90.0
+BREAKER_MIN_CALLS = 5
+BREAKER_OPEN_SEC = 30.0
+BREAKER_HALF_OPEN_PROBES = 1
+
 TASK_HELPER_PROMPT_TEMPLATE_SYSTEM = (
     "You are given an image of a math problem. Help the user solve it."
 )
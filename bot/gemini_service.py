@@ -1,5 +1,4 @@
 import asyncio
-import io
 import json
 import time
 from json import JSONDecodeError
@@ -10,15 +9,19 @@ import google.generativeai as genai
 from bot.constants import (
     TASK_HELPER_PROMPT_TEMPLATE_USER,
     GEMINI_MODEL,
+    GEMINI_MAX_CONCURRENCY,
     TEXT_TASK_HELPER_PROMPT_TEMPLATE_USER,
     LATEX_TO_TEXT_TASK_HELPER_PROMPT_TEMPLATE_USER,
 )
-from PIL import Image
+from bot.image_preprocessing import detect_image_mime_type
 
 
 class GeminiSolver:
-    def __init__(self, google_api_key: str):
+    def __init__(
+        self, google_api_key: str, max_concurrency: int = GEMINI_MAX_CONCURRENCY
+    ):
         genai.configure(api_key=google_api_key)
+        self._sem = asyncio.Semaphore(max_concurrency)
         self.model = genai.GenerativeModel(model_name=GEMINI_MODEL)
         self._prompt = TASK_HELPER_PROMPT_TEMPLATE_USER
         self._text_model = genai.GenerativeModel(
@@ -31,14 +34,26 @@ class GeminiSolver:
             system_instruction=LATEX_TO_TEXT_TASK_HELPER_PROMPT_TEMPLATE_USER,
         )
 
-    async def solve(self, photo_io):
+    async def _generate(self, model, contents):
+        # generate_content_async goes through the SDK's grpc.aio transport,
+        # so the event loop keeps serving other requests meanwhile
+        async with self._sem:
+            return await model.generate_content_async(contents)
+
+    async def solve(self, photo_io, mime_type: str | None = None):
         start_time = time.time()
-        # Read the file content asynchronously
-        content = await photo_io.read()
-        # Wrap it in a BytesIO object so PIL can open it
-        image = Image.open(io.BytesIO(content))
+        if isinstance(photo_io, bytes):
+            content = photo_io
+        else:
+            # Read the file content asynchronously
+            content = await photo_io.read()
+        # Send raw bytes as an inline blob instead of decoding through PIL
+        image = {
+            "mime_type": mime_type or detect_image_mime_type(content),
+            "data": content,
+        }
 
-        result = self.model.generate_content([image, self._prompt])
+        result = await self._generate(self.model, [image, self._prompt])
         end_time = time.time()
         print(f"Time elapsed: {end_time - start_time}")
         print("GEMINI result:", result.text)
@@ -56,7 +71,7 @@ class GeminiSolver:
             str: generated text
         """
 
-        result = self._text_model.generate_content(user_input)
+        result = await self._generate(self._text_model, user_input)
         print("GEMINI TEXT result:", result.text)
         parsed_result = self.parse_output_json(result.text)
         return parsed_result
@@ -69,7 +84,7 @@ class GeminiSolver:
         Returns:
             str: generated solution
         """
-        result = self._latex_to_text_model.generate_content(user_input)
+        result = await self._generate(self._latex_to_text_model, user_input)
         parsed_result = self.parse_output_json(result.text)
         return parsed_result
 
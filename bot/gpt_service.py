@@ -1,19 +1,81 @@
 import asyncio
 import base64
+import io
 import json
 import time
 from json import JSONDecodeError
-from typing import Dict
+from typing import Dict, List, AsyncIterator
 
 import httpx
 from openai import AsyncOpenAI
+from PIL import Image
 
 from bot.constants import GPT_MODEL, TASK_HELPER_PROMPT_TEMPLATE_USER, TEXT_TASK_HELPER_PROMPT_TEMPLATE_USER, \
-    OPENAI_OUTPUT_FORMAT, LATEX_TASK_HELPER_PROMPT_TEMPLATE_USER
+    OPENAI_OUTPUT_FORMAT, LATEX_TASK_HELPER_PROMPT_TEMPLATE_USER, OPENAI_EXPECTED_OUTPUT_TOKENS
+from bot.image_preprocessing import estimate_vision_tokens
+from bot.rate_limiter import LLMRateLimiter
+
+# Rough chars-per-token for mixed Russian/LaTeX prompts
+_CHARS_PER_TOKEN = 3
+_USER_INSTRUCTION = "You are a helpful university professor. Help me with my homework!"
+
+
+def _usage_tokens(response) -> int:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", 0) or 0
+
+
+class SolutionStreamParser:
+    """
+    Incremental parser for `{"solutions": [{...}, {...}]}` output.
+    Feed it text deltas; it returns every solution object as soon as its
+    closing brace arrives.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._start = None
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self._text += chunk
+        completed = []
+        while self._pos < len(self._text):
+            char = self._text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                # Solution objects live at depth 2: {"solutions": [ {...} ]}
+                if char == "{" and self._depth == 2:
+                    self._start = self._pos
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._depth == 2 and self._start is not None:
+                    completed.append(json.loads(self._text[self._start : self._pos + 1]))
+                    self._text = self._text[self._pos + 1 :]
+                    self._pos = -1
+                    self._start = None
+            self._pos += 1
+        if self._start is None:
+            # Nothing to keep between solution objects
+            self._text = ""
+            self._pos = 0
+        return completed
 
 
 class TaskSolverGPT:
-    def __init__(self, openai_api_key: str):
+    def __init__(self, openai_api_key: str, rate_limiter: LLMRateLimiter | None = None):
         http_client = httpx.AsyncClient(
             limits=httpx.Limits(
                 max_connections=100,  # Total connection pool size
@@ -26,9 +88,31 @@ class TaskSolverGPT:
             http_client=http_client,
             max_retries=2
         )
+        self.rate_limiter = rate_limiter or LLMRateLimiter()
 
-    async def encode_image(self, photo_io):
-        """Encode image to base64, handling both sync and async file objects."""
+    def _estimate_tokens(self, *texts: str, photo_bytes: bytes | None = None) -> int:
+        tokens = sum(len(text) for text in texts) // _CHARS_PER_TOKEN
+        if photo_bytes:
+            try:
+                # Only parses the header, no pixel decoding
+                with Image.open(io.BytesIO(photo_bytes)) as image:
+                    tokens += estimate_vision_tokens(*image.size)
+            except Exception:
+                tokens += estimate_vision_tokens(2048, 768)
+        return tokens + OPENAI_EXPECTED_OUTPUT_TOKENS
+
+    async def _create(self, estimated_tokens: int, **kwargs):
+        reservation = await self.rate_limiter.acquire(estimated_tokens)
+        try:
+            response = await self.client.responses.create(**kwargs)
+        except Exception:
+            # Rejected requests don't count against TPM
+            self.rate_limiter.reconcile(reservation, 0)
+            raise
+        self.rate_limiter.reconcile(reservation, _usage_tokens(response))
+        return response
+
+    async def _read_image(self, photo_io) -> bytes:
         if isinstance(photo_io, bytes):
             photo_bytes = photo_io
         elif hasattr(photo_io, 'read'):
@@ -39,19 +123,29 @@ class TaskSolverGPT:
                 photo_bytes = photo_io.read()
         else:
             raise ValueError(f"Unsupported photo_io type: {type(photo_io)}")
+        return photo_bytes
 
+    async def encode_image(self, photo_io):
+        """Encode image to base64, handling both sync and async file objects."""
+        photo_bytes = await self._read_image(photo_io)
         return base64.b64encode(photo_bytes).decode("utf-8")
 
     async def _encode_image(self, image_path):
         with open(image_path, "rb") as image_file:
             return base64.b64encode(image_file.read()).decode("utf-8")
 
-    async def solve(self, photo_io):
+    async def solve(self, photo_io, mime_type: str = "image/jpeg"):
         start_time = time.time()
         print(type(photo_io))
-        image_base64 = await self.encode_image(photo_io)
+        photo_bytes = await self._read_image(photo_io)
+        image_base64 = base64.b64encode(photo_bytes).decode("utf-8")
         print("Image started")
-        response = await self.client.responses.create(
+        response = await self._create(
+            self._estimate_tokens(
+                LATEX_TASK_HELPER_PROMPT_TEMPLATE_USER,
+                _USER_INSTRUCTION,
+                photo_bytes=photo_bytes,
+            ),
             model=GPT_MODEL,
             input=[
                 {
@@ -61,10 +155,10 @@ class TaskSolverGPT:
                 {
                     "role": "user",
                     "content": [
-                        {"type": "input_text", "text": "You are a helpful university professor. Help me with my homework!"},
+                        {"type": "input_text", "text": _USER_INSTRUCTION},
                         {
                             "type": "input_image",
-                            "image_url": f"data:image/jpeg;base64,{image_base64}",
+                            "image_url": f"data:{mime_type};base64,{image_base64}",
                         },
                     ],
                 }
@@ -84,6 +178,86 @@ class TaskSolverGPT:
         result = self.parse_output_json(output_text)
         return result
 
+    async def solve_stream(
+        self, photo_io, mime_type: str = "image/jpeg"
+    ) -> AsyncIterator[Dict]:
+        """
+        Stream solutions for a photo, yielding each one as soon as the model
+        has finished generating it.
+        Args:
+            photo_io: image bytes or file object
+            mime_type (str): image MIME type
+        Returns:
+            AsyncIterator[Dict]: solution objects in output order
+        """
+        start_time = time.time()
+        photo_bytes = await self._read_image(photo_io)
+        image_base64 = base64.b64encode(photo_bytes).decode("utf-8")
+        reservation = await self.rate_limiter.acquire(
+            self._estimate_tokens(
+                LATEX_TASK_HELPER_PROMPT_TEMPLATE_USER,
+                _USER_INSTRUCTION,
+                photo_bytes=photo_bytes,
+            )
+        )
+        used_tokens = None
+        streamed = False
+        try:
+            async for item in self._stream_solutions(image_base64, mime_type, start_time):
+                if isinstance(item, int):
+                    used_tokens = item
+                else:
+                    streamed = True
+                    yield item
+        finally:
+            if used_tokens is None:
+                # Aborted: keep the estimate if generation had started
+                used_tokens = reservation.estimated_tokens if streamed else 0
+            self.rate_limiter.reconcile(reservation, used_tokens)
+
+    async def _stream_solutions(self, image_base64: str, mime_type: str, start_time: float):
+        """Yield solution dicts, then the reported total token usage as an int."""
+        stream = await self.client.responses.create(
+            model=GPT_MODEL,
+            input=[
+                {
+                    "role": "system",
+                    "content": LATEX_TASK_HELPER_PROMPT_TEMPLATE_USER,
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "input_text", "text": _USER_INSTRUCTION},
+                        {
+                            "type": "input_image",
+                            "image_url": f"data:{mime_type};base64,{image_base64}",
+                        },
+                    ],
+                }
+            ],
+            reasoning={
+                "effort": "minimal"
+            },
+            text={"format": OPENAI_OUTPUT_FORMAT},
+            stream=True,
+        )
+        parser = SolutionStreamParser()
+        count = 0
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                for solution in parser.feed(event.delta):
+                    count += 1
+                    print(f"GPT streamed solution {count} after {time.time() - start_time:.1f}s")
+                    yield solution
+            elif event.type == "response.completed":
+                # Reported usage, for rate limiter reconciliation
+                yield _usage_tokens(event.response)
+            elif event.type in ("response.failed", "response.incomplete", "error"):
+                raise Exception(f"Streaming failed: {event.type}")
+        if count == 0:
+            raise Exception("Failed to get solutions")
+        print(f"Time elapsed: {time.time() - start_time}")
+
     def parse_output_json(
         self,
         response: str,
@@ -113,7 +287,10 @@ class TaskSolverGPT:
         Returns:
             str: generated solution
         """
-        response = await self.client.responses.create(
+        response = await self._create(
+            self._estimate_tokens(
+                TEXT_TASK_HELPER_PROMPT_TEMPLATE_USER, _USER_INSTRUCTION, user_input
+            ),
             model=GPT_MODEL,
             input=[
                 {"role": "system",
@@ -122,7 +299,7 @@ class TaskSolverGPT:
                 {
                     "role": "user",
                     "content": [
-                        {"type": "input_text", "text": "You are a helpful university professor. Help me with my homework!"},
+                        {"type": "input_text", "text": _USER_INSTRUCTION},
                         {
                             "type": "input_text",
                             "text": user_input,
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from bot.constants import (
+    LLM_HEDGING_ENABLED,
+    HEDGE_DELAY_SEC,
+    HEDGE_PERCENTILE,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_DEFAULT_DELAY_SEC,
+    HEDGE_LATENCY_WINDOW,
+)
+
+
+class LatencyTracker:
+    """Sliding window of call latencies with percentile estimates."""
+
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+
+    def add(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[idx]
+
+
+class ProviderStats:
+    def __init__(self):
+        self.latency = LatencyTracker()
+        self.calls = 0
+        self.wins = 0
+        self.failures = 0
+        self.cancelled = 0
+        # Cancelled calls whose elapsed time was added as a latency sample
+        self.censored = 0
+        self.hedges_started = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "wins": self.wins,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "censored": self.censored,
+            "hedges_started": self.hedges_started,
+            "p50_latency_sec": self.latency.percentile(0.5),
+            "p90_latency_sec": self.latency.percentile(0.9),
+        }
+
+
+class Hedger:
+    """
+    Runs a call against the primary provider and, if it has not produced a
+    valid result within the hedge delay, races it against the secondary.
+    The first valid result wins and the other call is cancelled.
+    With hedging disabled the secondary only starts after the primary fails.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = LLM_HEDGING_ENABLED,
+        hedge_delay: Optional[float] = HEDGE_DELAY_SEC,
+        percentile: float = HEDGE_PERCENTILE,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        default_delay: float = HEDGE_DEFAULT_DELAY_SEC,
+    ):
+        self.enabled = enabled
+        self.hedge_delay = hedge_delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self._stats: Dict[str, ProviderStats] = {}
+
+    def provider_stats(self, provider: str) -> ProviderStats:
+        return self._stats.setdefault(provider, ProviderStats())
+
+    def delay_for(self, provider: str) -> Optional[float]:
+        if not self.enabled:
+            return None
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        latency = self.provider_stats(provider).latency
+        if len(latency) < self.min_samples:
+            return self.default_delay
+        return latency.percentile(self.percentile)
+
+    async def _call(
+        self,
+        provider: str,
+        call: Callable[[], Awaitable[Any]],
+        validate: Callable[[Any], bool],
+    ) -> Any:
+        stats = self.provider_stats(provider)
+        stats.calls += 1
+        start_time = time.monotonic()
+        try:
+            result = await call()
+            if not validate(result):
+                raise ValueError(f"{provider} returned an invalid result")
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            # Cut off past the hedge point, the call would have taken at
+            # least this long; leaving it out biases the percentile low
+            elapsed = time.monotonic() - start_time
+            delay = self.delay_for(provider)
+            if delay is not None and elapsed >= delay:
+                stats.latency.add(elapsed)
+                stats.censored += 1
+            raise
+        except Exception:
+            stats.failures += 1
+            raise
+        stats.latency.add(time.monotonic() - start_time)
+        return result
+
+    async def run_single(
+        self,
+        provider: str,
+        call: Callable[[], Awaitable[Any]],
+        validate: Callable[[Any], bool] = lambda result: result is not None,
+    ) -> Any:
+        result = await self._call(provider, call, validate)
+        self.provider_stats(provider).wins += 1
+        return result
+
+    async def run(
+        self,
+        primary: str,
+        primary_call: Callable[[], Awaitable[Any]],
+        secondary: str,
+        secondary_call: Callable[[], Awaitable[Any]],
+        validate: Callable[[Any], bool] = lambda result: result is not None,
+    ) -> Any:
+        """
+        Args:
+            primary (str): primary provider name
+            primary_call: zero-argument coroutine factory for the primary
+            secondary (str): secondary provider name
+            secondary_call: zero-argument coroutine factory for the secondary
+            validate: predicate a result must satisfy to win the race
+        Returns:
+            Any: the first valid result
+        """
+        pending = {
+            asyncio.create_task(self._call(primary, primary_call, validate)): primary
+        }
+        secondary_started = False
+        last_error: Optional[BaseException] = None
+        try:
+            done, _ = await asyncio.wait(
+                set(pending), timeout=self.delay_for(primary)
+            )
+            while True:
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        self.provider_stats(provider).wins += 1
+                        return task.result()
+                    last_error = task.exception()
+                    print(f"Error with {provider}: {last_error}")
+                if not secondary_started:
+                    if pending:
+                        print(f"{primary} is slow, hedging with {secondary}")
+                        self.provider_stats(secondary).hedges_started += 1
+                    secondary_started = True
+                    task = asyncio.create_task(
+                        self._call(secondary, secondary_call, validate)
+                    )
+                    pending[task] = secondary
+                if not pending:
+                    raise last_error
+                done, _ = await asyncio.wait(
+                    set(pending), return_when=asyncio.FIRST_COMPLETED
+                )
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "providers": {
+                name: {**stats.as_dict(), "hedge_delay_sec": self.delay_for(name)}
+                for name, stats in self._stats.items()
+            },
+        }
@@ -0,0 +1,158 @@
+import io
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, Any
+
+from PIL import Image, ImageOps, ImageStat
+
+from bot.constants import (
+    IMAGE_MAX_LONG_SIDE,
+    IMAGE_MAX_SHORT_SIDE,
+    IMAGE_TARGET_BYTES,
+    IMAGE_JPEG_QUALITIES,
+    IMAGE_GRAYSCALE_MAX_SATURATION,
+)
+
+_MIN_SHORT_SIDE = 384
+_EXIF_ORIENTATION = 0x0112
+
+
+def detect_image_mime_type(content: bytes) -> str:
+    """Guess the image MIME type from its magic bytes, defaulting to JPEG."""
+    if content.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return "image/webp"
+    if content[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    return "image/jpeg"
+
+
+def estimate_vision_tokens(width: int, height: int) -> int:
+    """
+    Estimate OpenAI high-detail vision tokens for an image:
+    fit into 2048x2048, scale the short side to 768, count 512px tiles.
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+@dataclass
+class PreprocessedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    grayscale: bool
+
+
+class ImagePreprocessor:
+    """
+    Prepares Telegram photos for the vision models: EXIF rotation,
+    downscaling to what the model actually looks at, grayscale for
+    colourless pages and JPEG recompression to a byte budget.
+    """
+
+    def __init__(
+        self,
+        max_long_side: int = IMAGE_MAX_LONG_SIDE,
+        max_short_side: int = IMAGE_MAX_SHORT_SIDE,
+        target_bytes: int = IMAGE_TARGET_BYTES,
+        max_saturation: int = IMAGE_GRAYSCALE_MAX_SATURATION,
+    ):
+        self.max_long_side = max_long_side
+        self.max_short_side = max_short_side
+        self.target_bytes = target_bytes
+        self.max_saturation = max_saturation
+        self.processed = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.total_latency = 0.0
+
+    def process(self, content: bytes) -> PreprocessedImage:
+        """
+        Blocking; run it in a worker thread.
+        Args:
+            content (bytes): raw photo bytes
+        Returns:
+            PreprocessedImage: recompressed photo, or the original bytes if
+                it can't be decoded
+        """
+        start_time = time.monotonic()
+        try:
+            with Image.open(io.BytesIO(content)) as image:
+                original_size = image.size
+                rotated = image.getexif().get(_EXIF_ORIENTATION, 1) != 1
+                image = ImageOps.exif_transpose(image)
+                image = self._resize(image)
+                grayscale = self._is_colourless(image)
+                image = image.convert("L" if grayscale else "RGB")
+                data = self._compress(image)
+        except Exception as e:
+            print(f"Image preprocessing failed: {e}")
+            self.failed += 1
+            return PreprocessedImage(content, detect_image_mime_type(content), 0, 0, False)
+
+        mime_type = "image/jpeg"
+        if len(data) >= len(content) and image.size == original_size and not rotated:
+            # Already small and upright; keep the original bytes
+            data = content
+            mime_type = detect_image_mime_type(content)
+        self.processed += 1
+        self.bytes_in += len(content)
+        self.bytes_out += len(data)
+        self.tokens_in += estimate_vision_tokens(*original_size)
+        self.tokens_out += estimate_vision_tokens(*image.size)
+        self.total_latency += time.monotonic() - start_time
+        return PreprocessedImage(data, mime_type, *image.size, grayscale)
+
+    def _resize(self, image: Image.Image, factor: float = 1.0) -> Image.Image:
+        width, height = image.size
+        scale = min(
+            1.0,
+            self.max_long_side / max(width, height),
+            self.max_short_side / min(width, height),
+        ) * factor
+        if scale >= 1.0:
+            return image
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return image.resize(size, Image.Resampling.LANCZOS)
+
+    def _is_colourless(self, image: Image.Image) -> bool:
+        if image.mode in ("L", "LA", "1"):
+            return True
+        saturation = image.convert("RGB").convert("HSV").getchannel("S")
+        return ImageStat.Stat(saturation).mean[0] <= self.max_saturation
+
+    def _compress(self, image: Image.Image) -> bytes:
+        while True:
+            for quality in IMAGE_JPEG_QUALITIES:
+                buffer = io.BytesIO()
+                image.save(buffer, format="JPEG", quality=quality, optimize=True)
+                if buffer.tell() <= self.target_bytes:
+                    return buffer.getvalue()
+            if min(image.size) * 0.8 < _MIN_SHORT_SIDE:
+                # Legibility beats the byte budget
+                return buffer.getvalue()
+            image = self._resize(image, factor=0.8)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "estimated_tokens_in": self.tokens_in,
+            "estimated_tokens_out": self.tokens_out,
+            "avg_latency_sec": (
+                round(self.total_latency / self.processed, 4) if self.processed else 0.0
+            ),
+        }
@@ -1,18 +1,89 @@
 # python
 # file: bot/app/latex_renderer.py
 import asyncio
+import atexit
+import glob
 import hashlib
+import io
 import os
 import re
+import shutil
 import tempfile
-from functools import lru_cache
-from typing import Dict, Any, Optional
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Any, List, Optional, Tuple
 
 import subprocess
 
+from PIL import Image
+
+from bot.constants import PRIORITY_FREE
+from bot.hedging import LatencyTracker
+from bot.mathtext_renderer import MathtextRenderer
+from bot.render_cache import RenderCache
+from bot.scheduler import PriorityScheduler
+from bot.solution_cache import solution_key
+
+
+def _available_cpus() -> int:
+    """
+    CPUs this process can actually use: its affinity mask, capped by the
+    cgroup CPU quota. os.cpu_count() is the host's count inside a container.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = period = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1, quota -1 means unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            pass
+    try:
+        if quota not in (None, "max", "-1"):
+            cpus = min(cpus, max(1, -(-int(quota) // int(period))))
+    except (ValueError, ZeroDivisionError):
+        pass
+    return max(1, cpus)
+
+
 # Tune these
 LATEX_TIMEOUT_SEC = 15
-MAX_CONCURRENT_COMPILATIONS = 2
+LATEX_FORMAT_TIMEOUT_SEC = 120
+# After a format fails to load, compile without it this long, then rebuild
+LATEX_FORMAT_RETRY_SEC = 600
+# One warm TeX worker per available core, and as many compilations at a time
+TEX_WORKER_POOL_MAX_SIZE = 8
+MAX_CONCURRENT_COMPILATIONS = int(os.environ.get("MAX_CONCURRENT_COMPILATIONS", 0)) or min(
+    _available_cpus(), TEX_WORKER_POOL_MAX_SIZE
+)
+TEX_WORKER_MAX_IDLE_SEC = 600
+TEX_WORKER_MAX_RSS_BYTES = 512 * 1024 * 1024
+# Rendered PNGs: memory budget per process, and a shared directory
+RENDER_CACHE_MEMORY_MAX_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+RENDER_CACHE_DIR = os.environ.get(
+    "RENDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "render-cache")
+)
+# Render each problem/step/answer item as its own cached fragment
+LATEX_FRAGMENT_MODE = os.environ.get("LATEX_FRAGMENT_MODE", "").lower() in ("1", "true", "yes")
+# Render simple solutions in-process with matplotlib mathtext, skipping TeX
+LATEX_MATHTEXT_ENABLED = os.environ.get("LATEX_MATHTEXT_ENABLED", "1").lower() in ("1", "true", "yes")
+# Dumped preamble formats, see LatexRenderer.build_format
+LATEX_FORMAT_DIR = os.environ.get(
+    "LATEX_FORMAT_DIR", os.path.join(tempfile.gettempdir(), "latex-format")
+)
 
 _SANITIZE_PATTERN = re.compile(
     r"""\\(input|include|write|openout|read|catcode|usepackage|def|loop|repeat|csname|newwrite|immediate)""",
@@ -23,11 +94,6 @@ def _sanitize_user_text(text: str) -> str:
     # Remove dangerous control sequences
     return _SANITIZE_PATTERN.sub("", text)
 
-def _hash_solution(solution: Dict[str, Any]) -> str:
-    m = hashlib.sha256()
-    m.update(repr(solution).encode("utf-8"))
-    return m.hexdigest()
-
 def _strip_math_delimiters(s: str) -> str:
     s = s.strip()
     for a, b in (("$$", "$$"), ("$", "$"), ("\\[", "\\]"), ("\\(", "\\)")):
@@ -35,20 +101,28 @@ def _strip_math_delimiters(s: str) -> str:
             return s[len(a): -len(b)].strip()
     return s
 
-_LATEX_HEADER = r"""
+# Everything up to \endofdump is dumped into the format by mylatexformat
+_LATEX_PREAMBLE = r"""
 \documentclass[preview]{standalone}
 \usepackage{amsmath, amssymb}
 \usepackage{fontspec}
 \usepackage{polyglossia}
+\usepackage{enumitem}
+\setlength{\parindent}{0pt}
+"""
+
+_END_OF_DUMP = "\\endofdump\n"
+
+# XeTeX can't dump natively loaded fonts, so these run on every compile
+_LATEX_FONT_SETUP = r"""
 \setdefaultlanguage{russian}
 \setmainfont{DejaVu Serif}
 \setsansfont{DejaVu Sans}
 \setmonofont{DejaVu Sans Mono}
-\usepackage{enumitem}
-\setlength{\parindent}{0pt}
-\begin{document}
 """
 
+_LATEX_HEADER = _LATEX_PREAMBLE + _END_OF_DUMP + _LATEX_FONT_SETUP + "\\begin{document}\n"
+
 
 _LATEX_FOOTER = r"""
 \end{document}
@@ -117,44 +191,698 @@ def build_latex(solution: Dict[str, Any]) -> str:
     lines.append(r"\end{enumerate}")
     return _LATEX_HEADER + "\n".join(lines) + _LATEX_FOOTER
 
+# Cached PNGs are only valid for the template that produced them
+_TEMPLATE_VERSION = hashlib.sha256(
+    (_LATEX_HEADER + _LATEX_FOOTER).encode("utf-8")
+).hexdigest()[:8]
+
+def _render_key(solution: Dict[str, Any]) -> str:
+    return solution_key(solution) + "-" + _TEMPLATE_VERSION
+
+def _tex_env() -> Dict[str, str]:
+    return {
+        **os.environ,
+        "HOME": "/tmp",
+        "TEXMFVAR": "/tmp/texmf-var",
+        "TEXMFCONFIG": "/tmp/texmf-config"
+    }
+
+def _format_name() -> str:
+    # A new preamble or a TeX upgrade gets a new format
+    m = hashlib.sha256(_LATEX_PREAMBLE.encode("utf-8"))
+    xelatex = shutil.which("xelatex")
+    if xelatex:
+        m.update(str(os.stat(os.path.realpath(xelatex)).st_mtime).encode())
+    return "solution-" + m.hexdigest()[:16]
+
 class LatexCompilationError(Exception):
     def __init__(self, message: str, stdout: str = "", stderr: str = ""):
         super().__init__(message)
         self.stdout = stdout
         self.stderr = stderr
 
+# What TeX prints when the format itself is missing, corrupt or stale
+_FORMAT_LOAD_ERROR_RE = re.compile(
+    r"can't find the format file|Fatal format file error|^---! .*\.fmt", re.MULTILINE
+)
+
+def _format_load_failed(error: LatexCompilationError) -> bool:
+    return bool(_FORMAT_LOAD_ERROR_RE.search(error.stdout + error.stderr))
+
+# Fragment mode: one page per fragment, each cropped by standalone
+_FRAGMENT_HEADER = _LATEX_HEADER.replace(_END_OF_DUMP, "", 1).replace(
+    r"\documentclass[preview]{standalone}",
+    r"\documentclass[multi=fragment,border=1pt]{standalone}",
+)
+_FRAGMENT_MARGIN = 12
+_FRAGMENT_ROW_GAP = 6
+_FRAGMENT_SECTION_GAP = 14
+_FRAGMENT_LABEL_GAP = 8
+
+# (cache key, TeX source) of one fragment
+_Fragment = Tuple[str, str]
+
+
+def _fragment(tex: str) -> _Fragment:
+    key = hashlib.sha256((tex + _TEMPLATE_VERSION).encode("utf-8")).hexdigest()
+    return "frag-" + key, tex
+
+
+def _item_fragment(item: Dict[str, Any]) -> _Fragment:
+    if item["type"] == "math":
+        return _fragment("$" + _strip_math_delimiters(item["content"]) + "$")
+    return _fragment(
+        r"\begin{minipage}{\textwidth}"
+        + _process_mixed(_sanitize_user_text(item["content"]))
+        + r"\end{minipage}"
+    )
+
+
+def _fragment_layout(solution: Dict[str, Any]) -> List[Tuple[str, Tuple[_Fragment, ...]]]:
+    """
+    Rows of the composed image, mirroring build_latex: ("heading", (f,)),
+    ("block", (f,)) and ("item", (label, content)).
+    """
+    rows = [
+        ("heading", (_fragment(r"\textbf{Задание:}"),)),
+        ("block", (_item_fragment({"type": "text", "content": solution["problem"]}),)),
+    ]
+    for title, items in (("Решение:", solution["steps"]), ("Ответ:", solution["solution"])):
+        rows.append(("heading", (_fragment(r"\textbf{" + title + "}"),)))
+        for idx, item in enumerate(items, start=1):
+            rows.append(("item", (_fragment(f"{idx}."), _item_fragment(item))))
+    return rows
+
+
+def _compose_fragments(
+    rows: List[Tuple[str, Tuple[_Fragment, ...]]], images: Dict[str, bytes]
+) -> bytes:
+    """Stack fragment images into one PNG the way build_latex lays them out."""
+    decoded = {key: Image.open(io.BytesIO(data)).convert("RGB") for key, data in images.items()}
+    label_width = max(
+        (decoded[fragments[0][0]].width for kind, fragments in rows if kind == "item"),
+        default=0,
+    )
+    indent = label_width + _FRAGMENT_LABEL_GAP
+    placements = []
+    y = _FRAGMENT_MARGIN
+    width = 0
+    for idx, (kind, fragments) in enumerate(rows):
+        if kind == "heading" and idx:
+            y += _FRAGMENT_SECTION_GAP - _FRAGMENT_ROW_GAP
+        if kind == "item":
+            label, content = (decoded[key] for key, _ in fragments)
+            x = _FRAGMENT_MARGIN + indent
+            placements.append((label, _FRAGMENT_MARGIN + label_width - label.width, y))
+            placements.append((content, x, y))
+            height = max(label.height, content.height)
+            width = max(width, x + content.width)
+        else:
+            image = decoded[fragments[0][0]]
+            placements.append((image, _FRAGMENT_MARGIN, y))
+            height = image.height
+            width = max(width, _FRAGMENT_MARGIN + image.width)
+        y += height + _FRAGMENT_ROW_GAP
+    canvas = Image.new("RGB", (width + _FRAGMENT_MARGIN, y - _FRAGMENT_ROW_GAP + _FRAGMENT_MARGIN), "white")
+    for image, x, top in placements:
+        canvas.paste(image, (x, top))
+    out = io.BytesIO()
+    canvas.save(out, format="PNG", optimize=True)
+    return out.getvalue()
+
+
+# Worker documents wait here, after the preamble and fonts are loaded,
+# until the job body is in place. Reading the terminal needs scrollmode;
+# the job itself then runs in nonstopmode like a one-shot compile.
+_WORKER_WAIT = r"""
+\endlinechar=-1
+\read-1 to \jobready
+\endlinechar=13
+\nonstopmode
+\input{job}
+"""
+
+
+def _document_body(latex_code: str) -> Optional[str]:
+    """The part between the standard header and footer, None for other documents."""
+    if not latex_code.startswith(_LATEX_HEADER) or not latex_code.endswith(_LATEX_FOOTER):
+        return None
+    return latex_code[len(_LATEX_HEADER):len(latex_code) - len(_LATEX_FOOTER)]
+
+
+def _pdf_to_pngs(pdf_path: str, workdir: str) -> List[bytes]:
+    """One PNG per page, in page order."""
+    try:
+        subprocess.run(
+            ["pdftoppm", "-png", pdf_path, "page"],
+            cwd=workdir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            timeout=15,
+        )
+    except subprocess.CalledProcessError as e:
+        raise LatexCompilationError(
+            "PDF->PNG failed",
+            e.stdout.decode("utf-8", "ignore"),
+            e.stderr.decode("utf-8", "ignore"),
+        ) from e
+    # page-1.png or page-01.png..., depending on the page count
+    paths = sorted(
+        glob.glob(os.path.join(workdir, "page-*.png")),
+        key=lambda path: int(path.rsplit("-", 1)[1][:-4]),
+    )
+    pages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            pages.append(f.read())
+    return pages
+
+
+def _pdf_to_png(pdf_path: str, workdir: str) -> bytes:
+    png_path = os.path.join(workdir, "out.png")
+    try:
+        subprocess.run(
+            ["pdftoppm", "-png", "-singlefile", pdf_path, "out"],
+            cwd=workdir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+            timeout=5,
+        )
+    except subprocess.CalledProcessError as e:
+        raise LatexCompilationError(
+            "PDF->PNG failed",
+            e.stdout.decode("utf-8", "ignore"),
+            e.stderr.decode("utf-8", "ignore"),
+        ) from e
+    with open(png_path, "rb") as f:
+        return f.read()
+
+
+class TexWorker:
+    """
+    An xelatex process started ahead of time that has loaded the preamble
+    and fonts and blocks until it is given a job. TeX writes the PDF only
+    when it finishes, so every worker runs exactly one job.
+    """
+
+    def __init__(self, fmt: Optional[str]):
+        self.fmt = fmt
+        self.started_at = time.monotonic()
+        self.dir = tempfile.mkdtemp(prefix="texworker-")
+        header = _LATEX_HEADER if fmt else _LATEX_HEADER.replace(_END_OF_DUMP, "", 1)
+        with open(os.path.join(self.dir, "worker.tex"), "w", encoding="utf-8") as f:
+            f.write(header + _WORKER_WAIT + _LATEX_FOOTER)
+        env = _tex_env()
+        fmt_args = []
+        if fmt:
+            fmt_args = [f"-fmt={fmt}"]
+            env["TEXFORMATS"] = LATEX_FORMAT_DIR + os.pathsep
+        # Output goes to a file: an undrained pipe would stall the process
+        self._log = open(os.path.join(self.dir, "worker.out"), "wb")
+        try:
+            self.process = subprocess.Popen(
+                ["xelatex", "-no-shell-escape", "-interaction=scrollmode", *fmt_args, "worker.tex"],
+                cwd=self.dir,
+                env=env,
+                stdin=subprocess.PIPE,
+                stdout=self._log,
+                stderr=subprocess.STDOUT,
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def rss_bytes(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def run(self, body: str) -> bytes:
+        with open(os.path.join(self.dir, "job.tex"), "w", encoding="utf-8") as f:
+            f.write(body)
+        try:
+            self.process.stdin.write(b"\n")
+            self.process.stdin.close()
+        except OSError as e:
+            raise LatexCompilationError("TeX worker died", self._output(), "") from e
+        try:
+            self.process.wait(timeout=LATEX_TIMEOUT_SEC)
+        except subprocess.TimeoutExpired as e:
+            self.process.kill()
+            self.process.wait()
+            raise LatexCompilationError("LaTeX timeout", "", "") from e
+        pdf_path = os.path.join(self.dir, "worker.pdf")
+        if self.process.returncode != 0:
+            stdout = self._output()
+            print(f"XeLaTeX worker failed with exit code {self.process.returncode}")
+            print(f"STDOUT:\n{stdout}")
+            print(f"Generated LaTeX:\n{body[:1000]}")
+            raise LatexCompilationError("LaTeX failed", stdout, "")
+        if not os.path.exists(pdf_path):
+            raise LatexCompilationError("PDF not produced")
+        return _pdf_to_png(pdf_path, self.dir)
+
+    def _output(self) -> str:
+        self._log.flush()
+        with open(os.path.join(self.dir, "worker.out"), "rb") as f:
+            return f.read().decode("utf-8", "ignore")
+
+    def close(self) -> None:
+        process = getattr(self, "process", None)
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        self._log.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class TexWorkerPool:
+    """
+    Keeps `size` warm TexWorkers ready so a render only pays for its own
+    body, not for starting TeX and loading the preamble and fonts.
+    Workers are one-shot (see TexWorker): each runs a single job and exits,
+    and a background thread starts its replacement while the caller
+    converts and sends the result. Idle workers are health-checked when
+    handed out: dead ones, ones idle longer than TEX_WORKER_MAX_IDLE_SEC,
+    over TEX_WORKER_MAX_RSS_BYTES or started with a different format are
+    replaced.
+    """
+
+    def __init__(
+        self,
+        size: int = MAX_CONCURRENT_COMPILATIONS,
+        max_idle_sec: float = TEX_WORKER_MAX_IDLE_SEC,
+        max_rss_bytes: int = TEX_WORKER_MAX_RSS_BYTES,
+    ):
+        self.size = size
+        self.max_idle_sec = max_idle_sec
+        self.max_rss_bytes = max_rss_bytes
+        self._idle: Deque[TexWorker] = deque()
+        # Workers being started, counted so concurrent fills don't overshoot
+        self._spawning = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._refill = ThreadPoolExecutor(max_workers=1, thread_name_prefix="texworker-refill")
+        self.jobs = 0
+        self.cold_starts = 0
+        self.spawned = 0
+        self.recycled = 0
+        self.timeouts = 0
+        self.refill_errors = 0
+
+    def _healthy(self, worker: TexWorker, fmt: Optional[str]) -> bool:
+        if worker.fmt != fmt or not worker.alive():
+            return False
+        if time.monotonic() - worker.started_at > self.max_idle_sec:
+            return False
+        rss = worker.rss_bytes()
+        return rss is None or rss <= self.max_rss_bytes
+
+    def _acquire(self, fmt: Optional[str]) -> TexWorker:
+        stale = []
+        worker = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.popleft()
+                if self._healthy(candidate, fmt):
+                    worker = candidate
+                    break
+                stale.append(candidate)
+            self.recycled += len(stale)
+        for candidate in stale:
+            candidate.close()
+        if worker is None:
+            self.cold_starts += 1
+            worker = self._spawn(fmt)
+        return worker
+
+    def _spawn(self, fmt: Optional[str]) -> TexWorker:
+        worker = TexWorker(fmt)
+        self.spawned += 1
+        return worker
+
+    def fill(self, fmt: Optional[str]) -> None:
+        """Start workers until `size` are idle or starting."""
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) + self._spawning >= self.size:
+                    return
+                self._spawning += 1
+            try:
+                worker = self._spawn(fmt)
+            except BaseException:
+                with self._lock:
+                    self._spawning -= 1
+                raise
+            with self._lock:
+                self._spawning -= 1
+                if not self._closed:
+                    self._idle.append(worker)
+                    continue
+            worker.close()
+            return
+
+    def _fill_in_background(self, fmt: Optional[str]) -> None:
+        try:
+            self.fill(fmt)
+        except OSError as e:
+            # The next render cold-starts and, if that fails too, disables the pool
+            self.refill_errors += 1
+            print(f"TeX worker refill failed: {e}")
+
+    def run(self, body: str, fmt: Optional[str]) -> bytes:
+        worker = self._acquire(fmt)
+        self.jobs += 1
+        try:
+            return worker.run(body)
+        except LatexCompilationError as e:
+            if str(e) == "LaTeX timeout":
+                self.timeouts += 1
+            raise
+        finally:
+            worker.close()
+            # Under the lock so close() can't shut the executor down in between
+            with self._lock:
+                if not self._closed:
+                    self._refill.submit(self._fill_in_background, fmt)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            workers = list(self._idle)
+            self._idle.clear()
+        self._refill.shutdown(wait=False)
+        for worker in workers:
+            worker.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "jobs": self.jobs,
+            "cold_starts": self.cold_starts,
+            "spawned": self.spawned,
+            "recycled": self.recycled,
+            "timeouts": self.timeouts,
+            "refill_errors": self.refill_errors,
+        }
+
 class LatexRenderer:
-    def __init__(self):
-        self._sem = asyncio.Semaphore(MAX_CONCURRENT_COMPILATIONS)
+    def __init__(
+        self,
+        fragment_mode: bool = LATEX_FRAGMENT_MODE,
+        mathtext_enabled: bool = LATEX_MATHTEXT_ENABLED,
+    ):
+        self.fragment_mode = fragment_mode
+        self._mathtext = MathtextRenderer() if mathtext_enabled else None
+        self.mathtext_fallbacks = 0
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        self._scheduler = PriorityScheduler(capacity=MAX_CONCURRENT_COMPILATIONS)
+        self._format_lock = threading.Lock()
+        self._format: Optional[str] = None
+        self._format_failed = False
+        self._format_retry_at = 0.0
+        self.format_load_failures = 0
+        # Compile latency with the dumped format vs. a full preamble load
+        self._latency = {"format": LatencyTracker(), "plain": LatencyTracker()}
+        # End-to-end render latency of cache misses, by the backend that served them
+        self._backend_latency = {
+            "mathtext": LatencyTracker(),
+            "fragments": LatencyTracker(),
+            "xelatex": LatencyTracker(),
+        }
+        self._pool: Optional[TexWorkerPool] = TexWorkerPool()
+        self._cache = RenderCache(
+            directory=RENDER_CACHE_DIR,
+            memory_max_bytes=RENDER_CACHE_MEMORY_MAX_BYTES,
+            disk_max_bytes=RENDER_CACHE_DISK_MAX_BYTES,
+        )
+        atexit.register(self.close)
+
+    def warm(self) -> None:
+        """Build the format and start the warm TeX workers."""
+        fmt = self.build_format()
+        if self._pool is not None:
+            try:
+                self._pool.fill(fmt)
+            except OSError as e:
+                self._disable_pool(e)
+
+    def _disable_pool(self, error: Exception) -> None:
+        print(f"TeX worker pool unavailable, compiling one-shot: {error}")
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+
+    def build_format(self) -> Optional[str]:
+        """
+        Dump the preamble (document class and packages) into a XeLaTeX
+        format once, so compiles skip loading them. Reuses a format already
+        in LATEX_FORMAT_DIR, e.g. one built into the Docker image.
+        Returns:
+            Optional[str]: format name, None if it can't be built
+        """
+        with self._format_lock:
+            if self._format is not None or self._format_failed:
+                return self._format
+            if time.monotonic() < self._format_retry_at:
+                return None
+            name = _format_name()
+            if not os.path.exists(os.path.join(LATEX_FORMAT_DIR, name + ".fmt")):
+                try:
+                    self._dump_format(name)
+                except Exception as e:
+                    print(f"Building LaTeX format failed, compiling without it: {e}")
+                    self._format_failed = True
+                    return None
+            self._format = name
+            return name
+
+    def _dump_format(self, name: str) -> None:
+        os.makedirs(LATEX_FORMAT_DIR, exist_ok=True)
+        # Built next to its final place so the rename is atomic for other processes
+        with tempfile.TemporaryDirectory(dir=LATEX_FORMAT_DIR) as tmp:
+            with open(os.path.join(tmp, "preamble.tex"), "w", encoding="utf-8") as f:
+                f.write(_LATEX_HEADER + _LATEX_FOOTER)
+            subprocess.run(
+                [
+                    "xelatex", "-ini", "-interaction=nonstopmode", f"-jobname={name}",
+                    "&xelatex", "mylatexformat.ltx", "preamble.tex",
+                ],
+                cwd=tmp,
+                env=_tex_env(),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                check=True,
+                timeout=LATEX_FORMAT_TIMEOUT_SEC,
+            )
+            os.replace(
+                os.path.join(tmp, name + ".fmt"),
+                os.path.join(LATEX_FORMAT_DIR, name + ".fmt"),
+            )
 
-    async def render_solution(self, solution: Dict[str, Any]) -> bytes:
-        # Cache per-solution content (structure hash)
-        key = _hash_solution(solution)
-        cached = _get_cache(key)
+    async def render_solution(
+        self, solution: Dict[str, Any], priority: str = PRIORITY_FREE
+    ) -> bytes:
+        key = _render_key(solution)
+        cached = await asyncio.to_thread(self._cache.get, key)
         if cached:
             return cached
-        latex = build_latex(solution)
-        png = await self._compile_to_png(latex)
-        _store_cache(key, png)
+        start_time = time.monotonic()
+        png = None
+        if self._mathtext is not None and await asyncio.to_thread(
+            self._mathtext.qualifies, solution
+        ):
+            try:
+                png = await asyncio.to_thread(self._mathtext.render, solution)
+                backend = "mathtext"
+            except Exception as e:
+                # Anything mathtext chokes on still renders through TeX
+                self.mathtext_fallbacks += 1
+                print(f"Mathtext render failed, falling back to xelatex: {e}")
+        if png is None and self.fragment_mode:
+            png = await self._render_fragments(solution, priority)
+            backend = "fragments"
+        elif png is None:
+            latex = build_latex(solution)
+            png = await self._compile_to_png(latex, priority)
+            backend = "xelatex"
+        self._backend_latency[backend].add(time.monotonic() - start_time)
+        await asyncio.to_thread(self._cache.put, key, png)
         return png
 
-    async def _compile_to_png(self, latex_code: str) -> bytes:
-        async with self._sem:
+    async def _render_fragments(
+        self, solution: Dict[str, Any], priority: str = PRIORITY_FREE
+    ) -> bytes:
+        """
+        Render a solution from per-item fragments: cached ones are reused,
+        the rest are compiled together in one TeX run, then the image is
+        composed in-process.
+        The run is one-shot, without the worker pool or the dumped format:
+        both are set up for the preview class option, fragments need
+        multi=fragment, which can't be changed after the class is loaded.
+        """
+        rows = _fragment_layout(solution)
+        fragments = dict(fragment for _, row in rows for fragment in row)
+        # Headings and labels are shared by every solution and always hit;
+        # only math fragments say whether fragment mode pays off
+        math_keys = {
+            _item_fragment(item)[0]
+            for item in solution["steps"] + solution["solution"]
+            if item["type"] == "math"
+        }
+        images = {}
+        missing = []
+        for key, tex in fragments.items():
+            png = await asyncio.to_thread(self._cache.get, key)
+            if png:
+                images[key] = png
+            else:
+                missing.append((key, tex))
+            if key in math_keys:
+                if png:
+                    self.fragment_hits += 1
+                else:
+                    self.fragment_misses += 1
+        if missing:
+            latex = (
+                _FRAGMENT_HEADER
+                + "\n".join(r"\begin{fragment}" + tex + r"\end{fragment}" for _, tex in missing)
+                + _LATEX_FOOTER
+            )
+            async with self._scheduler.slot(priority):
+                pages = await asyncio.to_thread(
+                    self._compile_document, latex, None, _pdf_to_pngs
+                )
+            if len(pages) != len(missing):
+                raise LatexCompilationError(
+                    f"Expected {len(missing)} fragment pages, got {len(pages)}"
+                )
+            for (key, _), png in zip(missing, pages):
+                images[key] = png
+                await asyncio.to_thread(self._cache.put, key, png)
+        return await asyncio.to_thread(_compose_fragments, rows, images)
+
+    async def _compile_to_png(
+        self, latex_code: str, priority: str = PRIORITY_FREE
+    ) -> bytes:
+        async with self._scheduler.slot(priority):
             return await asyncio.to_thread(self._compile_sync, latex_code)
 
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "scheduler": self._scheduler.stats(),
+            "cache": self._cache.stats(),
+            "format": self._format,
+            "format_load_failures": self.format_load_failures,
+            "fragments": {
+                "enabled": self.fragment_mode,
+                "math_hits": self.fragment_hits,
+                "math_misses": self.fragment_misses,
+                "math_hit_rate": (
+                    self.fragment_hits / (self.fragment_hits + self.fragment_misses)
+                    if self.fragment_hits + self.fragment_misses
+                    else 0.0
+                ),
+            },
+            "pool": self._pool.stats() if self._pool is not None else None,
+            "backends": {
+                "mathtext_enabled": self._mathtext is not None and self._mathtext.available,
+                "mathtext_fallbacks": self.mathtext_fallbacks,
+                **{
+                    backend: {
+                        "count": len(latency),
+                        "p50_latency_sec": latency.percentile(0.5),
+                        "p90_latency_sec": latency.percentile(0.9),
+                    }
+                    for backend, latency in self._backend_latency.items()
+                },
+            },
+            "compiles": {
+                mode: {
+                    "count": len(latency),
+                    "p50_latency_sec": latency.percentile(0.5),
+                    "p90_latency_sec": latency.percentile(0.9),
+                }
+                for mode, latency in self._latency.items()
+            },
+        }
+
     def _compile_sync(self, latex_code: str) -> bytes:
+        start_time = time.monotonic()
+        fmt = self.build_format()
+        try:
+            png = self._compile(latex_code, fmt)
+        except LatexCompilationError as e:
+            # Timeouts and bad LaTeX would fail the same way without the format
+            if not fmt or not _format_load_failed(e):
+                raise
+            self._drop_format(fmt)
+            # One-shot, so the pool isn't refilled without the format and back
+            png = self._compile_document(latex_code, None)
+            fmt = None
+        self._latency["format" if fmt else "plain"].add(time.monotonic() - start_time)
+        return png
+
+    def _drop_format(self, fmt: str) -> None:
+        """
+        Stop using a format TeX couldn't load and delete it, so that
+        build_format dumps a fresh one after LATEX_FORMAT_RETRY_SEC.
+        """
+        with self._format_lock:
+            if self._format != fmt:
+                return
+            print(f"LaTeX format {fmt} failed to load, compiling without it for {LATEX_FORMAT_RETRY_SEC}s")
+            self._format = None
+            self._format_retry_at = time.monotonic() + LATEX_FORMAT_RETRY_SEC
+            self.format_load_failures += 1
+        try:
+            os.unlink(os.path.join(LATEX_FORMAT_DIR, fmt + ".fmt"))
+        except OSError:
+            pass
+
+    def _compile(self, latex_code: str, fmt: Optional[str]) -> bytes:
+        body = _document_body(latex_code)
+        pool = self._pool
+        if body is not None and pool is not None:
+            try:
+                return pool.run(body, fmt)
+            except OSError as e:
+                self._disable_pool(e)
+        return self._compile_document(latex_code, fmt)
+
+    def _compile_document(
+        self, latex_code: str, fmt: Optional[str], convert: Callable = _pdf_to_png
+    ):
+        env = _tex_env()
+        if fmt:
+            fmt_args = [f"-fmt={fmt}"]
+            # Trailing separator keeps the default search path
+            env["TEXFORMATS"] = LATEX_FORMAT_DIR + os.pathsep
+        else:
+            fmt_args = []
+            latex_code = latex_code.replace(_END_OF_DUMP, "", 1)
         with tempfile.TemporaryDirectory() as tmp:
             tex_path = os.path.join(tmp, "doc.tex")
             with open(tex_path, "w", encoding="utf-8") as f:
                 f.write(latex_code)
 
-            cmd = ["xelatex", "-no-shell-escape", "-interaction=nonstopmode", "doc.tex"]
-            env = {
-                **os.environ,
-                "HOME": "/tmp",
-                "TEXMFVAR": "/tmp/texmf-var",
-                "TEXMFCONFIG": "/tmp/texmf-config"
-            }
+            cmd = ["xelatex", "-no-shell-escape", "-interaction=nonstopmode", *fmt_args, "doc.tex"]
 
             try:
                 result = subprocess.run(
@@ -187,37 +915,7 @@ class LatexRenderer:
                 raise LatexCompilationError("PDF not produced")
 
             # Convert PDF → PNG
-            png_path = os.path.join(tmp, "out.png")
-            try:
-                subprocess.run(
-                    ["pdftoppm", "-png", "-singlefile", pdf_path, "out"],
-                    cwd=tmp,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    check=True,
-                    timeout=5,
-                )
-            except subprocess.CalledProcessError as e:
-                raise LatexCompilationError(
-                    "PDF->PNG failed",
-                    e.stdout.decode("utf-8", "ignore"),
-                    e.stderr.decode("utf-8", "ignore"),
-                ) from e
-            with open(png_path, "rb") as f:
-                return f.read()
-
-# Simple in‑process cache
-@lru_cache(maxsize=256)
-def _get_cache(key: str) -> Optional[bytes]:
-    return None  # lru_cache wrapper placeholder
-
-_cache_store: Dict[str, bytes] = {}
-
-def _store_cache(key: str, data: bytes) -> None:
-    _cache_store[key] = data
-
-def _get_cache(key: str) -> Optional[bytes]:  # override helper
-    return _cache_store.get(key)
+            return convert(pdf_path, tmp)
 
 # Singleton instance
 latex_renderer = LatexRenderer()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import io
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from matplotlib.mathtext import MathTextParser
+except ImportError:  # optional, solutions then always go to xelatex
+    Figure = None
+
+# Commands matplotlib mathtext renders like LaTeX does; anything else
+# (\text, environments, \\, ...) goes to xelatex
+_ALLOWED_COMMANDS = {
+    "frac", "dfrac", "sqrt", "cdot", "times", "div", "pm", "mp",
+    "le", "leq", "ge", "geq", "ne", "neq", "approx", "equiv", "sim",
+    "infty", "pi", "alpha", "beta", "gamma", "delta", "Delta", "epsilon",
+    "varepsilon", "theta", "lambda", "mu", "rho", "sigma", "tau", "phi",
+    "varphi", "omega", "Omega", "sin", "cos", "tan", "cot", "arcsin",
+    "arccos", "arctan", "log", "ln", "lg", "exp", "lim", "sum", "int", "prod",
+    "left", "right", "to", "rightarrow", "Rightarrow", "Leftrightarrow",
+    "cdots", "ldots", "circ", "angle", "perp", "parallel", "in", "notin",
+    "cup", "cap", "subset", "mathbb", "mathrm", "overline", "vec", "bar",
+    "quad", "qquad", ",", ";", "!", "{", "}", "%", "|",
+}
+_COMMAND_RE = re.compile(r"\\([A-Za-z]+|.)")
+# Inline math in text items: $...$, $$...$$ or \(...\)
+_INLINE_MATH_RE = re.compile(r"\$\$(.+?)\$\$|\$(.+?)\$|\\\((.+?)\\\)", re.DOTALL)
+
+MATHTEXT_MAX_MATH_CHARS = 120
+MATHTEXT_MAX_LINES = 40
+_LINE_CHARS = 70
+_FONT_SIZE = 13
+_DPI = 150
+_LEFT_IN = 0.1
+_INDENT_IN = 0.4
+_LINE_GAP_IN = 0.06
+_SECTION_GAP_IN = 0.12
+
+
+def _strip_delimiters(s: str) -> str:
+    s = s.strip()
+    for a, b in (("$$", "$$"), ("$", "$"), ("\\[", "\\]"), ("\\(", "\\)")):
+        if s.startswith(a) and s.endswith(b):
+            return s[len(a): -len(b)].strip()
+    return s
+
+
+class MathtextRenderer:
+    """
+    In-process renderer for simple solutions using matplotlib's mathtext,
+    which needs no TeX installation and takes milliseconds. A solution
+    qualifies when all of its math is short, uses only commands mathtext
+    renders faithfully and parses; its text has no TeX commands.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._parser = MathTextParser("agg") if Figure is not None else None
+
+    @property
+    def available(self) -> bool:
+        return self._parser is not None
+
+    def _math_ok(self, expr: str) -> bool:
+        if not expr or len(expr) > MATHTEXT_MAX_MATH_CHARS or "$" in expr:
+            return False
+        if any(name not in _ALLOWED_COMMANDS for name in _COMMAND_RE.findall(expr)):
+            return False
+        try:
+            with self._lock:
+                self._parser.parse(f"${expr}$", dpi=72)
+        except Exception:
+            return False
+        return True
+
+    def _text_line(self, text: str) -> Optional[str]:
+        """Text with inline math as a mathtext string, None if it doesn't qualify."""
+        out = []
+        pos = 0
+        for match in _INLINE_MATH_RE.finditer(text):
+            plain = text[pos:match.start()]
+            if "\\" in plain or "$" in plain:
+                return None
+            expr = next(group for group in match.groups() if group is not None).strip()
+            if not self._math_ok(expr):
+                return None
+            out.append(plain)
+            out.append(f"${expr}$")
+            pos = match.end()
+        plain = text[pos:]
+        if "\\" in plain or "$" in plain:
+            return None
+        out.append(plain)
+        return "".join(out)
+
+    def _layout(self, solution: Dict[str, Any]) -> Optional[List[Tuple[str, str, str]]]:
+        """Rows of (kind, label, mathtext), None if the solution doesn't qualify."""
+        problem = self._text_line(solution["problem"])
+        if problem is None:
+            return None
+        rows = [("heading", "", "Задание:")]
+        rows += [("text", "", line) for line in _wrap(problem)]
+        for title, items in (("Решение:", solution["steps"]), ("Ответ:", solution["solution"])):
+            rows.append(("heading", "", title))
+            for idx, item in enumerate(items, start=1):
+                if item["type"] == "math":
+                    expr = _strip_delimiters(item["content"])
+                    if not self._math_ok(expr):
+                        return None
+                    lines = [f"${expr}$"]
+                else:
+                    line = self._text_line(item["content"])
+                    if line is None:
+                        return None
+                    lines = _wrap(line)
+                for n, line in enumerate(lines):
+                    rows.append(("item", f"{idx}." if n == 0 else "", line))
+        if len(rows) > MATHTEXT_MAX_LINES:
+            return None
+        return rows
+
+    def qualifies(self, solution: Dict[str, Any]) -> bool:
+        if not self.available:
+            return False
+        try:
+            return self._layout(solution) is not None
+        except (KeyError, TypeError):
+            return False
+
+    def render(self, solution: Dict[str, Any]) -> bytes:
+        rows = self._layout(solution)
+        if rows is None:
+            raise ValueError("Solution doesn't qualify for mathtext rendering")
+        with self._lock:
+            figure = Figure(figsize=(1, 1), dpi=_DPI)
+            canvas = FigureCanvasAgg(figure)
+            renderer = canvas.get_renderer()
+            font = {"fontsize": _FONT_SIZE, "family": "DejaVu Serif", "math_fontfamily": "dejavuserif"}
+            texts = []
+            y = 0.0
+            width = 0.0
+            for idx, (kind, label, line) in enumerate(rows):
+                if kind == "heading" and idx:
+                    y -= _SECTION_GAP_IN
+                x = _LEFT_IN + (_INDENT_IN if kind == "item" else 0.0)
+                text = figure.text(
+                    x, y, line, va="top", transform=figure.dpi_scale_trans,
+                    fontweight="bold" if kind == "heading" else "normal", **font,
+                )
+                texts.append(text)
+                if label:
+                    texts.append(figure.text(
+                        _LEFT_IN, y, label, va="top", transform=figure.dpi_scale_trans, **font
+                    ))
+                extent = text.get_window_extent(renderer)
+                width = max(width, x + extent.width / _DPI)
+                y -= extent.height / _DPI + _LINE_GAP_IN
+            # Laid out downwards from y=0; now size the figure and shift into it
+            height = -y + _LEFT_IN
+            figure.set_size_inches(width + _LEFT_IN, height)
+            for text in texts:
+                tx, ty = text.get_position()
+                text.set_position((tx, ty + height - _LEFT_IN))
+            out = io.BytesIO()
+            figure.savefig(out, format="png", dpi=_DPI, facecolor="white")
+        return out.getvalue()
+
+
+def _wrap(line: str) -> List[str]:
+    """Greedy word wrap that never breaks inside $...$."""
+    tokens = re.findall(r"(?:\$[^$]*\$|[^\s$])+", line)
+    lines, current = [], ""
+    for token in tokens:
+        candidate = f"{current} {token}" if current else token
+        if current and len(candidate) > _LINE_CHARS:
+            lines.append(current)
+            current = token
+        else:
+            current = candidate
+    if current or not lines:
+        lines.append(current)
+    return lines
@@ -0,0 +1,295 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from bot.constants import (
+    BREAKER_EWMA_ALPHA,
+    BREAKER_ERROR_RATE_THRESHOLD,
+    BREAKER_LATENCY_THRESHOLD_SEC,
+    BREAKER_MIN_CALLS,
+    BREAKER_OPEN_SEC,
+    BREAKER_HALF_OPEN_PROBES,
+)
+from bot.hedging import Hedger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Tracks EWMA error rate and latency of one provider.
+    Opens when either crosses its threshold, lets a limited number of probe
+    requests through after the cool-down and closes again on a good probe.
+    """
+
+    def __init__(
+        self,
+        alpha: float = BREAKER_EWMA_ALPHA,
+        error_rate_threshold: float = BREAKER_ERROR_RATE_THRESHOLD,
+        latency_threshold_sec: float = BREAKER_LATENCY_THRESHOLD_SEC,
+        min_calls: int = BREAKER_MIN_CALLS,
+        open_sec: float = BREAKER_OPEN_SEC,
+        half_open_probes: int = BREAKER_HALF_OPEN_PROBES,
+    ):
+        self.alpha = alpha
+        self.error_rate_threshold = error_rate_threshold
+        self.latency_threshold_sec = latency_threshold_sec
+        self.min_calls = min_calls
+        self.open_sec = open_sec
+        self.half_open_probes = half_open_probes
+        self.error_rate = 0.0
+        self.latency: Optional[float] = None
+        self.calls = 0
+        self.cancelled_slow = 0
+        self.times_opened = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_sec:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+        return self._state
+
+    def available(self) -> bool:
+        state = self.state
+        return state == CLOSED or (
+            state == HALF_OPEN and self._probes_in_flight < self.half_open_probes
+        )
+
+    def acquire(self) -> bool:
+        """Return True if a request may be sent to the provider now."""
+        if not self.available():
+            return False
+        if self._state == HALF_OPEN:
+            self._probes_in_flight += 1
+        return True
+
+    def release(self) -> None:
+        # The request was cancelled before producing a verdict
+        if self._state == HALF_OPEN and self._probes_in_flight:
+            self._probes_in_flight -= 1
+
+    def record_success(self, latency: float) -> None:
+        self.calls += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = (1 - self.alpha) * self.latency + self.alpha * latency
+        if self._state == HALF_OPEN:
+            self._close(latency)
+        elif self._degraded():
+            self._open()
+
+    def record_cancelled(self, elapsed: float) -> None:
+        """
+        The call was cancelled, usually by the hedger once the other
+        provider won. Its latency is at least `elapsed`, which counts as a
+        sample when it is above the EWMA or the latency threshold: otherwise
+        a provider the hedge keeps cutting off would never trip the breaker
+        on latency.
+        """
+        if self._state == HALF_OPEN:
+            if elapsed >= self.latency_threshold_sec:
+                self._open()
+            else:
+                self.release()
+            return
+        if (
+            self.latency is not None
+            and elapsed < self.latency
+            and elapsed < self.latency_threshold_sec
+        ):
+            return
+        self.calls += 1
+        self.cancelled_slow += 1
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = (1 - self.alpha) * self.latency + self.alpha * elapsed
+        if self._degraded():
+            self._open()
+
+    def record_failure(self) -> None:
+        self.calls += 1
+        self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha
+        if self._state == HALF_OPEN or self._degraded():
+            self._open()
+
+    def _degraded(self) -> bool:
+        if self.calls < self.min_calls:
+            return False
+        return self.error_rate >= self.error_rate_threshold or (
+            self.latency is not None and self.latency >= self.latency_threshold_sec
+        )
+
+    def _open(self) -> None:
+        if self._state != OPEN:
+            self.times_opened += 1
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probes_in_flight = 0
+
+    def _close(self, latency: float) -> None:
+        self._state = CLOSED
+        self.error_rate = 0.0
+        self.latency = latency
+        self.calls = 0
+        self._probes_in_flight = 0
+
+    def status(self) -> Dict[str, Any]:
+        state = self.state
+        return {
+            "state": state,
+            "error_rate_ewma": round(self.error_rate, 4),
+            "latency_ewma_sec": None if self.latency is None else round(self.latency, 3),
+            "cancelled_slow": self.cancelled_slow,
+            "times_opened": self.times_opened,
+            "reopens_in_sec": (
+                round(max(0.0, self.open_sec - (time.monotonic() - self._opened_at)), 1)
+                if state == OPEN
+                else None
+            ),
+        }
+
+
+class ProviderRouter:
+    """
+    Routes solver operations to LLM providers by breaker state.
+    Providers are tried in the configured order, skipping open breakers;
+    with two healthy providers the call is hedged between them.
+    """
+
+    def __init__(
+        self,
+        providers: Dict[str, Dict[str, Callable[..., Awaitable[Any]]]],
+        hedger: Optional[Hedger] = None,
+    ):
+        """
+        Args:
+            providers: provider name -> operation name -> coroutine function,
+                in order of preference
+            hedger (Hedger): hedging policy between the two best providers
+        """
+        self.providers = providers
+        self.hedger = hedger or Hedger()
+        self.breakers = {name: CircuitBreaker() for name in providers}
+        self.rejected = {name: 0 for name in providers}
+
+    def _select(self) -> List[str]:
+        # Half-open providers keep their place in the order so the probe is
+        # actually sent; the hedge covers the request if the probe is slow
+        selected = []
+        for name in self.providers:
+            if self.breakers[name].available():
+                selected.append(name)
+            else:
+                self.rejected[name] += 1
+        return selected
+
+    async def _tracked(
+        self,
+        provider: str,
+        operation: str,
+        args: tuple,
+        validate: Callable[[Any], bool],
+        force: bool = False,
+    ) -> Any:
+        breaker = self.breakers[provider]
+        # Acquire only when the call actually starts, so a hedge that never
+        # fires does not hold a half-open probe slot
+        if not breaker.acquire() and not force:
+            raise ProviderUnavailableError(f"{provider} circuit is open")
+        start_time = time.monotonic()
+        try:
+            result = await self.providers[provider][operation](*args)
+            if not validate(result):
+                raise ValueError(f"{provider} returned an invalid result")
+        except Exception:
+            breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            breaker.record_cancelled(time.monotonic() - start_time)
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success(time.monotonic() - start_time)
+        return result
+
+    async def call(
+        self,
+        operation: str,
+        *args,
+        validate: Callable[[Any], bool] = lambda result: result is not None,
+    ) -> Any:
+        """
+        Args:
+            operation (str): operation name, e.g. "solve" or "text"
+            *args: arguments passed to the provider's coroutine function
+            validate: predicate a provider result must satisfy
+        Returns:
+            Any: the first valid provider result
+        """
+        selected = self._select()
+        if not selected:
+            # Every breaker is open: better to try the preferred provider
+            # than to fail the request outright
+            preferred = next(iter(self.providers))
+            return await self.hedger.run_single(
+                preferred,
+                lambda: self._tracked(preferred, operation, args, validate, force=True),
+            )
+        if len(selected) == 1:
+            return await self.hedger.run_single(
+                selected[0],
+                lambda: self._tracked(selected[0], operation, args, validate),
+            )
+        primary, secondary = selected[:2]
+        return await self.hedger.run(
+            primary,
+            lambda: self._tracked(primary, operation, args, validate),
+            secondary,
+            lambda: self._tracked(secondary, operation, args, validate),
+        )
+
+    async def stream(self, operation: str, *args) -> AsyncIterator[Any]:
+        """
+        Stream from the first available provider implementing `operation`.
+        Streams are not hedged: once items have been delivered the caller
+        can't switch providers.
+        """
+        for name in self._select():
+            if operation in self.providers[name]:
+                break
+        else:
+            raise ProviderUnavailableError(f"No provider available for {operation}")
+        breaker = self.breakers[name]
+        if not breaker.acquire():
+            raise ProviderUnavailableError(f"{name} circuit is open")
+        start_time = time.monotonic()
+        try:
+            async for item in self.providers[name][operation](*args):
+                yield item
+        except Exception:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_success(time.monotonic() - start_time)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            name: {**self.breakers[name].status(), "rejected": self.rejected[name]}
+            for name in self.providers
+        }
@@ -0,0 +1,119 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Dict
+
+from bot.constants import OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE
+
+
+class TokenBucket:
+    """Per-minute budget refilled continuously. May go negative (debt)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, amount: float) -> float:
+        self._refill()
+        # A request bigger than the whole bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def adjust(self, delta: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+@dataclass
+class Reservation:
+    estimated_tokens: int
+    waited: float
+
+
+class LLMRateLimiter:
+    """
+    Client-side RPM/TPM limiter for an LLM provider.
+    Callers reserve an estimated token count before the request and
+    reconcile it with the reported usage afterwards. Waiters are served
+    strictly in arrival order.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute: int = OPENAI_TOKENS_PER_MINUTE,
+    ):
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        # asyncio.Lock wakes waiters in FIFO order
+        self._lock = asyncio.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.acquired = 0
+        self.delayed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.estimated_tokens = 0
+        self.actual_tokens = 0
+
+    async def acquire(self, estimated_tokens: int) -> Reservation:
+        start_time = time.monotonic()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            async with self._lock:
+                while True:
+                    wait = max(
+                        self._requests.time_until(1),
+                        self._tokens.time_until(estimated_tokens),
+                    )
+                    if wait <= 0:
+                        break
+                    await asyncio.sleep(wait)
+                self._requests.consume(1)
+                self._tokens.consume(estimated_tokens)
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - start_time
+        self.acquired += 1
+        self.estimated_tokens += estimated_tokens
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited > 0.01:
+            self.delayed += 1
+        return Reservation(estimated_tokens=estimated_tokens, waited=waited)
+
+    def reconcile(self, reservation: Reservation, actual_tokens: int) -> None:
+        """
+        Replace the estimate with the real usage; pass 0 for requests that
+        failed before consuming tokens.
+        """
+        self.actual_tokens += actual_tokens
+        self._tokens.adjust(actual_tokens - reservation.estimated_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "acquired": self.acquired,
+            "delayed": self.delayed,
+            "avg_wait_sec": round(self.total_wait / self.acquired, 3) if self.acquired else 0.0,
+            "max_wait_sec": round(self.max_wait, 3),
+            "estimated_tokens": self.estimated_tokens,
+            "actual_tokens": self.actual_tokens,
+            "available_requests": int(self._requests.tokens),
+            "available_tokens": int(self._tokens.tokens),
+        }
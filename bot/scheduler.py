@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Optional
+
+from bot.constants import PRIORITY_PAID, PRIORITY_FREE, PRIORITY_WEIGHTS
+from bot.hedging import LatencyTracker
+
+
+def classify_priority(balance: Dict[str, Any]) -> str:
+    """
+    Map a get_current_balance response to a priority class.
+    Users with a non-zero subscription_limit (donors) are paid.
+    """
+    try:
+        if balance["message"][0]["subscription_limit"] > 0:
+            return PRIORITY_PAID
+    except (KeyError, IndexError, TypeError):
+        pass
+    return PRIORITY_FREE
+
+
+class PriorityScheduler:
+    """
+    Limits concurrent work to `capacity` slots and hands freed slots to
+    waiting classes by smooth weighted round-robin, so paid requests queue
+    less without starving free ones.
+    """
+
+    def __init__(self, capacity: int, weights: Optional[Dict[str, int]] = None):
+        self.capacity = capacity
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self._active = 0
+        self._queues: Dict[str, Deque[asyncio.Future]] = {
+            name: deque() for name in self.weights
+        }
+        self._credit = {name: 0 for name in self.weights}
+        self._wait = {name: LatencyTracker() for name in self.weights}
+        self._served = {name: 0 for name in self.weights}
+
+    @asynccontextmanager
+    async def slot(self, priority: str):
+        if priority not in self.weights:
+            priority = PRIORITY_FREE
+        start_time = time.monotonic()
+        await self._acquire(priority)
+        self._wait[priority].add(time.monotonic() - start_time)
+        self._served[priority] += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: str) -> None:
+        if self._active < self.capacity and not any(self._queues.values()):
+            self._active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we were cancelled
+                self._release()
+            else:
+                self._queues[priority].remove(future)
+            raise
+
+    def _release(self) -> None:
+        priority = self._next_class()
+        if priority is None:
+            self._active -= 1
+            return
+        # Hand the slot over directly; _active stays the same
+        self._queues[priority].popleft().set_result(None)
+
+    def _next_class(self) -> Optional[str]:
+        waiting = [name for name, queue in self._queues.items() if queue]
+        if not waiting:
+            return None
+        total = 0
+        for name in waiting:
+            self._credit[name] += self.weights[name]
+            total += self.weights[name]
+        chosen = max(waiting, key=lambda name: self._credit[name])
+        self._credit[chosen] -= total
+        return chosen
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "active": self._active,
+            "classes": {
+                name: {
+                    "queued": len(self._queues[name]),
+                    "served": self._served[name],
+                    "p50_wait_sec": self._wait[name].percentile(0.5),
+                    "p90_wait_sec": self._wait[name].percentile(0.9),
+                }
+                for name in self.weights
+            },
+        }
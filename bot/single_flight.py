@@ -0,0 +1,99 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution.
+    The call runs as its own task, so a caller that goes away (e.g. a
+    dropped client connection) doesn't cancel it for the others; a leader
+    that goes away hands its work off (see `hand_off`).
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Future] = {}
+        # Callers awaiting a key they didn't start
+        self._followers: Dict[str, int] = {}
+        self._handoffs: Set[asyncio.Task] = set()
+        self.calls = 0
+        self.coalesced = 0
+        self.handoffs = 0
+
+    def in_flight(self, key: str) -> Optional[asyncio.Future]:
+        return self._tasks.get(key)
+
+    def lead(self, key: str) -> asyncio.Future:
+        """
+        Register the caller as the leader of `key` for work it drives itself
+        (e.g. a stream). The leader must resolve the returned future;
+        followers calling `do` with the same key await it.
+        """
+        self.calls += 1
+        future = asyncio.get_running_loop().create_future()
+        self._tasks[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def hand_off(self, key: str, factory: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Called by a leader that can't finish (e.g. its client disconnected):
+        if followers are waiting, `factory` runs as a detached task that
+        resolves the leader's future for them, otherwise the key is dropped.
+        """
+        future = self._tasks.get(key)
+        if future is None or future.done():
+            return
+        if not self._followers.get(key):
+            future.cancel()
+            return
+        self.handoffs += 1
+        task = asyncio.ensure_future(factory())
+        self._handoffs.add(task)
+
+        def resolve(done: asyncio.Task) -> None:
+            self._handoffs.discard(done)
+            if future.done():
+                return
+            if done.cancelled():
+                future.cancel()
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                future.set_result(done.result())
+
+        task.add_done_callback(resolve)
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Args:
+            key (str): content hash identifying the call
+            factory: zero-argument coroutine factory, run only by the first caller
+        Returns:
+            Any: the shared result
+        """
+        task = self._tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            self._followers[key] = self._followers.get(key, 0) + 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, future: asyncio.Future) -> None:
+        # The key may already belong to a newer flight
+        if self._tasks.get(key) is future:
+            del self._tasks[key]
+            self._followers.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "handoffs": self.handoffs,
+            "in_flight": len(self._tasks),
+            "coalesced_rate": self.coalesced / total if total else 0.0,
+        }
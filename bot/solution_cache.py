@@ -0,0 +1,624 @@
+import base64
+import binascii
+import hashlib
+import io
+import json
+import math
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple, List
+
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+from bot.constants import (
+    IMAGE_CACHE_MAX_HAMMING_DISTANCE,
+    IMAGE_CACHE_MIN_CORRELATION,
+    IMAGE_CACHE_TTL_SEC,
+    IMAGE_CACHE_MAX_ENTRIES,
+    TEXT_CACHE_MIN_SIMILARITY,
+    TEXT_CACHE_TTL_SEC,
+    TEXT_CACHE_MAX_ENTRIES,
+    USER_SOLUTION_CACHE_MAX_USERS,
+    USER_SOLUTION_CACHE_PER_USER,
+    SENT_SOLUTION_CACHE_MAX_ENTRIES,
+)
+
+_HASH_SIZE = 16
+_THUMBNAIL_SIZE = 32
+# Side of the grayscale image the hash and thumbnail are taken from
+_WORK_SIZE = 512
+# A row or column is content when its ink exceeds this share of the mean
+_CONTENT_THRESHOLD = 0.25
+
+_SHINGLE_SIZE = 5
+_MINHASH_BANDS = 16
+_MINHASH_ROWS = 4
+_MINHASH_PERMUTATIONS = _MINHASH_BANDS * _MINHASH_ROWS
+_MERSENNE_PRIME = (1 << 61) - 1
+# Fixed seeds so signatures stay comparable across restarts
+_MINHASH_PARAMS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME or 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME,
+    )
+    for i in range(_MINHASH_PERMUTATIONS)
+]
+
+_CHAR_REPLACEMENTS = {
+    "\u2212": "-",  # minus sign
+    "\u2013": "-",
+    "\u2014": "-",
+    "\u00d7": "*",
+    "\u00b7": "*",
+    "\u22c5": "*",
+    "\u00f7": "/",
+    "\u201c": '"',
+    "\u201d": '"',
+    "\u00ab": '"',
+    "\u00bb": '"',
+    "\u2019": "'",
+    "\u0451": "\u0435",  # ё -> е
+}
+_SENTENCE_PUNCTUATION_RE = re.compile(r"[.,!?;:\u2026]+(?=\s|$)|(?<=\s)[.,!?;:\u2026]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+# Spacing that doesn't change an expression: "x^2 - 5 x" is "x^2-5x"
+_OPERATOR_SPACE_RE = re.compile(r" ?([-+*/^=<>()]) ?")
+_COEFFICIENT_SPACE_RE = re.compile(r"(?<=\d) (?=[a-z]\b)")
+_MATH_TOKEN_RE = re.compile(r"\d+|[-+*/^=<>()]")
+_WORD_RE = re.compile(r"\w+")
+# Words whose presence doesn't change what a problem asks
+_STOPWORDS = frozenset(
+    "а в во и к ко на о об от по с со у из за для до же ли ну то это".split()
+    + "a an the of to in on at for and or is are be".split()
+)
+
+
+def _content_bounds(profile: bytes) -> Tuple[float, float]:
+    """
+    First and last position where a row or column ink profile crosses the
+    content threshold, interpolated to a fraction of a pixel.
+    """
+    n = len(profile)
+    threshold = _CONTENT_THRESHOLD * sum(profile) / n
+    inside = [i for i, value in enumerate(profile) if value > threshold]
+    if not inside:
+        return 0.0, float(n)
+    first, last = inside[0], inside[-1]
+    start = 0.0
+    if first > 0:
+        before, after = profile[first - 1], profile[first]
+        start = first - 1 + (threshold - before) / (after - before)
+    end = float(n)
+    if last < n - 1:
+        before, after = profile[last], profile[last + 1]
+        end = last + 1 - (threshold - after) / (before - after)
+    return start, end
+
+
+def compute_image_hash(image_bytes: bytes) -> Optional[str]:
+    """
+    Compute the fingerprint of a photo: a 256-bit difference hash (dHash)
+    and a 32x32 grayscale thumbnail of the ink on the page. The page's
+    lighting is removed with a high-pass filter, and both are taken over
+    the bounding box of the ink rather than the whole frame, so cropping
+    away margins or background doesn't move them and a crop that trims a
+    couple of percent of the text only stretches them slightly.
+    The hash survives recompression, rescaling, brightness changes and
+    such crops and shortlists candidates; the thumbnail verifies them (see
+    ImageSolutionCache.get), as pages of one textbook hash close together.
+    Args:
+        image_bytes (bytes): raw image file content
+    Returns:
+        Optional[str]: "<64-char hex hash>:<base64 thumbnail>" or None if
+        the image can't be decoded
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image.draft("L", (_WORK_SIZE * 2, _WORK_SIZE * 2))
+            gray = image.convert("L").resize(
+                (_WORK_SIZE, _WORK_SIZE), Image.Resampling.BOX
+            )
+    except Exception as e:
+        print(f"Failed to hash image: {e}")
+        return None
+    # Ink is darker than its blurred surroundings; lighting gradients cancel out
+    background = gray.filter(ImageFilter.GaussianBlur(_WORK_SIZE // 16))
+    ink = ImageOps.autocontrast(ImageChops.subtract(background, gray), cutoff=1)
+    left, right = _content_bounds(ink.resize((_WORK_SIZE, 1), Image.Resampling.BOX).tobytes())
+    top, bottom = _content_bounds(ink.resize((1, _WORK_SIZE), Image.Resampling.BOX).tobytes())
+    box = (left, top, right, bottom)
+    # Individual letters differ with every crop and rescale; lines and blocks don't
+    ink = ink.filter(ImageFilter.GaussianBlur(_WORK_SIZE // 128))
+    pixels = ink.resize((_HASH_SIZE + 1, _HASH_SIZE), Image.Resampling.BOX, box=box).tobytes()
+    value = 0
+    for row in range(_HASH_SIZE):
+        offset = row * (_HASH_SIZE + 1)
+        for col in range(_HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    thumbnail = ink.resize(
+        (_THUMBNAIL_SIZE, _THUMBNAIL_SIZE), Image.Resampling.BOX, box=box
+    ).tobytes()
+    return f"{value:064x}:" + base64.b64encode(thumbnail).decode("ascii")
+
+
+def _parse_image_hash(image_hash: str) -> Optional[Tuple[int, bytes]]:
+    # Rows hashed before thumbnails were added have no ":" and are skipped
+    value, sep, thumbnail = image_hash.partition(":")
+    if not sep or len(value) != _HASH_SIZE * _HASH_SIZE // 4:
+        return None
+    try:
+        thumbnail = base64.b64decode(thumbnail, validate=True)
+        key = int(value, 16)
+    except (binascii.Error, ValueError):
+        return None
+    if len(thumbnail) != _THUMBNAIL_SIZE * _THUMBNAIL_SIZE:
+        return None
+    return key, thumbnail
+
+
+def _thumbnail_correlation(a: bytes, b: bytes) -> float:
+    """Pearson correlation of two thumbnails' pixels."""
+    n = len(a)
+    mean_a = sum(a) / n
+    mean_b = sum(b) / n
+    cov = var_a = var_b = 0.0
+    for x, y in zip(a, b):
+        dx = x - mean_a
+        dy = y - mean_b
+        cov += dx * dy
+        var_a += dx * dx
+        var_b += dy * dy
+    if not var_a or not var_b:
+        return 1.0 if a == b else 0.0
+    return cov / math.sqrt(var_a * var_b)
+
+
+class ImageSolutionCache:
+    """
+    In-memory LRU/TTL index of solutions keyed by image fingerprint (see
+    compute_image_hash). Cached hashes within the Hamming threshold are
+    only candidates: one is served when its thumbnail also correlates with
+    the photo's, since the cache is shared by all users.
+    """
+
+    def __init__(
+        self,
+        max_distance: int = IMAGE_CACHE_MAX_HAMMING_DISTANCE,
+        min_correlation: float = IMAGE_CACHE_MIN_CORRELATION,
+        ttl_sec: float = IMAGE_CACHE_TTL_SEC,
+        max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+    ):
+        self.max_distance = max_distance
+        self.min_correlation = min_correlation
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        # hash int -> (stored_at, thumbnail, solution)
+        self._entries: "OrderedDict[int, Tuple[float, bytes, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def get(self, image_hash: str) -> Optional[Dict[str, Any]]:
+        parsed = _parse_image_hash(image_hash)
+        if parsed is None:
+            self.misses += 1
+            return None
+        key, thumbnail = parsed
+        now = time.monotonic()
+        candidates = []
+        expired = []
+        for cached_key, (stored_at, _, _) in self._entries.items():
+            if now - stored_at > self.ttl_sec:
+                expired.append(cached_key)
+                continue
+            distance = (cached_key ^ key).bit_count()
+            if distance <= self.max_distance:
+                candidates.append((distance, cached_key))
+        for cached_key in expired:
+            del self._entries[cached_key]
+            self.evictions += 1
+        for _, cached_key in sorted(candidates):
+            _, cached_thumbnail, solution = self._entries[cached_key]
+            if _thumbnail_correlation(thumbnail, cached_thumbnail) < self.min_correlation:
+                # A different page that happens to hash close by
+                self.rejected += 1
+                continue
+            self._entries.move_to_end(cached_key)
+            self.hits += 1
+            return solution
+        self.misses += 1
+        return None
+
+    def put(self, image_hash: str, solution: Dict[str, Any]) -> None:
+        parsed = _parse_image_hash(image_hash)
+        if parsed is None:
+            return
+        key, thumbnail = parsed
+        self._entries[key] = (time.monotonic(), thumbnail, solution)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def record_db_hit(self, image_hash: str, solution: Dict[str, Any]) -> None:
+        # A memory miss that was answered by the persistent index
+        self.db_hits += 1
+        self.put(image_hash, solution)
+
+    async def warm(self, db) -> int:
+        """
+        Load the most recent hashed solutions from the `tasks` table.
+        Args:
+            db (SupabaseService): database service
+        Returns:
+            int: number of loaded entries
+        """
+        response = await db.get_hashed_solutions(limit=self.max_entries)
+        if response.get("status_code") != 200:
+            print("Failed to warm image cache", response)
+            return 0
+        # Rows come newest first; insert oldest first to keep LRU order
+        for row in reversed(response["message"]):
+            if row.get("image_hash") and row.get("solution"):
+                self.put(row["image_hash"], row["solution"])
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "db_hits": self.db_hits,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.db_hits) / lookups if lookups else 0.0,
+            "max_distance": self.max_distance,
+            "min_correlation": self.min_correlation,
+        }
+
+
+def solution_key(solution: Dict[str, Any]) -> str:
+    """Stable key of a solution dict, independent of key order."""
+    canonical = json.dumps(solution, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SentSolutionCache:
+    """
+    Telegram file_ids of rendered solution PNGs, by solution_key. Once a
+    solution has been sent, sending it again reuses the uploaded photo
+    instead of rendering and uploading the PNG again.
+    """
+
+    def __init__(self, max_entries: int = SENT_SOLUTION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        file_id = self._entries.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return file_id
+
+    def put(self, key: str, file_id: str) -> None:
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UserSolutionCache:
+    """
+    Recent get_exist_solution results: an LRU of users, each holding an LRU
+    of their latest file paths. Kept current by the solution inserts, so
+    re-showing a recent solution doesn't query the database.
+    """
+
+    def __init__(
+        self,
+        max_users: int = USER_SOLUTION_CACHE_MAX_USERS,
+        per_user: int = USER_SOLUTION_CACHE_PER_USER,
+    ):
+        self.max_users = max_users
+        self.per_user = per_user
+        # user_id -> file_path -> [{"solution": ...}, ...] as the query returns them
+        self._users: "OrderedDict[str, OrderedDict[str, List[Dict[str, Any]]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str, file_path: str) -> Optional[List[Dict[str, Any]]]:
+        paths = self._users.get(str(user_id))
+        if paths is None or file_path not in paths:
+            self.misses += 1
+            return None
+        self._users.move_to_end(str(user_id))
+        paths.move_to_end(file_path)
+        self.hits += 1
+        return paths[file_path]
+
+    def put(self, user_id: str, file_path: str, rows: List[Dict[str, Any]]) -> None:
+        user_id = str(user_id)
+        paths = self._users.setdefault(user_id, OrderedDict())
+        self._users.move_to_end(user_id)
+        paths[file_path] = rows
+        paths.move_to_end(file_path)
+        while len(paths) > self.per_user:
+            paths.popitem(last=False)
+            self.evictions += 1
+        while len(self._users) > self.max_users:
+            _, evicted = self._users.popitem(last=False)
+            self.evictions += len(evicted)
+
+    def add(self, user_id: str, file_path: str, solution: Dict[str, Any]) -> None:
+        """Record a newly inserted solution row."""
+        if not file_path:
+            # Text solutions all share file_path "", the cached list would
+            # only be complete if it was read from the database first
+            paths = self._users.get(str(user_id))
+            if paths is not None:
+                paths.pop(file_path, None)
+            return
+        paths = self._users.get(str(user_id))
+        rows = paths.get(file_path) if paths is not None else None
+        self.put(user_id, file_path, (rows or []) + [{"solution": solution}])
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "entries": sum(len(paths) for paths in self._users.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def normalize_query_text(text: str) -> str:
+    """
+    Canonicalize a typed problem so that copies differing only in casing,
+    whitespace (including spaces around operators and between a coefficient
+    and its variable), sentence punctuation or look-alike symbols compare
+    equal. Decimal separators and math operators are kept intact.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    for src, dst in _CHAR_REPLACEMENTS.items():
+        text = text.replace(src, dst)
+    text = _SENTENCE_PUNCTUATION_RE.sub(" ", text)
+    text = _WHITESPACE_RE.sub(" ", text).strip()
+    text = _OPERATOR_SPACE_RE.sub(r"\1", text)
+    return _COEFFICIENT_SPACE_RE.sub("", text)
+
+
+def hash_query_text(canonical: str) -> str:
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _math_signature(canonical: str) -> Tuple[str, ...]:
+    # Numbers and operators must match exactly: "x+5=0" and "x+6=0" are
+    # near-identical strings but different problems.
+    return tuple(_MATH_TOKEN_RE.findall(canonical))
+
+
+def _word_signature(canonical: str) -> Tuple[str, ...]:
+    # Near-duplicates may differ in stopwords and punctuation only:
+    # "найдите длину" and "найдите квадрат длины" are different questions.
+    return tuple(w for w in _WORD_RE.findall(canonical) if w not in _STOPWORDS)
+
+
+def _minhash(canonical: str) -> Tuple[int, ...]:
+    if len(canonical) <= _SHINGLE_SIZE:
+        shingles = {canonical}
+    else:
+        shingles = {
+            canonical[i : i + _SHINGLE_SIZE]
+            for i in range(len(canonical) - _SHINGLE_SIZE + 1)
+        }
+    hashed = [
+        int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big")
+        for sh in shingles
+    ]
+    return tuple(
+        min((a * h + b) % _MERSENNE_PRIME for h in hashed)
+        for a, b in _MINHASH_PARAMS
+    )
+
+
+def _bands(signature: Tuple[int, ...]) -> List[Tuple[int, Tuple[int, ...]]]:
+    return [
+        (band, signature[band * _MINHASH_ROWS : (band + 1) * _MINHASH_ROWS])
+        for band in range(_MINHASH_BANDS)
+    ]
+
+
+@dataclass
+class _TextEntry:
+    signature: Tuple[int, ...]
+    math_signature: Tuple[str, ...]
+    word_signature: Tuple[str, ...]
+    solution: Dict[str, Any]
+    stored_at: float
+    latency: Optional[float]
+
+
+class TextSolutionCache:
+    """
+    Two-tier cache of text solutions.
+    Tier 1 is an exact lookup on the canonicalized query, tier 2 finds
+    near-duplicate candidates with MinHash over character shingles and an
+    LSH index, and serves one only if its numbers, operators and words
+    (stopwords aside) are the same.
+    """
+
+    def __init__(
+        self,
+        min_similarity: float = TEXT_CACHE_MIN_SIMILARITY,
+        ttl_sec: float = TEXT_CACHE_TTL_SEC,
+        max_entries: int = TEXT_CACHE_MAX_ENTRIES,
+    ):
+        self.min_similarity = min_similarity
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        # query hash -> entry
+        self._entries: "OrderedDict[str, _TextEntry]" = OrderedDict()
+        # (band, band values) -> query hashes
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], set] = {}
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.rejected = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.latency_saved_sec = 0.0
+        self._miss_latency_total = 0.0
+        self._miss_latency_count = 0
+
+    def get(self, canonical: str) -> Optional[Dict[str, Any]]:
+        key = hash_query_text(canonical)
+        entry = self._live_entry(key)
+        if entry is not None:
+            self.exact_hits += 1
+            return self._serve(key, entry)
+
+        signature = _minhash(canonical)
+        math_signature = _math_signature(canonical)
+        word_signature = _word_signature(canonical)
+        candidates = set()
+        for band in _bands(signature):
+            candidates.update(self._buckets.get(band, ()))
+        best_key, best_similarity = None, self.min_similarity
+        for candidate in candidates:
+            entry = self._live_entry(candidate)
+            if entry is None or entry.math_signature != math_signature:
+                continue
+            if entry.word_signature != word_signature:
+                self.rejected += 1
+                continue
+            similarity = sum(
+                x == y for x, y in zip(signature, entry.signature)
+            ) / _MINHASH_PERMUTATIONS
+            if similarity >= best_similarity:
+                best_key, best_similarity = candidate, similarity
+        if best_key is None:
+            self.misses += 1
+            return None
+        self.near_hits += 1
+        return self._serve(best_key, self._entries[best_key])
+
+    def put(
+        self,
+        canonical: str,
+        solution: Dict[str, Any],
+        latency: Optional[float] = None,
+    ) -> None:
+        key = hash_query_text(canonical)
+        if key in self._entries:
+            self._remove(key)
+        entry = _TextEntry(
+            signature=_minhash(canonical),
+            math_signature=_math_signature(canonical),
+            word_signature=_word_signature(canonical),
+            solution=solution,
+            stored_at=time.monotonic(),
+            latency=latency,
+        )
+        self._entries[key] = entry
+        for band in _bands(entry.signature):
+            self._buckets.setdefault(band, set()).add(key)
+        if latency is not None:
+            self._miss_latency_total += latency
+            self._miss_latency_count += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def record_db_hit(self, canonical: str, solution: Dict[str, Any]) -> None:
+        # A memory miss that was answered by the persistent index
+        self.db_hits += 1
+        self.latency_saved_sec += self._average_miss_latency()
+        self.put(canonical, solution)
+
+    async def warm(self, db) -> int:
+        """
+        Load the most recent text solutions from the `tasks` table.
+        Args:
+            db (SupabaseService): database service
+        Returns:
+            int: number of loaded entries
+        """
+        response = await db.get_text_solutions(limit=self.max_entries)
+        if response.get("status_code") != 200:
+            print("Failed to warm text cache", response)
+            return 0
+        for row in reversed(response["message"]):
+            if row.get("query_text") and row.get("solution"):
+                self.put(row["query_text"], row["solution"])
+        return len(self._entries)
+
+    def _live_entry(self, key: str) -> Optional[_TextEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.stored_at > self.ttl_sec:
+            self._remove(key)
+            self.evictions += 1
+            return None
+        return entry
+
+    def _serve(self, key: str, entry: _TextEntry) -> Dict[str, Any]:
+        self._entries.move_to_end(key)
+        self.latency_saved_sec += (
+            entry.latency if entry.latency is not None else self._average_miss_latency()
+        )
+        return entry.solution
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        for band in _bands(entry.signature):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _average_miss_latency(self) -> float:
+        if not self._miss_latency_count:
+            return 0.0
+        return self._miss_latency_total / self._miss_latency_count
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.near_hits + self.db_hits
+        lookups = self.exact_hits + self.near_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "rejected": self.rejected,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "latency_saved_sec": round(self.latency_saved_sec, 3),
+            "avg_miss_latency_sec": round(self._average_miss_latency(), 3),
+        }
@@ -0,0 +1,10 @@
+-- Perceptual image hash of solved photos, used by ImageSolutionCache
+alter table tasks add column if not exists image_hash text;
+alter table tasks add column if not exists created_at timestamptz not null default now();
+
+create index if not exists tasks_image_hash_idx
+    on tasks (image_hash)
+    where image_hash is not null;
+create index if not exists tasks_image_hash_created_at_idx
+    on tasks (created_at desc)
+    where image_hash is not null;
@@ -0,0 +1,10 @@
+-- Canonicalized text query of typed problems, used by TextSolutionCache
+alter table tasks add column if not exists query_text text;
+alter table tasks add column if not exists query_hash text;
+
+create index if not exists tasks_query_hash_idx
+    on tasks (query_hash)
+    where query_hash is not null;
+create index if not exists tasks_query_created_at_idx
+    on tasks (created_at desc)
+    where query_hash is not null;
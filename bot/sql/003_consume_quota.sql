@@ -0,0 +1,48 @@
+-- Atomic check-and-decrement of a user's quota, called via RPC from
+-- SupabaseService.consume_quota. Mirrors the old proceed_processing logic:
+-- the daily limit resets lazily when last_processing_date is not today,
+-- daily solutions are spent first, then donated (subscription) ones.
+create or replace function consume_quota(
+    p_user_id users_status.user_id%type,
+    p_today date,
+    p_default_daily_limit integer
+)
+returns table (allowed boolean, daily_limit integer, subscription_limit integer)
+language plpgsql
+as $$
+declare
+    v_daily integer;
+    v_subscription integer;
+    v_last date;
+begin
+    select s.daily_limit, s.subscription_limit, s.last_processing_date
+      into v_daily, v_subscription, v_last
+      from users_status s
+     where s.user_id = p_user_id
+       for update;
+
+    if not found then
+        return;
+    end if;
+
+    if v_last is distinct from p_today then
+        v_daily := p_default_daily_limit;
+    end if;
+
+    if v_daily > 0 then
+        v_daily := v_daily - 1;
+        update users_status s
+           set daily_limit = v_daily, last_processing_date = p_today
+         where s.user_id = p_user_id;
+        return query select true, v_daily, v_subscription;
+    elsif v_subscription > 0 then
+        v_subscription := v_subscription - 1;
+        update users_status s
+           set subscription_limit = v_subscription
+         where s.user_id = p_user_id;
+        return query select true, v_daily, v_subscription;
+    else
+        return query select false, v_daily, v_subscription;
+    end if;
+end;
+$$;
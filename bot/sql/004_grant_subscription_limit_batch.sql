@@ -0,0 +1,29 @@
+-- Set-based subscription grant for add_subscription_limits_for_all_users.
+-- Processes one keyset page of users_status per call, so a grant over all
+-- users is a short series of independent transactions that can be resumed
+-- from the returned last_user_id.
+create or replace function grant_subscription_limit_batch(
+    p_increment integer,
+    p_after_user_id users_status.user_id%type,
+    p_batch_size integer
+)
+returns table (updated integer, last_user_id users_status.user_id%type)
+language sql
+as $$
+    with batch as (
+        select s.user_id
+          from users_status s
+         where p_after_user_id is null or s.user_id > p_after_user_id
+         order by s.user_id
+         limit p_batch_size
+           for update
+    ),
+    granted as (
+        update users_status s
+           set subscription_limit = s.subscription_limit + p_increment
+          from batch
+         where s.user_id = batch.user_id
+     returning s.user_id
+    )
+    select count(*)::integer, max(granted.user_id) from granted;
+$$;
@@ -0,0 +1,28 @@
+-- Batched last_processing_image_path update for the write-behind queue.
+-- p_updates is a json array of {"user_id": ..., "image_path": ...}; rows
+-- are updated in user_id order so concurrent batches can't deadlock.
+create or replace function set_last_processing_image_paths(p_updates jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    v_item jsonb;
+    v_user_id users_status.user_id%type;
+    v_updated integer := 0;
+begin
+    for v_item in
+        select value
+          from jsonb_array_elements(p_updates)
+         order by value->>'user_id'
+    loop
+        v_user_id := v_item->>'user_id';
+        update users_status
+           set last_processing_image_path = v_item->>'image_path'
+         where user_id = v_user_id;
+        if found then
+            v_updated := v_updated + 1;
+        end if;
+    end loop;
+    return v_updated;
+end;
+$$;
@@ -0,0 +1,3 @@
+-- Covers SupabaseService.get_exist_solution (user_id = ? and file_path = ?)
+create index if not exists tasks_user_id_file_path_idx
+    on tasks (user_id, file_path);
@@ -0,0 +1,3 @@
+-- Content-addressed storage object of a task photo (UploadPipeline.object_path);
+-- file_path keeps the bot's <user_id>/<file name> used by get_exist_solution
+alter table tasks add column if not exists object_path text;
@@ -0,0 +1,508 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from functools import partial, wraps
+from typing import Any, AsyncIterator, Callable, Dict, Union
+
+from bot.balance_cache import BalanceCache
+from bot.solution_cache import UserSolutionCache
+from bot.constants import (
+    SUB_FOLDER,
+    DEFAULT_DAILY_LIMIT,
+    SQLITE_IO_WORKERS,
+    SQLITE_BUSY_TIMEOUT_SEC,
+    USER_IDS_PAGE_SIZE,
+    BULK_GRANT_BATCH_SIZE,
+)
+
+# Mirrors the Supabase tables plus the indexes from bot/sql
+_SCHEMA = """
+create table if not exists users (
+    user_id text primary key,
+    data text not null
+);
+create table if not exists users_status (
+    user_id text primary key references users (user_id),
+    last_processing_date text,
+    last_processing_image_path text,
+    daily_limit integer not null,
+    subscription_limit integer not null default 0
+);
+create table if not exists tasks (
+    id integer primary key autoincrement,
+    user_id text not null,
+    file_path text not null,
+    solution text not null,
+    image_hash text,
+    query_text text,
+    query_hash text,
+    object_path text,
+    created_at text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+);
+create index if not exists tasks_image_hash_idx
+    on tasks (image_hash) where image_hash is not null;
+create index if not exists tasks_image_hash_created_at_idx
+    on tasks (created_at desc) where image_hash is not null;
+create index if not exists tasks_query_hash_idx
+    on tasks (query_hash) where query_hash is not null;
+create index if not exists tasks_query_created_at_idx
+    on tasks (created_at desc) where query_hash is not null;
+create index if not exists tasks_user_id_file_path_idx
+    on tasks (user_id, file_path);
+"""
+
+
+def safe_result(func: Callable):
+    """
+    Same contract as supabase_service.auth_retry: errors come back as the
+    standardized failure dict instead of being raised.
+    """
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await func(self, *args, **kwargs)
+        except Exception as e:
+            return {
+                "message": f"{func.__name__} failed",
+                "status_code": 400,
+                "error": str(e),
+            }
+    return wrapper
+
+
+class SQLiteService:
+    """
+    Drop-in replacement for SupabaseService backed by a local SQLite file
+    and a storage directory, for running and load-testing the app without
+    a Supabase project. Select it with DB_BACKEND=sqlite.
+    Queries run on a thread pool with one connection per thread; the
+    database is in WAL mode so reads don't block on writes.
+    """
+
+    def __init__(self, db_path: str, storage_dir: str):
+        self.db_path = db_path
+        self.storage_dir = storage_dir
+        self._executor = ThreadPoolExecutor(
+            max_workers=SQLITE_IO_WORKERS, thread_name_prefix="sqlite-io"
+        )
+        self._local = threading.local()
+        self.balance_cache = BalanceCache()
+        self.solution_cache = UserSolutionCache()
+        with self._connection() as connection:
+            connection.execute("pragma journal_mode=wal")
+            connection.executescript(_SCHEMA)
+            columns = {row[1] for row in connection.execute("pragma table_info(tasks)")}
+            if "object_path" not in columns:
+                # Databases created before bot/sql/007_tasks_object_path.sql
+                connection.execute("alter table tasks add column object_path text")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_path,
+                timeout=SQLITE_BUSY_TIMEOUT_SEC,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("pragma foreign_keys=on")
+            self._local.connection = connection
+        return connection
+
+    def start_background_tasks(self) -> None:
+        pass
+
+    async def stop_background_tasks(self) -> None:
+        pass
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    def _query(self, sql: str, params=()) -> list:
+        rows = self._connection().execute(sql, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def _transaction(self, func: Callable, *args) -> Any:
+        # begin immediate takes the write lock up front, like select ... for update
+        connection = self._connection()
+        connection.execute("begin immediate")
+        try:
+            result = func(connection, *args)
+        except BaseException:
+            connection.execute("rollback")
+            raise
+        connection.execute("commit")
+        return result
+
+    async def _fetch(self, sql: str, params=()) -> list:
+        return await self._run(self._query, sql, params)
+
+    async def _write(self, func: Callable, *args) -> Any:
+        return await self._run(self._transaction, func, *args)
+
+    @safe_result
+    async def upload_file(
+        self, file_path: str, file_bytes: bytes, content_type: str | None = None
+    ) -> Dict[str, Union[str, int]]:
+        path = os.path.join(self.storage_dir, f"{SUB_FOLDER}{file_path}".lstrip("/"))
+        await self._run(self._store_file, path, file_bytes)
+        return {"message": "File uploaded successfully", "status_code": 200}
+
+    @staticmethod
+    def _store_file(path: str, file_bytes: bytes) -> None:
+        if os.path.exists(path):
+            # Same answer Supabase storage gives for an existing object
+            raise Exception("Duplicate: The resource already exists")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            file.write(file_bytes)
+        os.replace(tmp_path, path)
+
+    @safe_result
+    async def add_new_user(self, user_data: dict) -> Dict[str, Union[str, int]]:
+        user_id = str(user_data.get("user_id"))
+        inserted = await self._write(self._insert_user, user_id, user_data)
+        if not inserted:
+            return {"message": "User already exists", "status_code": 200}
+        return {"message": "User added successfully", "status_code": 200}
+
+    @staticmethod
+    def _insert_user(connection, user_id: str, user_data: dict) -> bool:
+        cursor = connection.execute(
+            "insert or ignore into users (user_id, data) values (?, ?)",
+            (user_id, json.dumps(user_data)),
+        )
+        if not cursor.rowcount:
+            return False
+        connection.execute(
+            "insert into users_status (user_id, last_processing_date, daily_limit, subscription_limit)"
+            " values (?, null, ?, 0)",
+            (user_id, DEFAULT_DAILY_LIMIT),
+        )
+        return True
+
+    async def is_exist(self, user_id: str) -> bool:
+        rows = await self._fetch(
+            "select user_id from users where user_id = ?", (str(user_id),)
+        )
+        return len(rows) > 0
+
+    @safe_result
+    async def consume_quota(self, user_id: str) -> Dict[str, Any]:
+        """Python port of the consume_quota function in bot/sql."""
+        row = await self._write(
+            self._consume_quota, str(user_id), date.today().isoformat()
+        )
+        if row is None:
+            return {"message": "User not found", "status_code": 404}
+        self.balance_cache.put(
+            user_id,
+            {
+                "daily_limit": row["daily_limit"],
+                "subscription_limit": row["subscription_limit"],
+                "last_processing_date": date.today().isoformat(),
+            },
+        )
+        return {"message": [row], "status_code": 200}
+
+    @staticmethod
+    def _consume_quota(connection, user_id: str, today: str) -> Dict[str, Any] | None:
+        status = connection.execute(
+            "select daily_limit, subscription_limit, last_processing_date"
+            " from users_status where user_id = ?",
+            (user_id,),
+        ).fetchone()
+        if status is None:
+            return None
+        daily = status["daily_limit"]
+        subscription = status["subscription_limit"]
+        if status["last_processing_date"] != today:
+            daily = DEFAULT_DAILY_LIMIT
+        if daily > 0:
+            daily -= 1
+            connection.execute(
+                "update users_status set daily_limit = ?, last_processing_date = ?"
+                " where user_id = ?",
+                (daily, today, user_id),
+            )
+            allowed = True
+        elif subscription > 0:
+            subscription -= 1
+            connection.execute(
+                "update users_status set subscription_limit = ? where user_id = ?",
+                (subscription, user_id),
+            )
+            allowed = True
+        else:
+            allowed = False
+        return {"allowed": allowed, "daily_limit": daily, "subscription_limit": subscription}
+
+    async def proceed_processing(self, user_id: str) -> bool:
+        quota = await self.consume_quota(user_id)
+        if quota.get("status_code") != 200:
+            print("Failed to proceed processing", quota)
+            return False
+        return quota["message"][0]["allowed"]
+
+    @safe_result
+    async def get_current_balance(self, user_id: str) -> Dict[str, Any]:
+        cached = self.balance_cache.get(user_id)
+        if cached is not None:
+            return {"message": [cached], "status_code": 200}
+        rows = await self._fetch(
+            "select daily_limit, subscription_limit, last_processing_date"
+            " from users_status where user_id = ?",
+            (str(user_id),),
+        )
+        if not rows:
+            return {"message": "User not found", "status_code": 404}
+        row = rows[0]
+        self.balance_cache.put(user_id, row)
+        if row.get("last_processing_date") != date.today().isoformat():
+            row["daily_limit"] = DEFAULT_DAILY_LIMIT
+        return {
+            "message": [
+                {
+                    "daily_limit": row["daily_limit"],
+                    "subscription_limit": row["subscription_limit"],
+                }
+            ],
+            "status_code": 200,
+        }
+
+    @safe_result
+    async def update_last_processing_image_path(self, user_id: str, image_path: str) -> Dict[str, Union[str, int]]:
+        await self._set_image_paths([{"user_id": user_id, "image_path": image_path}])
+        return {"message": "Last processing image path updated", "status_code": 200}
+
+    @safe_result
+    async def set_last_processing_image_paths(self, updates: list) -> Dict[str, Union[str, int]]:
+        await self._set_image_paths(updates)
+        return {"message": len(updates), "status_code": 200}
+
+    async def _set_image_paths(self, updates: list) -> None:
+        # user_id order, as in the set_last_processing_image_paths function
+        params = sorted(((str(u["user_id"]), u["image_path"]) for u in updates))
+        await self._write(
+            lambda connection: connection.executemany(
+                "update users_status set last_processing_image_path = ? where user_id = ?",
+                [(image_path, user_id) for user_id, image_path in params],
+            )
+        )
+
+    @safe_result
+    async def insert_solution(
+        self,
+        user_id: str,
+        file_path: str,
+        solution: dict,
+        image_hash: str | None = None,
+        query_text: str | None = None,
+        query_hash: str | None = None,
+        object_path: str | None = None,
+    ) -> Dict[str, Union[str, int]]:
+        await self._insert_solutions(
+            [
+                {
+                    "user_id": user_id,
+                    "file_path": file_path,
+                    "solution": solution,
+                    "image_hash": image_hash,
+                    "query_text": query_text,
+                    "query_hash": query_hash,
+                    "object_path": object_path,
+                }
+            ]
+        )
+        return {"message": "Solution inserted successfully", "status_code": 200}
+
+    @safe_result
+    async def insert_solutions(self, solutions: list) -> Dict[str, Union[str, int]]:
+        await self._insert_solutions(solutions)
+        return {"message": f"{len(solutions)} solutions inserted", "status_code": 200}
+
+    async def _insert_solutions(self, solutions: list) -> None:
+        rows = []
+        for solution in solutions:
+            has_query = bool(solution.get("query_text") and solution.get("query_hash"))
+            rows.append(
+                (
+                    str(solution["user_id"]),
+                    solution["file_path"],
+                    json.dumps(solution["solution"], ensure_ascii=False),
+                    solution.get("image_hash") or None,
+                    solution["query_text"] if has_query else None,
+                    solution["query_hash"] if has_query else None,
+                    solution.get("object_path") or None,
+                )
+            )
+        await self._write(
+            lambda connection: connection.executemany(
+                "insert into tasks"
+                " (user_id, file_path, solution, image_hash, query_text, query_hash, object_path)"
+                " values (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        )
+        for solution in solutions:
+            self.solution_cache.add(
+                solution["user_id"], solution["file_path"], solution["solution"]
+            )
+
+    async def _first_solution(self, column: str, value: str) -> Dict[str, Any]:
+        rows = await self._fetch(
+            f"select solution from tasks where {column} = ? limit 1", (value,)
+        )
+        solution = json.loads(rows[0]["solution"]) if rows else None
+        return {"message": solution, "status_code": 200}
+
+    @safe_result
+    async def get_solution_by_image_hash(self, image_hash: str) -> Dict[str, Any]:
+        return await self._first_solution("image_hash", image_hash)
+
+    @safe_result
+    async def get_solution_by_query_hash(self, query_hash: str) -> Dict[str, Any]:
+        return await self._first_solution("query_hash", query_hash)
+
+    async def _recent_solutions(self, key_column: str, select: str, limit: int) -> Dict[str, Any]:
+        rows = await self._fetch(
+            f"select {select}, solution from tasks where {key_column} is not null"
+            " order by created_at desc limit ?",
+            (limit,),
+        )
+        for row in rows:
+            row["solution"] = json.loads(row["solution"])
+        return {"message": rows, "status_code": 200}
+
+    @safe_result
+    async def get_text_solutions(self, limit: int) -> Dict[str, Any]:
+        return await self._recent_solutions("query_hash", "query_text", limit)
+
+    @safe_result
+    async def get_hashed_solutions(self, limit: int) -> Dict[str, Any]:
+        return await self._recent_solutions("image_hash", "image_hash", limit)
+
+    @safe_result
+    async def get_exist_solution(self, user_id: str, file_path: str) -> Dict[str, Union[str, int]]:
+        cached = self.solution_cache.get(user_id, file_path)
+        if cached is not None:
+            return {"message": cached, "status_code": 200}
+        rows = await self._fetch(
+            "select solution from tasks where user_id = ? and file_path = ?",
+            (str(user_id), file_path),
+        )
+        solutions = [{"solution": json.loads(row["solution"])} for row in rows]
+        self.solution_cache.put(user_id, file_path, solutions)
+        return {"message": solutions, "status_code": 200}
+
+    @safe_result
+    async def add_subscription_limit(self, user_id: str, subscription_limit: int = 1) -> Dict[str, Union[str, int]]:
+        row = await self._write(self._add_subscription_limit, str(user_id), subscription_limit)
+        if row is None:
+            return {"message": "User not found", "status_code": 404}
+        self.balance_cache.put(user_id, row)
+        return {"message": "Subscription updated successfully", "status_code": 200}
+
+    @staticmethod
+    def _add_subscription_limit(connection, user_id: str, amount: int) -> Dict[str, Any] | None:
+        connection.execute(
+            "update users_status set subscription_limit = subscription_limit + ?"
+            " where user_id = ?",
+            (amount, user_id),
+        )
+        row = connection.execute(
+            "select daily_limit, subscription_limit, last_processing_date"
+            " from users_status where user_id = ?",
+            (user_id,),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    async def iter_user_ids(
+        self, page_size: int = USER_IDS_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        cursor = None
+        while True:
+            if cursor is None:
+                page = await self._fetch(
+                    "select user_id from users order by user_id limit ?", (page_size,)
+                )
+            else:
+                page = await self._fetch(
+                    "select user_id from users where user_id > ? order by user_id limit ?",
+                    (cursor, page_size),
+                )
+            for row in page:
+                yield row
+            if len(page) < page_size:
+                return
+            cursor = page[-1]["user_id"]
+
+    @safe_result
+    async def get_all_user_ids(self) -> Dict[str, Union[str, int]]:
+        users = [row async for row in self.iter_user_ids()]
+        return {"message": users, "status_code": 200}
+
+    async def add_subscription_limits_for_all_users(
+        self,
+        subscription_limit: int,
+        resume_after=None,
+        batch_size: int = BULK_GRANT_BATCH_SIZE,
+    ) -> Dict[str, Any]:
+        updated = 0
+        batches = 0
+        cursor = resume_after
+        status_code = 200
+        while True:
+            try:
+                count, last_user_id = await self._write(
+                    self._grant_subscription_limit_batch,
+                    int(subscription_limit),
+                    cursor,
+                    batch_size,
+                )
+            except Exception as e:
+                print("Bulk grant failed after", cursor, str(e))
+                status_code = 400
+                break
+            if not count:
+                break
+            updated += count
+            batches += 1
+            cursor = last_user_id
+        self.balance_cache.invalidate()
+        return {
+            "message": {
+                "updated": updated,
+                "batches": batches,
+                "last_user_id": cursor,
+                "completed": status_code == 200,
+            },
+            "status_code": status_code,
+        }
+
+    @staticmethod
+    def _grant_subscription_limit_batch(connection, increment: int, after_user_id, batch_size: int):
+        user_ids = [
+            row["user_id"]
+            for row in connection.execute(
+                "select user_id from users_status where ? is null or user_id > ?"
+                " order by user_id limit ?",
+                (after_user_id, after_user_id, batch_size),
+            )
+        ]
+        connection.executemany(
+            "update users_status set subscription_limit = subscription_limit + ?"
+            " where user_id = ?",
+            [(increment, user_id) for user_id in user_ids],
+        )
+        return len(user_ids), user_ids[-1] if user_ids else None
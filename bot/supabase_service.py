@@ -1,10 +1,26 @@
+import asyncio
 import inspect
-from functools import wraps
-from typing import Dict, Union, Callable, Any
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Dict, Union, Callable, Any, AsyncIterator
 from datetime import date, datetime, timedelta, UTC
 from supabase import create_client, Client
 
-from bot.constants import SUB_FOLDER, DEFAULT_DAILY_LIMIT
+from bot.balance_cache import BalanceCache
+from bot.solution_cache import UserSolutionCache
+from bot.constants import (
+    SUB_FOLDER,
+    DEFAULT_DAILY_LIMIT,
+    SUPABASE_IO_WORKERS,
+    BALANCE_RECONCILE_INTERVAL_SEC,
+    BALANCE_RECONCILE_BATCH_SIZE,
+    SESSION_REFRESH_MARGIN_SEC,
+    SESSION_REFRESH_RETRY_SEC,
+    BULK_GRANT_BATCH_SIZE,
+    USER_IDS_PAGE_SIZE,
+)
 
 def _utcnow() -> datetime:
     return datetime.now(UTC)
@@ -31,12 +47,13 @@ def auth_retry(max_retries: int = 1):
             @wraps(func)
             async def async_wrapper(self, *args, **kwargs):
                 for attempt in range(max_retries + 1):
-                    self._ensure_session()
+                    if not self._session_valid():
+                        await self._run(self._ensure_session)
                     try:
                         return await func(self, *args, **kwargs)
                     except Exception as e:
                         if attempt < max_retries and _is_auth_error(e):
-                            self._login()
+                            await self._run(self._login)
                             continue
                         return {
                             "message": f"{func.__name__} failed",
@@ -68,6 +85,11 @@ class SupabaseService:
         self, supabase_url: str, supabase_key: str, user_email: str, user_password: str
     ):
         self.supabase_client: Client = create_client(supabase_url, supabase_key)
+        # supabase-py is synchronous; every call runs on this bounded pool so
+        # the event loop keeps serving other requests
+        self._executor = ThreadPoolExecutor(
+            max_workers=SUPABASE_IO_WORKERS, thread_name_prefix="supabase-io"
+        )
         self.bucket_name: str = "tasks"
         self._users_table = "users"
         self._users_status_table = "users_status"
@@ -75,33 +97,125 @@ class SupabaseService:
         self._email = user_email
         self._password = user_password
         self._session_expiry: datetime | None = None
+        self._session_lock = threading.Lock()
+        self.balance_cache = BalanceCache()
+        self.solution_cache = UserSolutionCache()
+        self._reconcile_task: asyncio.Task | None = None
+        self._session_task: asyncio.Task | None = None
         self._login()
 
-    def _login(self):
-        auth_resp = self.supabase_client.auth.sign_in_with_password(
-            {"email": self._email, "password": self._password}
-        )
+    def _set_session_expiry(self, auth_resp) -> None:
         try:
             expires_in = auth_resp.session.expires_in
             self._session_expiry = _utcnow() + timedelta(seconds=expires_in - 30)
         except Exception:
             self._session_expiry = None
 
+    def _login(self):
+        auth_resp = self.supabase_client.auth.sign_in_with_password(
+            {"email": self._email, "password": self._password}
+        )
+        self._set_session_expiry(auth_resp)
+
+    def _session_valid(self) -> bool:
+        return bool(self._session_expiry and _utcnow() < self._session_expiry)
+
+    def _refresh_session(self, force: bool = False):
+        # Runs on the I/O pool; only one thread refreshes at a time.
+        # The client replaces its tokens and auth headers in one step, so
+        # concurrent requests see either the old or the new session.
+        with self._session_lock:
+            if not force and self._session_valid():
+                return
+            try:
+                self._set_session_expiry(self.supabase_client.auth.refresh_session())
+            except Exception:
+                self._login()
+
     def _ensure_session(self):
-        if self._session_expiry and _utcnow() < self._session_expiry:
-            return
-        try:
-            self.supabase_client.auth.refresh_session()
-            self._session_expiry = _utcnow() + timedelta(minutes=5)
-        except Exception:
-            self._login()
+        # Fallback for when the background refresher is late or not running
+        self._refresh_session()
+
+    def _seconds_until_refresh(self) -> float:
+        if self._session_expiry is None:
+            return 0.0
+        remaining = (self._session_expiry - _utcnow()).total_seconds()
+        # Short-lived tokens are renewed at half their remaining lifetime
+        return max(0.0, remaining - min(SESSION_REFRESH_MARGIN_SEC, remaining / 2))
+
+    async def _refresh_session_loop(self) -> None:
+        """Renew the token SESSION_REFRESH_MARGIN_SEC before it expires."""
+        while True:
+            await asyncio.sleep(self._seconds_until_refresh())
+            try:
+                await self._run(self._refresh_session, force=True)
+            except Exception as e:
+                print("Session refresh failed", str(e))
+            if not self._session_valid():
+                await asyncio.sleep(SESSION_REFRESH_RETRY_SEC)
+
+    def start_background_tasks(self) -> None:
+        if self._reconcile_task is None:
+            self._reconcile_task = asyncio.create_task(self._reconcile_balances())
+        if self._session_task is None:
+            self._session_task = asyncio.create_task(self._refresh_session_loop())
+
+    async def stop_background_tasks(self) -> None:
+        tasks = [t for t in (self._reconcile_task, self._session_task) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._reconcile_task = None
+        self._session_task = None
+
+    async def _reconcile_balances(self) -> None:
+        """Re-read cached balances that are getting old, in batches."""
+        while True:
+            await asyncio.sleep(BALANCE_RECONCILE_INTERVAL_SEC)
+            user_ids = self.balance_cache.stale_user_ids(
+                older_than_sec=self.balance_cache.ttl_sec / 2,
+                limit=BALANCE_RECONCILE_BATCH_SIZE,
+            )
+            if not user_ids:
+                continue
+            fetched_at = time.monotonic()
+            response = await self._fetch_balances(user_ids)
+            if response.get("status_code") != 200:
+                print("Balance reconciliation failed", response)
+                continue
+            try:
+                self.balance_cache.reconcile(response["message"], fetched_at)
+            except Exception as e:
+                print("Balance reconciliation failed", str(e))
 
-    # TODO: Implement the async upload_file method
     @auth_retry()
-    async def upload_file(self, file_path: str, file_bytes: bytes) -> Dict[str, Union[str, int]]:
+    async def _fetch_balances(self, user_ids: list) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.table(self._users_status_table)
+            .select("user_id", "daily_limit", "subscription_limit", "last_processing_date")
+            .in_("user_id", user_ids)
+        )
+        return {"message": response.data, "status_code": 200}
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs)
+        )
+
+    async def _execute(self, query) -> Any:
+        return await self._run(query.execute)
+
+    @auth_retry()
+    async def upload_file(
+        self, file_path: str, file_bytes: bytes, content_type: str | None = None
+    ) -> Dict[str, Union[str, int]]:
         supabase_path = f"{SUB_FOLDER}{file_path}"
-        self.supabase_client.storage.from_(self.bucket_name).upload(
-            path=supabase_path, file=file_bytes
+        await self._run(
+            self.supabase_client.storage.from_(self.bucket_name).upload,
+            path=supabase_path,
+            file=file_bytes,
+            file_options={"content-type": content_type} if content_type else None,
         )
         return {"message": "File uploaded successfully", "status_code": 200}
 
@@ -110,90 +224,91 @@ class SupabaseService:
         user_id = user_data.get("user_id")
         if await self.is_exist(user_id):
             return {"message": "User already exists", "status_code": 200}
-        self.supabase_client.table(self._users_table).insert(user_data).execute()
-        self.supabase_client.table(self._users_status_table).insert(
-            {
-                "user_id": user_id,
-                "last_processing_date": None,
-                "daily_limit": DEFAULT_DAILY_LIMIT,
-                "subscription_limit": 0,
-            }
-        ).execute()
+        await self._execute(
+            self.supabase_client.table(self._users_table).insert(user_data)
+        )
+        await self._execute(
+            self.supabase_client.table(self._users_status_table).insert(
+                {
+                    "user_id": user_id,
+                    "last_processing_date": None,
+                    "daily_limit": DEFAULT_DAILY_LIMIT,
+                    "subscription_limit": 0,
+                }
+            )
+        )
         return {"message": "User added successfully", "status_code": 200}
 
     @auth_retry()
     async def is_exist(self, user_id: str) -> bool:
         # Check if the user with the given user_id exists in the Supabase table
-        data = (
+        data = await self._execute(
             self.supabase_client.table(self._users_table)
             .select("user_id")
             .eq("user_id", user_id)
-            .execute()
         )
         print(data)
         print(data.data)
         return len(data.data) > 0
 
     @auth_retry()
-    async def _get_last_processing_date(self, user_id: str) -> Dict[str, Union[str, int]]:
-        response = (
-            self.supabase_client.table(self._users_status_table)
-            .select("last_processing_date")
-            .eq("user_id", user_id)
-            .execute()
+    async def consume_quota(self, user_id: str) -> Dict[str, Any]:
+        """
+        Atomically spend one solution from the user's quota (daily first,
+        then subscription) in a single round trip.
+        Returns:
+            Dict: {"message": [{"allowed", "daily_limit", "subscription_limit"}]}
+                with the balance after the call
+        """
+        response = await self._execute(
+            self.supabase_client.rpc(
+                "consume_quota",
+                {
+                    "p_user_id": user_id,
+                    "p_today": date.today().isoformat(),
+                    "p_default_daily_limit": DEFAULT_DAILY_LIMIT,
+                },
+            )
         )
-        val = response.data[0]["last_processing_date"] if response.data else None
-        return {"last_processing_date": val, "status_code": 200}
+        if not response.data:
+            return {"message": "User not found", "status_code": 404}
+        row = response.data[0]
+        self.balance_cache.put(
+            user_id,
+            {
+                "daily_limit": row["daily_limit"],
+                "subscription_limit": row["subscription_limit"],
+                # Any outcome leaves today's daily counter in effect
+                "last_processing_date": date.today().isoformat(),
+            },
+        )
+        return {"message": response.data, "status_code": 200}
 
-    @auth_retry()
-    async def proceed_processing(
-        self, user_id: str
-    ) -> Union[bool, Dict[str, Union[str, int]]]:
-        # Update the last processing date for the user with the given user_id
-        try:
-            balance = await self.get_current_balance(user_id)
-            user_limits = balance["message"][0]
-            print("User limits", user_limits)
-            if user_limits["daily_limit"] == 0:
-                print("Daily limit is exceeded")
-                if user_limits["subscription_limit"] > 0:
-                    await self._decrease_subscription_limit(
-                        user_id=user_id,
-                        subscription_limit=user_limits["subscription_limit"],
-                    )
-                    return True
-                else:
-                    last_processing_date = await self._get_last_processing_date(user_id)
-                    if (
-                        last_processing_date["last_processing_date"]
-                        == date.today().isoformat()
-                    ):
-                        print("Last processing date is today. Daily limit is exceeded")
-                        return False
-                    else:
-                        print("Daily limit is not exceeded")
-                        await self._decrease_daily_limit(user_id)
-                        return True
-            else:
-                print("Daily limit is not exceeded")
-                # TODO Uncomment the line below
-                await self._decrease_daily_limit(user_id)
-                return True
-        except Exception as e:
-            print("Failed to proceed processing", str(e))
+    async def proceed_processing(self, user_id: str) -> bool:
+        quota = await self.consume_quota(user_id)
+        if quota.get("status_code") != 200:
+            print("Failed to proceed processing", quota)
             return False
+        user_limits = quota["message"][0]
+        print("User limits", user_limits)
+        if not user_limits["allowed"]:
+            print("Daily limit is exceeded")
+        return user_limits["allowed"]
 
     @auth_retry()
     async def get_current_balance(self, user_id: str) -> Dict[str, Any]:
-        response = (
+        cached = self.balance_cache.get(user_id)
+        if cached is not None:
+            return {"message": [cached], "status_code": 200}
+        response = await self._execute(
             self.supabase_client.table(self._users_status_table)
             .select("daily_limit", "subscription_limit", "last_processing_date")
             .eq("user_id", user_id)
-            .execute()
         )
         if not response.data:
             return {"message": "User not found", "status_code": 404}
         row = response.data[0]
+        self.balance_cache.put(user_id, row)
         if row.get("last_processing_date") != date.today().isoformat():
             row["daily_limit"] = DEFAULT_DAILY_LIMIT
         return {
@@ -207,89 +322,252 @@ class SupabaseService:
         }
 
     @auth_retry()
-    async def _decrease_daily_limit(self, user_id: str) -> Dict[str, Union[str, int]]:
-        balance = await self.get_current_balance(user_id)
-        if balance.get("status_code") != 200:
-            return {"message": "Balance fetch failed", "status_code": 400}
-        data_list = balance.get("message")
-        if not isinstance(data_list, list) or not data_list:
-            return {"message": "Malformed balance data", "status_code": 400}
-        current = data_list[0].get("daily_limit")
-        if current is None:
-            return {"message": "daily_limit missing", "status_code": 400}
-        new_limit = max(0, current - 1)
-        today = date.today().isoformat()
-        self.supabase_client.table(self._users_status_table).update(
-            {"daily_limit": new_limit, "last_processing_date": today}
-        ).eq("user_id", user_id).execute()
-        return {"message": "Daily limit decreased", "status_code": 200}
+    async def update_last_processing_image_path(self, user_id: str, image_path: str) -> Dict[str, Union[str, int]]:
+        await self._execute(
+            self.supabase_client.table(self._users_status_table)
+            .update({"last_processing_image_path": image_path})
+            .eq("user_id", user_id)
+        )
+        return {"message": "Last processing image path updated", "status_code": 200}
 
-    @auth_retry()
-    async def _decrease_subscription_limit(self, user_id: str, subscription_limit: int) -> Dict[str, Union[str, int]]:
-        new_limit = max(0, subscription_limit - 1)
-        self.supabase_client.table(self._users_status_table).update(
-            {"subscription_limit": new_limit}
-        ).eq("user_id", user_id).execute()
-        return {"message": "Subscription limit decreased", "status_code": 200}
 
     @auth_retry()
-    async def update_last_processing_image_path(self, user_id: str, image_path: str) -> Dict[str, Union[str, int]]:
-        self.supabase_client.table(self._users_status_table).update(
-            {"last_processing_image_path": image_path}
-        ).eq("user_id", user_id).execute()
-        return {"message": "Last processing image path updated", "status_code": 200}
+    async def set_last_processing_image_paths(self, updates: list) -> Dict[str, Union[str, int]]:
+        """Batched update_last_processing_image_path, `updates` is a list of
+        {"user_id", "image_path"} dicts."""
+        response = await self._execute(
+            self.supabase_client.rpc(
+                "set_last_processing_image_paths", {"p_updates": updates}
+            )
+        )
+        return {"message": response.data, "status_code": 200}
 
+    @staticmethod
+    def _solution_row(
+        user_id: str,
+        file_path: str,
+        solution: dict,
+        image_hash: str | None = None,
+        query_text: str | None = None,
+        query_hash: str | None = None,
+        object_path: str | None = None,
+    ) -> Dict[str, Any]:
+        # Every row has every column so batches are a single bulk insert
+        has_query = bool(query_text and query_hash)
+        return {
+            "user_id": user_id,
+            "file_path": file_path,
+            "solution": solution,
+            "image_hash": image_hash or None,
+            "query_text": query_text if has_query else None,
+            "query_hash": query_hash if has_query else None,
+            "object_path": object_path or None,
+        }
 
     @auth_retry()
-    async def insert_solution(self, user_id: str, file_path: str, solution: dict) -> Dict[str, Union[str, int]]:
-        self.supabase_client.table(self._task_table).insert(
-            {"user_id": user_id, "file_path": file_path, "solution": solution}
-        ).execute()
+    async def insert_solution(
+        self,
+        user_id: str,
+        file_path: str,
+        solution: dict,
+        image_hash: str | None = None,
+        query_text: str | None = None,
+        query_hash: str | None = None,
+        object_path: str | None = None,
+    ) -> Dict[str, Union[str, int]]:
+        row = self._solution_row(
+            user_id, file_path, solution, image_hash, query_text, query_hash, object_path
+        )
+        await self._execute(self.supabase_client.table(self._task_table).insert(row))
+        self.solution_cache.add(user_id, file_path, solution)
         return {"message": "Solution inserted successfully", "status_code": 200}
 
+    @auth_retry()
+    async def insert_solutions(self, solutions: list) -> Dict[str, Union[str, int]]:
+        """Bulk insert_solution, `solutions` is a list of its keyword arguments."""
+        rows = [self._solution_row(**solution) for solution in solutions]
+        await self._execute(self.supabase_client.table(self._task_table).insert(rows))
+        for row in rows:
+            self.solution_cache.add(row["user_id"], row["file_path"], row["solution"])
+        return {"message": f"{len(rows)} solutions inserted", "status_code": 200}
+
+    @auth_retry()
+    async def get_solution_by_image_hash(self, image_hash: str) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.table(self._task_table)
+            .select("solution")
+            .eq("image_hash", image_hash)
+            .limit(1)
+        )
+        solution = response.data[0]["solution"] if response.data else None
+        return {"message": solution, "status_code": 200}
+
+    @auth_retry()
+    async def get_solution_by_query_hash(self, query_hash: str) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.table(self._task_table)
+            .select("solution")
+            .eq("query_hash", query_hash)
+            .limit(1)
+        )
+        solution = response.data[0]["solution"] if response.data else None
+        return {"message": solution, "status_code": 200}
+
+    @auth_retry()
+    async def get_text_solutions(self, limit: int) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.table(self._task_table)
+            .select("query_text", "solution")
+            .not_.is_("query_hash", "null")
+            .order("created_at", desc=True)
+            .limit(limit)
+        )
+        return {"message": response.data, "status_code": 200}
+
+    @auth_retry()
+    async def get_hashed_solutions(self, limit: int) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.table(self._task_table)
+            .select("image_hash", "solution")
+            .not_.is_("image_hash", "null")
+            .order("created_at", desc=True)
+            .limit(limit)
+        )
+        return {"message": response.data, "status_code": 200}
+
 
     @auth_retry()
     async def get_exist_solution(self, user_id: str, file_path: str) -> Dict[str, Union[str, int]]:
-        response = (
+        cached = self.solution_cache.get(user_id, file_path)
+        if cached is not None:
+            return {"message": cached, "status_code": 200}
+        # Served by tasks_user_id_file_path_idx
+        response = await self._execute(
             self.supabase_client.table(self._task_table)
             .select("solution")
             .eq("user_id", user_id)
             .eq("file_path", file_path)
-            .execute()
         )
+        self.solution_cache.put(user_id, file_path, response.data)
         return {"message": response.data, "status_code": 200}
 
     @auth_retry()
     async def add_subscription_limit(self, user_id: str, subscription_limit: int = 1) -> Dict[str, Union[str, int]]:
-        current = (
+        current = await self._execute(
             self.supabase_client.table(self._users_status_table)
             .select("subscription_limit")
             .eq("user_id", user_id)
-            .execute()
         )
         if not current.data:
             return {"message": "User not found", "status_code": 404}
         new_limit = current.data[0]["subscription_limit"] + subscription_limit
-        self.supabase_client.table(self._users_status_table).update(
-            {"subscription_limit": new_limit}
-        ).eq("user_id", user_id).execute()
+        updated = await self._execute(
+            self.supabase_client.table(self._users_status_table)
+            .update({"subscription_limit": new_limit})
+            .eq("user_id", user_id)
+        )
+        if updated.data:
+            self.balance_cache.put(user_id, updated.data[0])
+        else:
+            self.balance_cache.invalidate(user_id)
         return {"message": "Subscription updated successfully", "status_code": 200}
 
 
     @auth_retry()
-    async def get_all_user_ids(self) -> Dict[str, Union[str, int]]:
-        response = (
-            self.supabase_client.table(self._users_table)
-            .select("user_id")
-            .execute()
-        )
+    async def _get_user_ids_page(self, after_user_id, page_size: int) -> Dict[str, Any]:
+        query = self.supabase_client.table(self._users_table).select("user_id")
+        if after_user_id is not None:
+            query = query.gt("user_id", after_user_id)
+        response = await self._execute(query.order("user_id").limit(page_size))
         return {"message": response.data, "status_code": 200}
 
+    async def iter_user_ids(
+        self, page_size: int = USER_IDS_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield `{"user_id": ...}` rows of every user in user_id order.
+        Keyset pagination keeps each request small and is not affected by
+        the PostgREST max-rows cap.
+        Args:
+            page_size (int): rows per request
+        Returns:
+            AsyncIterator[Dict]: user rows
+        """
+        cursor = None
+        while True:
+            page = await self._get_user_ids_page(cursor, page_size)
+            if page.get("status_code") != 200:
+                raise Exception(f"Failed to read users after {cursor}: {page.get('error')}")
+            for row in page["message"]:
+                yield row
+            if len(page["message"]) < page_size:
+                return
+            cursor = page["message"][-1]["user_id"]
+
+    @auth_retry()
+    async def get_all_user_ids(self) -> Dict[str, Union[str, int]]:
+        users = [row async for row in self.iter_user_ids()]
+        return {"message": users, "status_code": 200}
+
     @auth_retry()
-    async def add_subscription_limits_for_all_users(self, subscription_limit: int) -> Dict[str, Union[str, int]]:
-        users = await self.get_all_user_ids()
-        if users.get("status_code") != 200:
-            return {"message": "Failed to fetch users", "status_code": 400}
-        for u in users["message"]:
-            await self.add_subscription_limit(u["user_id"], int(subscription_limit))
-        return {"message": users["message"], "status_code": 200}
+    async def _grant_subscription_limit_batch(
+        self, subscription_limit: int, after_user_id, batch_size: int
+    ) -> Dict[str, Any]:
+        response = await self._execute(
+            self.supabase_client.rpc(
+                "grant_subscription_limit_batch",
+                {
+                    "p_increment": subscription_limit,
+                    "p_after_user_id": after_user_id,
+                    "p_batch_size": batch_size,
+                },
+            )
+        )
+        return {"message": response.data[0], "status_code": 200}
+
+    async def add_subscription_limits_for_all_users(
+        self,
+        subscription_limit: int,
+        resume_after=None,
+        batch_size: int = BULK_GRANT_BATCH_SIZE,
+    ) -> Dict[str, Any]:
+        """
+        Grant `subscription_limit` extra solutions to every user, one
+        set-based batch per round trip.
+        Args:
+            subscription_limit (int): solutions to add per user
+            resume_after: last_user_id of an interrupted run to continue from
+            batch_size (int): users per batch
+        Returns:
+            Dict: counts and the cursor; on failure status_code is 400 and
+                message.last_user_id is where to resume
+        """
+        updated = 0
+        batches = 0
+        cursor = resume_after
+        while True:
+            batch = await self._grant_subscription_limit_batch(
+                int(subscription_limit), cursor, batch_size
+            )
+            if batch.get("status_code") != 200:
+                print("Bulk grant failed after", cursor, batch)
+                status_code = 400
+                break
+            if not batch["message"]["updated"]:
+                status_code = 200
+                break
+            updated += batch["message"]["updated"]
+            batches += 1
+            cursor = batch["message"]["last_user_id"]
+            print(f"Bulk grant: {updated} users updated, last user {cursor}")
+        # Cached balances of every user are now behind by the grant
+        self.balance_cache.invalidate()
+        return {
+            "message": {
+                "updated": updated,
+                "batches": batches,
+                "last_user_id": cursor,
+                "completed": status_code == 200,
+            },
+            "status_code": status_code,
+        }
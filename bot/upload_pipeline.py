@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict
+
+from bot.constants import (
+    UPLOAD_MAX_CONCURRENCY,
+    UPLOAD_MAX_PENDING,
+    UPLOAD_MAX_RETRIES,
+    UPLOAD_RETRY_BACKOFF_SEC,
+    UPLOAD_DEDUP_MAX_ENTRIES,
+    UPLOAD_SHUTDOWN_TIMEOUT_SEC,
+)
+from bot.image_preprocessing import detect_image_mime_type
+
+_EXTENSIONS = {
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/heic": ".heic",
+    "image/jpeg": ".jpg",
+}
+
+
+def _is_duplicate(response: Dict[str, Any]) -> bool:
+    # Storage answers 409 Duplicate when the object already exists
+    error = str(response.get("error", ""))
+    return "Duplicate" in error or "already exists" in error
+
+
+class UploadPipeline:
+    """
+    Uploads task photos to storage in the background so quota checks and
+    solving don't wait for them.
+    Objects are stored under the SHA-256 of their content, so the same
+    photo is uploaded once no matter how many times it's sent.
+    At most UPLOAD_MAX_CONCURRENCY uploads run at a time; once
+    UPLOAD_MAX_PENDING are queued, `submit` waits for one to finish.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_concurrency: int = UPLOAD_MAX_CONCURRENCY,
+        max_pending: int = UPLOAD_MAX_PENDING,
+        max_retries: int = UPLOAD_MAX_RETRIES,
+        retry_backoff_sec: float = UPLOAD_RETRY_BACKOFF_SEC,
+        dedup_entries: int = UPLOAD_DEDUP_MAX_ENTRIES,
+    ):
+        self.db = db
+        self.max_retries = max_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self.dedup_entries = dedup_entries
+        self._running = asyncio.Semaphore(max_concurrency)
+        self._pending = asyncio.Semaphore(max_pending)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._uploaded: "OrderedDict[str, None]" = OrderedDict()
+        self.submitted = 0
+        self.deduplicated = 0
+        self.uploaded = 0
+        self.retries = 0
+        self.failed = 0
+
+    @staticmethod
+    def object_path(content: bytes) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        return digest + _EXTENSIONS[detect_image_mime_type(content)]
+
+    async def submit(self, content: bytes) -> str:
+        """
+        Schedule an upload of `content` and return its object path without
+        waiting for the upload itself.
+        """
+        self.submitted += 1
+        path = self.object_path(content)
+        if path in self._uploaded or path in self._in_flight:
+            self.deduplicated += 1
+            return path
+        await self._pending.acquire()
+        if path in self._uploaded or path in self._in_flight:
+            # Same photo got scheduled while we waited for a slot
+            self._pending.release()
+            self.deduplicated += 1
+            return path
+        task = asyncio.create_task(self._upload(path, content))
+        self._in_flight[path] = task
+        task.add_done_callback(lambda _: self._done(path))
+        return path
+
+    def _done(self, path: str) -> None:
+        self._in_flight.pop(path, None)
+        self._pending.release()
+
+    async def _upload(self, path: str, content: bytes) -> None:
+        async with self._running:
+            for attempt in range(self.max_retries + 1):
+                response = await self.db.upload_file(
+                    file_path=path,
+                    file_bytes=content,
+                    content_type=detect_image_mime_type(content),
+                )
+                if response.get("status_code") == 200 or _is_duplicate(response):
+                    self.uploaded += 1
+                    self._remember(path)
+                    return
+                print(f"Upload of {path} failed", response.get("error"))
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    await asyncio.sleep(self.retry_backoff_sec * 2 ** attempt)
+            self.failed += 1
+            print(f"Giving up on upload of {path}")
+
+    def _remember(self, path: str) -> None:
+        self._uploaded[path] = None
+        self._uploaded.move_to_end(path)
+        while len(self._uploaded) > self.dedup_entries:
+            self._uploaded.popitem(last=False)
+
+    async def stop(self, timeout: float = UPLOAD_SHUTDOWN_TIMEOUT_SEC) -> None:
+        """Wait for queued uploads to finish."""
+        tasks = list(self._in_flight.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            print(f"Upload pipeline shutdown timed out, {len(pending)} uploads lost")
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._in_flight),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "uploaded": self.uploaded,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
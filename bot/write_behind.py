@@ -0,0 +1,191 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from bot.constants import (
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL_SEC,
+    WRITE_BEHIND_MAX_PENDING,
+    WRITE_BEHIND_MAX_RETRIES,
+    WRITE_BEHIND_RETRY_BACKOFF_SEC,
+    WRITE_BEHIND_SHUTDOWN_TIMEOUT_SEC,
+)
+
+_SOLUTION = "solution"
+_IMAGE_PATH = "image_path"
+# Enough of a row to find it in the logs, without the solution payload
+_ROW_KEYS = ("user_id", "file_path", "image_path")
+
+
+class WriteBehindQueue:
+    """
+    Buffers solution inserts and last_processing_image_path updates off the
+    response path and writes them in batches, on WRITE_BEHIND_BATCH_SIZE
+    pending writes or WRITE_BEHIND_FLUSH_INTERVAL_SEC, whichever comes first.
+    The queue is bounded: when the database falls behind, `put_*` waits
+    instead of growing memory. `stop` flushes what is left.
+    """
+
+    def __init__(
+        self,
+        db,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval_sec: float = WRITE_BEHIND_FLUSH_INTERVAL_SEC,
+        max_pending: int = WRITE_BEHIND_MAX_PENDING,
+        max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+        retry_backoff_sec: float = WRITE_BEHIND_RETRY_BACKOFF_SEC,
+    ):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.max_retries = max_retries
+        self.retry_backoff_sec = retry_backoff_sec
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.retries = 0
+        self.dropped = 0
+        self.batches = 0
+        self._flush_time_total = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._worker())
+
+    async def stop(self, timeout: float = WRITE_BEHIND_SHUTDOWN_TIMEOUT_SEC) -> None:
+        """Flush everything queued so far and stop the worker."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        try:
+            await asyncio.wait_for(self._task, timeout)
+        except asyncio.TimeoutError:
+            print(f"Write-behind shutdown timed out, {self._queue.qsize()} writes lost")
+        self._task = None
+
+    async def put_solution(
+        self,
+        user_id: str,
+        file_path: str,
+        solution: dict,
+        image_hash: str | None = None,
+        query_text: str | None = None,
+        query_hash: str | None = None,
+        object_path: str | None = None,
+    ) -> None:
+        """Queue an insert_solution call; arguments are the same."""
+        await self._put(
+            (
+                _SOLUTION,
+                {
+                    "user_id": user_id,
+                    "file_path": file_path,
+                    "solution": solution,
+                    "image_hash": image_hash,
+                    "query_text": query_text,
+                    "query_hash": query_hash,
+                    "object_path": object_path,
+                },
+            )
+        )
+
+    async def put_last_processing_image_path(self, user_id: str, image_path: str) -> None:
+        """Queue an update_last_processing_image_path call."""
+        await self._put((_IMAGE_PATH, {"user_id": user_id, "image_path": image_path}))
+
+    async def _put(self, item: Tuple[str, Dict[str, Any]]) -> None:
+        self.enqueued += 1
+        if self._task is None:
+            # Not started (or already stopped): write through
+            await self._flush([item])
+            return
+        await self._queue.put(item)
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + self.flush_interval_sec
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        start = time.monotonic()
+        solutions = [row for kind, row in batch if kind == _SOLUTION]
+        # Only the latest path per user matters
+        image_paths = {}
+        for kind, row in batch:
+            if kind == _IMAGE_PATH:
+                image_paths[row["user_id"]] = row
+        if image_paths:
+            await self._write(
+                self.db.set_last_processing_image_paths, list(image_paths.values())
+            )
+        if solutions:
+            await self._write(self.db.insert_solutions, solutions)
+        self.batches += 1
+        self._flush_time_total += time.monotonic() - start
+
+    async def _write(self, write, rows: List[Dict[str, Any]]) -> None:
+        if await self._attempt(write, rows, self.max_retries):
+            return
+        # Still failing after the retries: likely one bad row (constraint,
+        # oversized JSON), so bisect to drop only that one
+        await self._split(write, rows)
+
+    async def _attempt(self, write, rows: List[Dict[str, Any]], retries: int) -> bool:
+        for attempt in range(retries + 1):
+            try:
+                response = await write(rows)
+            except Exception as e:
+                response = {"status_code": 400, "error": str(e)}
+            if response.get("status_code") == 200:
+                self.written += len(rows)
+                return True
+            print(f"Write-behind {write.__name__} of {len(rows)} rows failed", response.get("error"))
+            if attempt < retries:
+                self.retries += 1
+                await asyncio.sleep(self.retry_backoff_sec * 2 ** attempt)
+        return False
+
+    async def _split(self, write, rows: List[Dict[str, Any]]) -> None:
+        if len(rows) == 1:
+            self.dropped += 1
+            keys = {key: rows[0][key] for key in _ROW_KEYS if key in rows[0]}
+            print(f"Write-behind dropped a {write.__name__} row", keys)
+            return
+        middle = len(rows) // 2
+        for half in (rows[:middle], rows[middle:]):
+            if not await self._attempt(write, half, 0):
+                await self._split(write, half)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "avg_flush_ms": round(1000 * self._flush_time_total / self.batches, 1)
+            if self.batches
+            else 0.0,
+        }
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from bot.gemini_service import GeminiSolver
+
+CALL_SEC = 0.2
+
+
+class _Result:
+    text = '{"solutions": []}'
+
+
+class _SlowModel:
+    """Stands in for GenerativeModel: each call takes CALL_SEC without blocking."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def generate_content_async(self, contents):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(CALL_SEC)
+            return _Result()
+        finally:
+            self.in_flight -= 1
+
+
+def _solver(max_concurrency: int = 16) -> GeminiSolver:
+    solver = GeminiSolver(google_api_key="test", max_concurrency=max_concurrency)
+    solver.model = solver._text_model = _SlowModel()
+    return solver
+
+
+def test_calls_run_concurrently():
+    solver = _solver()
+    calls = 8
+
+    async def run():
+        start = time.monotonic()
+        results = await asyncio.gather(
+            *(solver.solve(b"\x89PNG\r\n\x1a\n", "image/png") for _ in range(calls))
+        )
+        return time.monotonic() - start, results
+
+    elapsed, results = asyncio.run(run())
+    assert results == [{"solutions": []}] * calls
+    # Sequential calls would take calls * CALL_SEC
+    assert elapsed < 2 * CALL_SEC
+    assert solver.model.max_in_flight == calls
+
+
+def test_event_loop_keeps_running_during_a_call():
+    solver = _solver()
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await solver.generate_text("2 + 2")
+        task.cancel()
+        return ticks
+
+    # A blocking call would leave the ticker no chance to run
+    assert asyncio.run(run()) >= CALL_SEC / 0.01 / 2
+
+
+def test_concurrency_is_bounded():
+    solver = _solver(max_concurrency=2)
+
+    async def run():
+        await asyncio.gather(*(solver.generate_text("x") for _ in range(6)))
+
+    asyncio.run(run())
+    assert solver.model.max_in_flight == 2
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+pytest.importorskip("openai")
+
+from bot.gpt_service import SolutionStreamParser
+
+SOLUTIONS = [
+    {
+        "problem": "Решите $x^2 = 4$ {и} [проверьте]",
+        "steps": [{"type": "math", "content": "x = \\pm 2"}],
+        "solution": [{"type": "text", "content": "Ответ: \"±2\""}],
+    },
+    {"problem": "2 + 2", "steps": [], "solution": [{"type": "math", "content": "4"}]},
+]
+
+
+def _chunks(text: str, size: int):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 17, 10_000])
+def test_solutions_come_out_as_soon_as_they_close(size):
+    text = json.dumps({"solutions": SOLUTIONS}, ensure_ascii=False)
+    parser = SolutionStreamParser()
+    completed = []
+    first_at = None
+    for i, chunk in enumerate(_chunks(text, size)):
+        new = parser.feed(chunk)
+        if new and first_at is None:
+            first_at = i
+        completed.extend(new)
+    assert completed == SOLUTIONS
+    # The first solution is delivered before the output is complete
+    if size < len(text):
+        assert first_at < len(_chunks(text, size)) - 1
+
+
+def test_braces_and_quotes_inside_strings_are_ignored():
+    solution = {"problem": '} ] \\" {', "steps": [], "solution": []}
+    parser = SolutionStreamParser()
+    assert parser.feed(json.dumps({"solutions": [solution]})) == [solution]
+
+
+def test_no_solutions():
+    parser = SolutionStreamParser()
+    assert parser.feed('{"solutions": []}') == []
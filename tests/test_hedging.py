@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from bot.hedging import Hedger, LatencyTracker
+
+
+def _call(result, delay: float = 0.0, error: Exception | None = None):
+    async def call():
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return call
+
+
+def test_latency_tracker_percentiles():
+    tracker = LatencyTracker(window=4)
+    assert tracker.percentile(0.5) is None
+    for latency in (5.0, 1.0, 2.0, 3.0, 4.0):
+        tracker.add(latency)
+    # The oldest sample fell out of the window
+    assert len(tracker) == 4
+    assert tracker.percentile(0.0) == 1.0
+    assert tracker.percentile(0.9) == 4.0
+
+
+def test_fast_primary_wins_without_hedging():
+    hedger = Hedger(enabled=True, hedge_delay=0.5)
+    result = asyncio.run(hedger.run("openai", _call("a"), "gemini", _call("b")))
+    assert result == "a"
+    assert "gemini" not in hedger.stats()["providers"]
+
+
+def test_slow_primary_is_hedged_and_cancelled():
+    hedger = Hedger(enabled=True, hedge_delay=0.05)
+    result = asyncio.run(
+        hedger.run("openai", _call("a", delay=1.0), "gemini", _call("b", delay=0.01))
+    )
+    assert result == "b"
+    openai, gemini = hedger.provider_stats("openai"), hedger.provider_stats("gemini")
+    assert gemini.hedges_started == 1 and gemini.wins == 1
+    assert openai.cancelled == 1
+    # Cut off past the hedge delay, the primary's elapsed time is kept
+    assert openai.censored == 1 and len(openai.latency) == 1
+
+
+def test_invalid_result_falls_through_to_secondary():
+    hedger = Hedger(enabled=True, hedge_delay=0.5)
+    result = asyncio.run(
+        hedger.run("openai", _call({}), "gemini", _call({"solutions": []}), validate=bool)
+    )
+    assert result == {"solutions": []}
+    assert hedger.provider_stats("openai").failures == 1
+
+
+def test_disabled_hedging_only_fails_over():
+    hedger = Hedger(enabled=False)
+    assert hedger.delay_for("openai") is None
+    result = asyncio.run(
+        hedger.run("openai", _call("a", delay=0.1), "gemini", _call("b"))
+    )
+    assert result == "a"
+    assert "gemini" not in hedger.stats()["providers"]
+
+
+def test_both_failing_raises_the_last_error():
+    hedger = Hedger(enabled=True, hedge_delay=0.5)
+    with pytest.raises(RuntimeError, match="gemini down"):
+        asyncio.run(
+            hedger.run(
+                "openai",
+                _call(None, error=RuntimeError("openai down")),
+                "gemini",
+                _call(None, error=RuntimeError("gemini down")),
+            )
+        )
+
+
+def test_adaptive_delay_uses_the_latency_percentile():
+    hedger = Hedger(enabled=True, hedge_delay=None, percentile=0.9, min_samples=10, default_delay=30.0)
+    assert hedger.delay_for("openai") == 30.0
+    for i in range(10):
+        hedger.provider_stats("openai").latency.add(float(i + 1))
+    assert hedger.delay_for("openai") == 10.0
@@ -0,0 +1,164 @@
+import asyncio
+import time
+
+import pytest
+
+from bot.hedging import Hedger
+from bot.provider_router import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    ProviderRouter,
+    ProviderUnavailableError,
+)
+
+
+def _breaker(**kwargs) -> CircuitBreaker:
+    options = dict(
+        alpha=0.5,
+        error_rate_threshold=0.5,
+        latency_threshold_sec=10.0,
+        min_calls=2,
+        open_sec=60.0,
+        half_open_probes=1,
+    )
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def _cool_down(breaker: CircuitBreaker) -> None:
+    breaker._opened_at = time.monotonic() - breaker.open_sec
+
+
+def test_breaker_opens_on_errors_and_recovers_through_a_probe():
+    breaker = _breaker()
+    breaker.record_failure()
+    assert breaker.state == CLOSED  # below min_calls
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.acquire()
+
+    _cool_down(breaker)
+    assert breaker.state == HALF_OPEN
+    assert breaker.acquire()
+    # Only one probe at a time
+    assert not breaker.acquire()
+    breaker.record_success(1.0)
+    assert breaker.state == CLOSED and breaker.error_rate == 0.0
+
+
+def test_failed_probe_reopens():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    _cool_down(breaker)
+    assert breaker.acquire()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 2
+
+
+def test_breaker_opens_on_latency():
+    breaker = _breaker(latency_threshold_sec=1.0)
+    breaker.record_success(3.0)
+    breaker.record_success(3.0)
+    assert breaker.state == OPEN
+
+
+def test_slow_cancelled_calls_count_as_latency_samples():
+    breaker = _breaker(latency_threshold_sec=1.0)
+    breaker.record_success(0.1)
+    # Cut off by the hedge after 0.05s: faster than usual, ignored
+    breaker.record_cancelled(0.05)
+    assert breaker.calls == 1
+    breaker.record_cancelled(5.0)
+    breaker.record_cancelled(5.0)
+    assert breaker.cancelled_slow == 2
+    assert breaker.state == OPEN
+
+
+def test_cancelled_probe_frees_its_slot():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    _cool_down(breaker)
+    assert breaker.acquire()
+    breaker.record_cancelled(0.1)
+    assert breaker.state == HALF_OPEN and breaker.acquire()
+
+
+def _provider(result=None, error: Exception | None = None, delay: float = 0.0):
+    calls = []
+
+    async def solve(*args):
+        calls.append(args)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return solve, calls
+
+
+def _router(openai, gemini) -> ProviderRouter:
+    router = ProviderRouter(
+        {"openai": {"solve": openai}, "gemini": {"solve": gemini}},
+        hedger=Hedger(enabled=True, hedge_delay=0.5),
+    )
+    for name in router.breakers:
+        router.breakers[name] = _breaker()
+    return router
+
+
+def test_router_prefers_the_first_provider():
+    openai, openai_calls = _provider("a")
+    gemini, gemini_calls = _provider("b")
+    router = _router(openai, gemini)
+    assert asyncio.run(router.call("solve", b"img")) == "a"
+    assert openai_calls == [(b"img",)] and gemini_calls == []
+
+
+def test_router_skips_an_open_breaker():
+    openai, openai_calls = _provider("a")
+    gemini, _ = _provider("b")
+    router = _router(openai, gemini)
+    router.breakers["openai"]._open()
+    assert asyncio.run(router.call("solve")) == "b"
+    assert openai_calls == []
+    assert router.status()["openai"]["rejected"] == 1
+
+
+def test_router_fails_over_and_records_the_failure():
+    openai, _ = _provider(error=RuntimeError("down"))
+    gemini, _ = _provider("b")
+    router = _router(openai, gemini)
+    assert asyncio.run(router.call("solve")) == "b"
+    assert router.breakers["openai"].error_rate > 0
+
+
+def test_router_with_every_breaker_open_still_tries_the_preferred_provider():
+    openai, openai_calls = _provider("a")
+    gemini, _ = _provider("b")
+    router = _router(openai, gemini)
+    router.breakers["openai"]._open()
+    router.breakers["gemini"]._open()
+    assert asyncio.run(router.call("solve")) == "a"
+    assert len(openai_calls) == 1
+
+
+def test_stream_uses_the_first_provider_with_the_operation():
+    async def stream(*args):
+        for item in ("x", "y"):
+            yield item
+
+    router = ProviderRouter(
+        {"openai": {"solve_stream": stream}, "gemini": {}}, hedger=Hedger(enabled=False)
+    )
+
+    async def collect():
+        return [item async for item in router.stream("solve_stream")]
+
+    assert asyncio.run(collect()) == ["x", "y"]
+    router.breakers["openai"]._open()
+    with pytest.raises(ProviderUnavailableError):
+        asyncio.run(collect())
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from bot.rate_limiter import LLMRateLimiter, TokenBucket
+
+
+def test_token_bucket_waits_for_the_deficit():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.time_until(60) == 0.0
+    bucket.consume(60)
+    # 1 token per second
+    assert 0.9 < bucket.time_until(1) <= 1.0
+    # A request bigger than the bucket waits for a full bucket, not forever
+    assert bucket.time_until(1000) <= 60.0
+
+
+def test_token_bucket_adjust_is_capped_at_capacity():
+    bucket = TokenBucket(per_minute=100)
+    bucket.adjust(-500)
+    assert bucket.tokens == 100
+    bucket.adjust(150)
+    assert bucket.tokens < 0
+
+
+def test_acquire_is_immediate_within_budget():
+    limiter = LLMRateLimiter(requests_per_minute=10, tokens_per_minute=10_000)
+
+    async def run():
+        return [await limiter.acquire(1000) for _ in range(5)]
+
+    reservations = asyncio.run(run())
+    assert all(r.waited < 0.01 for r in reservations)
+    stats = limiter.stats()
+    assert stats["acquired"] == 5 and stats["delayed"] == 0
+    assert stats["estimated_tokens"] == 5000
+    assert stats["available_requests"] == 5
+
+
+def test_empty_token_bucket_delays_the_request():
+    # 1000 tokens per second
+    limiter = LLMRateLimiter(requests_per_minute=1000, tokens_per_minute=60_000)
+    limiter._tokens.tokens = 0
+    start_time = time.monotonic()
+    reservation = asyncio.run(limiter.acquire(100))
+    assert time.monotonic() - start_time >= 0.09
+    assert reservation.waited >= 0.09
+    assert limiter.stats()["delayed"] == 1
+
+
+def test_empty_request_bucket_delays_the_request():
+    # 100 requests per second
+    limiter = LLMRateLimiter(requests_per_minute=6000, tokens_per_minute=1_000_000)
+    limiter._requests.tokens = -4
+    reservation = asyncio.run(limiter.acquire(1))
+    assert reservation.waited >= 0.04
+
+
+def test_waiters_are_served_in_arrival_order():
+    limiter = LLMRateLimiter(requests_per_minute=6000, tokens_per_minute=1_000_000)
+    limiter._requests.tokens = 0
+    order = []
+
+    async def request(i):
+        await limiter.acquire(1)
+        order.append(i)
+
+    async def run():
+        tasks = []
+        for i in range(5):
+            tasks.append(asyncio.create_task(request(i)))
+            await asyncio.sleep(0)
+        assert limiter.queue_depth == 5
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == [0, 1, 2, 3, 4]
+    assert limiter.max_queue_depth == 5 and limiter.queue_depth == 0
+
+
+def test_reconcile_returns_unused_tokens_and_charges_overruns():
+    limiter = LLMRateLimiter(requests_per_minute=10, tokens_per_minute=10_000)
+    reservation = asyncio.run(limiter.acquire(4000))
+    assert limiter.stats()["available_tokens"] == 6000
+    limiter.reconcile(reservation, 1000)
+    assert limiter.stats()["available_tokens"] == 9000
+    assert limiter.actual_tokens == 1000
+
+    reservation = asyncio.run(limiter.acquire(1000))
+    limiter.reconcile(reservation, 12_000)
+    # The overrun is debt: the next request has to wait for it
+    assert limiter._tokens.tokens < 0
+    assert limiter._tokens.time_until(1) > 0
+    assert limiter.stats()["actual_tokens"] == 13_000
+
+
+def test_failed_request_gives_back_its_estimate():
+    limiter = LLMRateLimiter(requests_per_minute=10, tokens_per_minute=10_000)
+    reservation = asyncio.run(limiter.acquire(3000))
+    limiter.reconcile(reservation, 0)
+    assert limiter.stats()["available_tokens"] == 10_000
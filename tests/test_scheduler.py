@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+from bot.constants import PRIORITY_FREE, PRIORITY_PAID
+from bot.scheduler import PriorityScheduler, classify_priority
+
+
+@pytest.mark.parametrize(
+    "balance, expected",
+    [
+        ({"message": [{"subscription_limit": 100}]}, PRIORITY_PAID),
+        ({"message": [{"subscription_limit": 0}]}, PRIORITY_FREE),
+        ({"message": []}, PRIORITY_FREE),
+        ({"message": "Error"}, PRIORITY_FREE),
+        ({}, PRIORITY_FREE),
+    ],
+)
+def test_classify_priority(balance, expected):
+    assert classify_priority(balance) == expected
+
+
+async def _run_order(scheduler: PriorityScheduler, priorities, hold: float = 0.0):
+    """Queue `priorities` behind a held slot and return the order they ran in."""
+    order = []
+    gate = asyncio.Event()
+
+    async def holder():
+        async with scheduler.slot(PRIORITY_FREE):
+            await gate.wait()
+
+    async def request(i, priority):
+        async with scheduler.slot(priority):
+            order.append((i, priority))
+            await asyncio.sleep(hold)
+
+    first = asyncio.create_task(holder())
+    await asyncio.sleep(0)
+    tasks = [asyncio.create_task(request(i, p)) for i, p in enumerate(priorities)]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(first, *tasks)
+    return order
+
+
+def test_capacity_limits_concurrency():
+    scheduler = PriorityScheduler(capacity=2)
+    active = 0
+    peak = 0
+
+    async def request():
+        nonlocal active, peak
+        async with scheduler.slot(PRIORITY_FREE):
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2
+    stats = scheduler.stats()
+    assert stats["active"] == 0
+    assert stats["classes"][PRIORITY_FREE]["served"] == 6
+
+
+def test_paid_requests_jump_the_queue_without_starving_free_ones():
+    scheduler = PriorityScheduler(capacity=1, weights={PRIORITY_PAID: 3, PRIORITY_FREE: 1})
+    priorities = [PRIORITY_FREE] * 4 + [PRIORITY_PAID] * 8
+    order = asyncio.run(_run_order(scheduler, priorities))
+    served = [priority for _, priority in order]
+    # 3 paid for every free while both classes wait
+    assert served[:4].count(PRIORITY_PAID) == 3
+    assert served[:8].count(PRIORITY_FREE) == 2
+    # Within a class, requests run in arrival order
+    assert [i for i, p in order if p == PRIORITY_FREE] == [0, 1, 2, 3]
+    assert len(order) == 12
+
+
+def test_unknown_priority_is_treated_as_free():
+    scheduler = PriorityScheduler(capacity=1)
+    order = asyncio.run(_run_order(scheduler, ["vip"]))
+    assert order == [(0, "vip")]
+    assert scheduler.stats()["classes"][PRIORITY_FREE]["served"] == 2
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    scheduler = PriorityScheduler(capacity=1)
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot(PRIORITY_FREE):
+                await gate.wait()
+
+        async def waiter():
+            async with scheduler.slot(PRIORITY_PAID):
+                pass
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        task = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert scheduler.stats()["classes"][PRIORITY_PAID]["queued"] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.stats()["classes"][PRIORITY_PAID]["queued"] == 0
+        gate.set()
+        await first
+
+    asyncio.run(run())
+    assert scheduler.stats()["active"] == 0
+
+
+def test_waiter_cancelled_after_the_hand_off_passes_the_slot_on():
+    scheduler = PriorityScheduler(capacity=1)
+
+    async def run():
+        gate = asyncio.Event()
+        ran = []
+
+        async def holder():
+            async with scheduler.slot(PRIORITY_FREE):
+                await gate.wait()
+
+        async def request(name):
+            async with scheduler.slot(PRIORITY_FREE):
+                ran.append(name)
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(request("cancelled"))
+        second = asyncio.create_task(request("second"))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.sleep(0)
+        assert first.done()
+        # The slot went to `cancelled`, which hasn't woken up yet
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await second
+        return ran
+
+    assert asyncio.run(run()) == ["second"]
+    assert scheduler.stats()["active"] == 0
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from bot.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    runs = 0
+
+    async def solve():
+        nonlocal runs
+        runs += 1
+        await asyncio.sleep(0.05)
+        return {"solutions": [runs]}
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", solve) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert runs == 1
+    assert results == [{"solutions": [1]}] * 5
+    assert flight.stats()["coalesced"] == 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_different_keys_run_separately():
+    flight = SingleFlight()
+
+    async def run():
+        return await asyncio.gather(
+            flight.do("a", lambda: asyncio.sleep(0.01, result="a")),
+            flight.do("b", lambda: asyncio.sleep(0.01, result="b")),
+        )
+
+    assert asyncio.run(run()) == ["a", "b"]
+    assert flight.stats()["calls"] == 2
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    flight = SingleFlight()
+    attempts = 0
+
+    async def fail():
+        nonlocal attempts
+        attempts += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError("down")
+
+    async def run():
+        return await asyncio.gather(
+            flight.do("k", fail), flight.do("k", fail), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    with pytest.raises(RuntimeError):
+        asyncio.run(flight.do("k", fail))
+    assert attempts == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    flight = SingleFlight()
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("k", lambda: asyncio.sleep(0.05, result=42)))
+        second = asyncio.ensure_future(flight.do("k", lambda: asyncio.sleep(0.05, result=0)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == 42
+
+
+def test_leader_hands_off_to_waiting_followers():
+    flight = SingleFlight()
+
+    async def run():
+        flight.lead("k")
+        follower = asyncio.ensure_future(flight.do("k", lambda: asyncio.sleep(0, result="unused")))
+        await asyncio.sleep(0)
+        # The leader's client went away before it finished
+        flight.hand_off("k", lambda: asyncio.sleep(0.01, result="handed off"))
+        return await follower
+
+    assert asyncio.run(run()) == "handed off"
+    assert flight.stats()["handoffs"] == 1
+
+
+def test_hand_off_without_followers_drops_the_key():
+    flight = SingleFlight()
+
+    async def run():
+        future = flight.lead("k")
+        flight.hand_off("k", lambda: asyncio.sleep(0, result="unused"))
+        await asyncio.sleep(0)
+        return future.cancelled()
+
+    assert asyncio.run(run())
+    assert flight.in_flight("k") is None
+    assert flight.stats()["handoffs"] == 0
@@ -0,0 +1,91 @@
+import io
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+from bot.solution_cache import (
+    ImageSolutionCache,
+    TextSolutionCache,
+    compute_image_hash,
+    hash_query_text,
+    normalize_query_text,
+)
+
+_LETTERS = "abcdefghijklmnopqrstuvwxyz"
+
+
+def _page(seed: int) -> Image.Image:
+    """A textbook-like page: lines of words of random length under uneven lighting."""
+    rnd = random.Random(seed)
+    width, height = 1240, 1754
+    image = Image.new("L", (width, height), 235)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default(size=30)
+    y = 120
+    while y < height - 150:
+        words = []
+        while sum(len(word) + 1 for word in words) < rnd.randint(30, 60):
+            words.append("".join(rnd.choice(_LETTERS) for _ in range(rnd.randint(2, 9))))
+        draw.text((100, y), " ".join(words), font=font, fill=25)
+        y += 46
+    lighting = Image.linear_gradient("L").resize((width, height)).rotate(90)
+    shadow = Image.composite(image, Image.new("L", (width, height), 60), lighting)
+    return Image.blend(image, shadow, 0.6).convert("RGB")
+
+
+def _jpeg(image: Image.Image, quality: int = 85) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _crop(image: Image.Image, share: float) -> Image.Image:
+    width, height = image.size
+    dx, dy = int(width * share), int(height * share)
+    return image.crop((dx, dy, width - dx, height - dy))
+
+
+def _cache_with(pages):
+    cache = ImageSolutionCache()
+    for i, page in enumerate(pages):
+        cache.put(compute_image_hash(_jpeg(page)), {"page": i})
+    return cache
+
+
+def test_image_cache_serves_near_duplicates():
+    pages = [_page(seed) for seed in range(3)]
+    cache = _cache_with(pages)
+    for i, page in enumerate(pages):
+        width, height = page.size
+        copies = [
+            _jpeg(page, quality=60),
+            _jpeg(page.resize((width * 6 // 10, height * 6 // 10))),
+            _jpeg(_crop(page, 0.02), quality=80),
+        ]
+        for copy in copies:
+            assert cache.get(compute_image_hash(copy)) == {"page": i}
+
+
+def test_image_cache_rejects_other_pages():
+    cache = _cache_with([_page(seed) for seed in range(3)])
+    for seed in range(100, 103):
+        assert cache.get(compute_image_hash(_jpeg(_page(seed)))) is None
+    assert cache.stats()["hits"] == 0
+
+
+def test_undecodable_image_has_no_hash():
+    assert compute_image_hash(b"not an image") is None
+
+
+def test_spacing_around_operators_is_canonical():
+    canonical = normalize_query_text("x^2-5x+6=0")
+    for variant in ("x^2 - 5x + 6 = 0", "x^2 - 5 x + 6 = 0", " X^2  \u2212 5x+6 =0 "):
+        assert normalize_query_text(variant) == canonical
+    assert hash_query_text(normalize_query_text("x^2 - 5x + 6 = 0")) == hash_query_text(canonical)
+
+
+def test_text_cache_matches_differently_spaced_copies():
+    cache = TextSolutionCache()
+    cache.put(normalize_query_text("Solve x^2-5x+6=0"), {"answer": "2, 3"})
+    assert cache.get(normalize_query_text("Solve  x^2 - 5x + 6 = 0.")) == {"answer": "2, 3"}
+    assert cache.get(normalize_query_text("Solve x^2 - 5x + 7 = 0")) is None
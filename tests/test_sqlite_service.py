@@ -0,0 +1,130 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from bot.constants import DEFAULT_DAILY_LIMIT
+from bot.sqlite_service import SQLiteService
+
+
+@pytest.fixture
+def db(tmp_path):
+    return SQLiteService(db_path=str(tmp_path / "bot.db"), storage_dir=str(tmp_path / "storage"))
+
+
+def _add_users(db: SQLiteService, *user_ids) -> None:
+    async def add():
+        for user_id in user_ids:
+            await db.add_new_user({"user_id": user_id})
+
+    asyncio.run(add())
+
+
+def test_consume_quota_spends_daily_then_subscription(db):
+    _add_users(db, 1)
+    asyncio.run(db.add_subscription_limit(1, 1))
+
+    async def run():
+        return [await db.proceed_processing(1) for _ in range(DEFAULT_DAILY_LIMIT + 2)]
+
+    assert asyncio.run(run()) == [True] * (DEFAULT_DAILY_LIMIT + 1) + [False]
+    balance = asyncio.run(db.get_current_balance(1))["message"][0]
+    assert balance == {"daily_limit": 0, "subscription_limit": 0}
+
+
+def test_concurrent_consume_quota_never_overspends(db):
+    _add_users(db, 1)
+    asyncio.run(db.add_subscription_limit(1, 5))
+    available = DEFAULT_DAILY_LIMIT + 5
+
+    async def run():
+        return await asyncio.gather(*(db.proceed_processing(1) for _ in range(4 * available)))
+
+    results = asyncio.run(run())
+    assert results.count(True) == available
+    db.balance_cache.invalidate()
+    balance = asyncio.run(db.get_current_balance(1))["message"][0]
+    assert balance == {"daily_limit": 0, "subscription_limit": 0}
+
+
+def test_consume_quota_for_unknown_user(db):
+    assert asyncio.run(db.consume_quota(42))["status_code"] == 404
+    assert asyncio.run(db.proceed_processing(42)) is False
+
+
+def test_iter_user_ids_pages_through_every_user_in_order(db):
+    user_ids = [str(i) for i in range(23)]
+    _add_users(db, *user_ids)
+
+    async def collect(page_size):
+        return [row["user_id"] async for row in db.iter_user_ids(page_size=page_size)]
+
+    for page_size in (1, 5, 23, 100):
+        assert asyncio.run(collect(page_size)) == sorted(user_ids)
+    assert asyncio.run(db.get_all_user_ids())["message"] == [
+        {"user_id": user_id} for user_id in sorted(user_ids)
+    ]
+
+
+
+def test_bulk_grant_resumes_after_a_cursor(db):
+    _add_users(db, "a", "b", "c", "d", "e")
+    result = asyncio.run(db.add_subscription_limits_for_all_users(2, resume_after="b", batch_size=2))
+    assert result["message"] == {"updated": 3, "batches": 2, "last_user_id": "e", "completed": True}
+
+    async def balances():
+        return {
+            user_id: (await db.get_current_balance(user_id))["message"][0]["subscription_limit"]
+            for user_id in "abcde"
+        }
+
+    assert asyncio.run(balances()) == {"a": 0, "b": 0, "c": 2, "d": 2, "e": 2}
+
+
+def test_add_new_user_is_idempotent(db):
+    assert asyncio.run(db.add_new_user({"user_id": 1}))["message"] == "User added successfully"
+    assert asyncio.run(db.add_new_user({"user_id": 1}))["message"] == "User already exists"
+    assert asyncio.run(db.is_exist(1)) and not asyncio.run(db.is_exist(2))
+    balance = asyncio.run(db.get_current_balance(1))["message"][0]
+    assert balance == {"daily_limit": DEFAULT_DAILY_LIMIT, "subscription_limit": 0}
+
+
+def test_solutions_round_trip(db):
+    solution = {"solutions": [{"problem": "2 + 2", "steps": [], "solution": []}]}
+
+    async def insert():
+        await db.insert_solution(1, "a.jpg", solution, image_hash="ff00", object_path="x/a.jpg")
+        await db.insert_solution(1, "b.jpg", solution, query_text="2+2")
+
+    asyncio.run(insert())
+    # A second service on the same file starts with empty caches
+    other = SQLiteService(db_path=db.db_path, storage_dir=db.storage_dir)
+    assert asyncio.run(other.get_exist_solution(1, "a.jpg"))["message"] == [{"solution": solution}]
+    assert asyncio.run(other.get_exist_solution(1, "c.jpg"))["message"] == []
+    assert asyncio.run(other.get_solution_by_image_hash("ff00"))["message"] == solution
+    assert asyncio.run(other.get_solution_by_image_hash("0000"))["message"] is None
+    # Query text without its hash isn't stored as a text solution
+    assert asyncio.run(other.get_text_solutions(10))["message"] == []
+    assert asyncio.run(other.get_hashed_solutions(10))["message"] == [
+        {"image_hash": "ff00", "solution": solution}
+    ]
+
+
+def test_upload_file_refuses_duplicates(db):
+    assert asyncio.run(db.upload_file("1/a.jpg", b"abc"))["status_code"] == 200
+    result = asyncio.run(db.upload_file("1/a.jpg", b"abc"))
+    assert result["status_code"] == 400 and "Duplicate" in result["error"]
+
+
+def test_old_database_gains_the_object_path_column(tmp_path):
+    path = str(tmp_path / "old.db")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "create table tasks (id integer primary key autoincrement, user_id text not null,"
+        " file_path text not null, solution text not null, image_hash text,"
+        " query_text text, query_hash text, created_at text not null default '')"
+    )
+    connection.close()
+    db = SQLiteService(db_path=path, storage_dir=str(tmp_path / "storage"))
+    result = asyncio.run(db.insert_solution(1, "a.jpg", {"solutions": []}, object_path="x/a.jpg"))
+    assert result["status_code"] == 200